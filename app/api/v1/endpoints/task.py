@@ -2,20 +2,33 @@
 Definition of the task endpoints for the service.
 """
 
-from typing import Union
+import json
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple, Union
 
 import redis
 from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.exc import NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.api.v1.schema.generic import ListResponse
-from app.api.v1.schema.task import CreateTask, Task
+from app.api.v1.schema.generic import CursorListResponse, ListResponse
+from app.api.v1.schema.task import CancelTasks, CancelTasksResult, CreateTask, CreateTasks, Task, TaskCount
+from app.core.config import settings
 from app.database.crud import task as crud_task
-from app.enum.task import TaskStatus
-from app.middleware.depends import get_db_session, get_redis_session
+from app.database.models.task import Task as TaskModel
+from app.enum.task import TaskStatus, TaskTotalMode, TaskType
+from app.middleware.depends import get_db_session, get_db_session_context_manager, get_redis_session, get_task_status_hub
+from app.utils.db import decode_cursor, encode_cursor
+from app.utils.exceptions.data_validation import InvalidCursorError, TooManyValuesError
+from app.utils.exceptions.db import EntryWithIDNotExist
 from app.utils.exceptions.task import JobCannotBeCancelled
 from app.utils.logging.logger import get_logger
-from app.utils.task.task import create_and_publish_task
+from app.utils.task.outbox import TaskOutboxRelay, get_task_outbox_relay
+from app.utils.task.status_cache import TERMINAL_STATUS_LIST, cache_task_status, cache_tasks, fill_cached_task, get_cached_task
+from app.utils.task.status_events import TaskStatusEvent, TaskStatusHub, build_task_status_event, publish_task_status_events
+from app.utils.task.task import create_and_publish_task, create_and_publish_tasks, publish_task_cancellations
+from app.utils.time import get_utc_now_without_timezone
 
 logger = get_logger()
 router: APIRouter = APIRouter()
@@ -30,19 +43,69 @@ STATUS_LIST_CAN_BE_CANCELLED = [TaskStatus.PENDING, TaskStatus.PROCESSING]
 )
 async def post_task(
     request_body: CreateTask,
+    wait: Optional[float] = Query(
+        None,
+        description="Optional, wait at most the seconds until the task is finished, the task is returned as it is then",
+        ge=0,
+        le=settings.TASK_WAIT_MAX_SECONDS,
+    ),
     db: AsyncSession = Depends(get_db_session),
     redis: Union[redis.Redis, redis.RedisCluster] = Depends(get_redis_session),
-) -> Task:
+    hub: TaskStatusHub = Depends(get_task_status_hub),
+    outbox_relay: TaskOutboxRelay = Depends(get_task_outbox_relay),
+) -> Union[TaskModel, Dict[str, Any]]:
 
     task = await create_and_publish_task(
         db=db,
         redis=redis,
         type=request_body.type,
         parameters=request_body.parameters,
+        priority=request_body.priority,
+        run_at=_get_run_at(request_body),
     )
+    if settings.TASK_OUTBOX_ENABLED:
+        outbox_relay.notify()
+    if wait:
+        return await _wait_for_task(db=db, redis=redis, hub=hub, task_id=task.id, timeout=wait)
     return task
 
 
+@router.post(
+    ":batch",
+    description="Create tasks in batch, the created tasks are returned in the order of the request.",
+    response_model=ListResponse[Task],
+)
+async def post_tasks_batch(
+    request_body: CreateTasks,
+    db: AsyncSession = Depends(get_db_session),
+    redis: Union[redis.Redis, redis.RedisCluster] = Depends(get_redis_session),
+    outbox_relay: TaskOutboxRelay = Depends(get_task_outbox_relay),
+) -> ListResponse[Task]:
+
+    tasks = await create_and_publish_tasks(
+        db=db,
+        redis=redis,
+        tasks=[
+            {
+                "type": create_task.type,
+                "parameters": create_task.parameters,
+                "priority": create_task.priority,
+                "run_at": _get_run_at(create_task),
+            }
+            for create_task in request_body.tasks
+        ],
+    )
+    if settings.TASK_OUTBOX_ENABLED:
+        outbox_relay.notify()
+    return ListResponse(data=tasks, total=len(tasks))  # type: ignore
+
+
+def _get_run_at(create_task: CreateTask) -> Optional[datetime]:
+    if create_task.delay_seconds is not None:
+        return get_utc_now_without_timezone() + timedelta(seconds=create_task.delay_seconds)
+    return create_task.run_at
+
+
 @router.post(
     "/{task_id}/cancel",
     description="cancel a task.",
@@ -51,6 +114,7 @@ async def post_task(
 async def cancel_task(
     task_id: str,
     db: AsyncSession = Depends(get_db_session),
+    redis: Union[redis.Redis, redis.RedisCluster] = Depends(get_redis_session),
 ) -> Task:
 
     task = await crud_task.get_task(db=db, id=task_id)
@@ -64,42 +128,328 @@ async def cancel_task(
         task_id=task_id,
         status=TaskStatus.CANCELED,
     )
+    try:
+        await publish_task_cancellations(redis=redis, task_ids=[task_id])
+    except Exception as e:
+        # the task is cancelled in db anyway, the worker only cannot stop the running handler early
+        logger.error(f"Failed to publish the cancellation of task: {task_id}, error: {e}")
+    if settings.TASK_STATUS_CACHE_ENABLED:
+        try:
+            await cache_tasks(redis=redis, tasks=[task])
+        except Exception as e:
+            logger.error(f"Failed to cache the cancelled task: {task_id}, error: {e}")
+    await _publish_status_events(
+        redis=redis, events=[build_task_status_event(task_id=task.id, status=task.status, type=task.type)]
+    )
+    return task
+
+
+@router.post(
+    ":cancel",
+    description="Cancel the PENDING or PROCESSING tasks by ids or by filter.",
+    response_model=CancelTasksResult,
+)
+async def cancel_tasks(
+    request_body: CancelTasks,
+    db: AsyncSession = Depends(get_db_session),
+    redis: Union[redis.Redis, redis.RedisCluster] = Depends(get_redis_session),
+) -> CancelTasksResult:
+
+    cancelled_ids = await crud_task.cancel_tasks(
+        db=db,
+        cancellable_status_list=STATUS_LIST_CAN_BE_CANCELLED,
+        ids=request_body.ids,
+        type=request_body.type,
+        status_list=request_body.status,
+        created_after=request_body.created_after,
+        created_before=request_body.created_before,
+    )
+    try:
+        await publish_task_cancellations(redis=redis, task_ids=cancelled_ids)
+    except Exception as e:
+        # the tasks are cancelled in db anyway, the workers only cannot stop the running handlers early
+        logger.error(f"Failed to publish the cancellations of {len(cancelled_ids)} task(s), error: {e}")
+    if settings.TASK_STATUS_CACHE_ENABLED:
+        try:
+            await cache_task_status(redis=redis, task_ids=cancelled_ids, status=TaskStatus.CANCELED)
+        except Exception as e:
+            logger.error(f"Failed to cache {len(cancelled_ids)} cancelled task(s), error: {e}")
+    await _publish_status_events(
+        redis=redis,
+        events=[build_task_status_event(task_id=task_id, status=TaskStatus.CANCELED) for task_id in cancelled_ids],
+    )
+    cancelled_id_set = set(cancelled_ids)
+    return CancelTasksResult(
+        cancelled_ids=cancelled_ids,
+        not_cancellable_ids=[task_id for task_id in request_body.ids or [] if task_id not in cancelled_id_set],
+    )
+
+
+@router.get(
+    "/{task_id}",
+    response_model=Task,
+    description="Get a task, it is read from the cache if possible.",
+)
+async def get_task(
+    task_id: str,
+    wait: Optional[float] = Query(
+        None,
+        description="Optional, wait at most the seconds until the task is finished, the task is returned as it is then",
+        ge=0,
+        le=settings.TASK_WAIT_MAX_SECONDS,
+    ),
+    db: AsyncSession = Depends(get_db_session),
+    redis: Union[redis.Redis, redis.RedisCluster] = Depends(get_redis_session),
+    hub: TaskStatusHub = Depends(get_task_status_hub),
+) -> Union[TaskModel, Dict[str, Any]]:
+
+    if wait:
+        return await _wait_for_task(db=db, redis=redis, hub=hub, task_id=task_id, timeout=wait)
+    return await _get_task(db=db, redis=redis, task_id=task_id)
+
+
+async def _get_task(
+    db: AsyncSession, redis: Union[redis.Redis, redis.RedisCluster], task_id: str
+) -> Union[TaskModel, Dict[str, Any]]:
+    if not settings.TASK_STATUS_CACHE_ENABLED:
+        return await _read_task(db=db, task_id=task_id)
+
+    try:
+        cached_task = await get_cached_task(redis=redis, task_id=task_id)
+    except Exception as e:
+        logger.error(f"Failed to read the cached task: {task_id}, error: {e}")
+        return await _read_task(db=db, task_id=task_id)
+    if cached_task is not None:
+        return cached_task
+
+    task = await _read_task(db=db, task_id=task_id)
+    try:
+        await fill_cached_task(redis=redis, task=task)
+    except Exception as e:
+        logger.error(f"Failed to cache the task: {task_id}, error: {e}")
     return task
 
 
+async def _wait_for_task(
+    db: AsyncSession,
+    redis: Union[redis.Redis, redis.RedisCluster],
+    hub: TaskStatusHub,
+    task_id: str,
+    timeout: float,
+) -> Union[TaskModel, Dict[str, Any]]:
+    """
+    Wait for the terminal status event of the task by the status hub of this process instead of polling the task.
+    The db session is released while waiting, so a waiting request does not hold a db connection.
+    """
+    async with hub.subscribe(task_ids=[task_id], status_list=TERMINAL_STATUS_LIST) as subscription:
+        # the task is read after subscribing, so a transition in the meantime is not missed
+        task = await _get_task(db=db, redis=redis, task_id=task_id)
+        status = task["status"] if isinstance(task, dict) else task.status
+        if TaskStatus(status) in TERMINAL_STATUS_LIST:
+            return task
+        await db.close()
+        if await subscription.get(timeout=timeout) is None:
+            return task
+    return await _get_task(db=db, redis=redis, task_id=task_id)
+
+
+async def _read_task(db: AsyncSession, task_id: str) -> TaskModel:
+    try:
+        return await crud_task.get_task(db=db, id=task_id)
+    except NoResultFound:
+        raise EntryWithIDNotExist(entry_name=TaskModel.__tablename__, id=task_id)
+
+
 @router.get(
     "",
-    response_model=ListResponse[Task],
-    description="List all tasks",
+    response_model=CursorListResponse[Task],
+    description="List tasks by pages, the next page is read by the next_cursor of the previous one.",
 )
 async def get_tasks(
-    offset: int = Query(
-        0,
-        description="Optional, determine the number of rows need be skipped",
-        examples=[0],
-    ),
     limit: int = Query(
-        0,
-        description="Optional, determine the number of returned rows after skipped offset, if it is 0, return all items",
-        examples=[0],
+        10,
+        description=f"Optional, the max number of returned rows, 0 means {settings.TASK_LIST_MAX_LIMIT}",
+        examples=[10],
+        ge=0,
+        le=settings.TASK_LIST_MAX_LIMIT,
     ),
-    order_by: str = Query(
-        "created_at:desc",
-        description="Optional, order items by asc or desc with comma-separated list of : pairs, default is created_at:desc.",
-        examples=["created_at:desc"],
+    cursor: Optional[str] = Query(
+        None,
+        description="Optional, the next_cursor of the previous page, the first page is returned without it",
+    ),
+    order: str = Query(
+        "desc",
+        description="Optional, order the tasks by created_at asc or desc, default is desc",
+        examples=["desc"],
+        pattern="^(asc|desc)$",
+    ),
+    status: Optional[List[TaskStatus]] = Query(None, description="Optional, only list the tasks in one of the status"),
+    type: Optional[TaskType] = Query(None, description="Optional, only list the tasks of the type"),
+    created_after: Optional[datetime] = Query(
+        None, description="Optional, only list the tasks created at or after the UTC time"
+    ),
+    created_before: Optional[datetime] = Query(None, description="Optional, only list the tasks created before the UTC time"),
+    total: TaskTotalMode = Query(
+        TaskTotalMode(settings.TASK_LIST_TOTAL_MODE),
+        description="Optional, how the total is got, COUNTED from the counts by status and type, ESTIMATED by the planner "
+        "without filters, EXACT by count(*), or NONE",
     ),
     db: AsyncSession = Depends(get_db_session),
-) -> ListResponse[Task]:
+) -> CursorListResponse[Task]:
     """
     List tasks by filter
     """
+    limit = limit or settings.TASK_LIST_MAX_LIMIT
+    # read one more task to know if there is a next page
     tasks = await crud_task.list_tasks(
         db,
-        offset=offset,
-        limit=limit,
-        order_by=order_by,
+        limit=limit + 1,
+        after=_decode_task_cursor(cursor) if cursor is not None else None,
+        descending=order == "desc",
+        status_list=status,
+        type=type,
+        created_after=created_after,
+        created_before=created_before,
     )
-    tasks_total = await crud_task.count_tasks(
+    next_cursor = None
+    if len(tasks) > limit:
+        tasks = tasks[:limit]
+        next_cursor = encode_cursor([tasks[-1].created_at.isoformat(), tasks[-1].id])
+    tasks_total = await _get_tasks_total(
         db=db,
+        total=total,
+        status_list=status,
+        type=type,
+        created_after=created_after,
+        created_before=created_before,
+    )
+    return CursorListResponse(data=tasks, total=tasks_total, next_cursor=next_cursor)  # type: ignore
+
+
+async def _get_tasks_total(
+    db: AsyncSession,
+    total: TaskTotalMode,
+    status_list: Optional[List[TaskStatus]],
+    type: Optional[TaskType],
+    created_after: Optional[datetime],
+    created_before: Optional[datetime],
+) -> Optional[int]:
+    """
+    The counts by status and type do not grow with the table, a created_at range is counted by scanning the index range.
+    """
+    if total == TaskTotalMode.NONE:
+        return None
+    has_range = created_after is not None or created_before is not None
+    if total == TaskTotalMode.EXACT or has_range:
+        return await crud_task.count_tasks(
+            db=db,
+            status_list=status_list,
+            type=type,
+            created_after=created_after,
+            created_before=created_before,
+        )
+    if total == TaskTotalMode.ESTIMATED and status_list is None and type is None:
+        estimate = await crud_task.estimate_task_count(db=db)
+        if estimate is not None:
+            return estimate
+    return await crud_task.count_tasks_by_counters(db=db, status_list=status_list, type=type)
+
+
+def _decode_task_cursor(cursor: str) -> Tuple[datetime, str]:
+    created_at, task_id = decode_cursor(cursor, length=2)
+    try:
+        return datetime.fromisoformat(created_at), str(task_id)
+    except (TypeError, ValueError):
+        raise InvalidCursorError(cursor=cursor)
+
+
+@router.get(
+    ":counts",
+    response_model=ListResponse[TaskCount],
+    description="Get the number of tasks by status and type.",
+)
+async def get_task_counts(
+    db: AsyncSession = Depends(get_db_session),
+) -> ListResponse[TaskCount]:
+
+    task_counts = [
+        TaskCount(status=status, type=type, count=count) for status, type, count in await crud_task.get_task_counts(db=db)
+    ]
+    return ListResponse(data=task_counts, total=sum(task_count.count for task_count in task_counts))
+
+
+@router.get(
+    ":events",
+    response_class=StreamingResponse,
+    description="Stream the status transitions of the tasks by Server-Sent Events, of the given task ids or by filter. "
+    "The stream of task ids starts with their current status, and ends when all of them are finished.",
+)
+async def get_task_events(
+    task_id: Optional[List[str]] = Query(
+        None, description=f"Optional, only stream the tasks of the ids, at most {settings.TASK_EVENTS_MAX_TASK_IDS}"
+    ),
+    status: Optional[List[TaskStatus]] = Query(None, description="Optional, only stream the transitions to one of the status"),
+    type: Optional[TaskType] = Query(None, description="Optional, only stream the tasks of the type"),
+    hub: TaskStatusHub = Depends(get_task_status_hub),
+) -> StreamingResponse:
+
+    if task_id is not None and len(task_id) > settings.TASK_EVENTS_MAX_TASK_IDS:
+        raise TooManyValuesError(parameter="task_id", max_count=settings.TASK_EVENTS_MAX_TASK_IDS)
+    return StreamingResponse(
+        _stream_task_events(hub=hub, task_ids=task_id, status_list=status, type=type),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    return ListResponse(data=tasks, total=tasks_total)  # type: ignore
+
+
+async def _stream_task_events(
+    hub: TaskStatusHub,
+    task_ids: Optional[List[str]],
+    status_list: Optional[List[TaskStatus]],
+    type: Optional[TaskType],
+) -> AsyncIterator[str]:
+    """
+    The db session is opened by the stream itself, the session of the request is closed before the response is sent.
+    """
+    async with hub.subscribe(
+        task_ids=task_ids, status_list=status_list, type=type, buffer_size=settings.TASK_EVENTS_BUFFER_SIZE
+    ) as subscription:
+        unfinished_task_ids: Optional[Set[str]] = None
+        if task_ids is not None:
+            # the current status is read after subscribing, so a transition in the meantime is streamed anyway
+            async with get_db_session_context_manager() as db:
+                tasks = await crud_task.get_tasks_by_ids(db=db, ids=list(set(task_ids)))
+            unfinished_task_ids = set(task_ids)
+            for task in tasks:
+                event = build_task_status_event(task_id=task.id, status=task.status, type=task.type)
+                if subscription.matches(event):
+                    yield _format_server_sent_event(event)
+                if TaskStatus(task.status) in TERMINAL_STATUS_LIST:
+                    unfinished_task_ids.discard(task.id)
+            # the tasks not existing are never finished
+            unfinished_task_ids &= {task.id for task in tasks}
+
+        while unfinished_task_ids is None or unfinished_task_ids:
+            received = await subscription.get(timeout=settings.TASK_EVENTS_HEARTBEAT_SECONDS)
+            if received is None:
+                yield ": keep-alive\n\n"
+                continue
+            event_id, event = received
+            yield _format_server_sent_event(event, event_id=event_id)
+            if unfinished_task_ids is not None and TaskStatus(event["status"]) in TERMINAL_STATUS_LIST:
+                unfinished_task_ids.discard(event["task_id"])
+
+
+def _format_server_sent_event(event: TaskStatusEvent, event_id: Optional[str] = None) -> str:
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += ["event: status", f"data: {json.dumps(event, separators=(',', ':'))}"]
+    return "\n".join(lines) + "\n\n"
+
+
+async def _publish_status_events(redis: Union[redis.Redis, redis.RedisCluster], events: List[TaskStatusEvent]):
+    if not settings.TASK_STATUS_EVENTS_ENABLED:
+        return
+    try:
+        await publish_task_status_events(redis=redis, events=events)
+    except Exception as e:
+        logger.error(f"Failed to publish {len(events)} task status event(s), error: {e}")
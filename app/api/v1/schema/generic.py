@@ -29,3 +29,11 @@ class ListResponse(GenericModel, Generic[T]):
 
     total: Optional[int] = Field(None, title="total", description="The total count of entries.", examples=[0])
     data: List[T] = Field(..., title="data", description="The entry list.")
+
+
+class CursorListResponse(ListResponse[T], Generic[T]):
+    """ListResponse schema of the cursor pagination"""
+
+    next_cursor: Optional[str] = Field(
+        None, title="next_cursor", description="The cursor of the next page, null if this is the last page.", examples=[None]
+    )
@@ -1,11 +1,12 @@
 """The schemas of task are defined in here."""
 
 from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, root_validator
 
-from app.enum.task import TaskStatus, TaskType
+from app.core.config import settings
+from app.enum.task import TaskPriority, TaskStatus, TaskType
 
 
 class BaseTask(BaseModel):
@@ -86,4 +87,98 @@ class UpdateTask(BaseModel):
 class CreateTask(BaseTask):
     """Create Task schema."""
 
-    pass
+    priority: TaskPriority = Field(
+        TaskPriority.NORMAL,
+        title="priority",
+        description="The priority of task, the tasks of higher priority are read more often by the workers",
+        examples=[TaskPriority.NORMAL],
+    )
+    run_at: Optional[datetime] = Field(
+        None,
+        title="run_at",
+        description="Optional, the time to run the task, UTC if it has no timezone. Cannot be set with delay_seconds.",
+        examples=["2020-06-09 10:25:47.116777"],
+    )
+    delay_seconds: Optional[float] = Field(
+        None,
+        title="delay_seconds",
+        description="Optional, run the task after the seconds. Cannot be set with run_at.",
+        examples=[60],
+        ge=0,
+    )
+
+    @root_validator(skip_on_failure=True)
+    def check_run_at_or_delay_seconds(cls, values: Dict[str, Any]) -> Dict[str, Any]:
+        if values.get("run_at") is not None and values.get("delay_seconds") is not None:
+            raise ValueError("only one of run_at and delay_seconds can be set")
+        return values
+
+
+class CreateTasks(BaseModel):
+    """Create Tasks in batch schema."""
+
+    tasks: List[CreateTask] = Field(
+        ...,
+        title="tasks",
+        description=f"The tasks to create, at most {settings.TASK_BATCH_MAX_SIZE} tasks.",
+        min_items=1,
+        max_items=settings.TASK_BATCH_MAX_SIZE,
+    )
+
+
+class CancelTasks(BaseModel):
+    """Cancel Tasks in batch schema, the tasks matching all the given conditions are cancelled."""
+
+    ids: Optional[List[str]] = Field(
+        None,
+        title="ids",
+        description=f"Optional, the ids of the tasks to cancel, at most {settings.TASK_BATCH_MAX_SIZE} ids.",
+        examples=[["xxx"]],
+        max_items=settings.TASK_BATCH_MAX_SIZE,
+    )
+    type: Optional[TaskType] = Field(
+        None, title="type", description="Optional, cancel the tasks of the type.", examples=[TaskType.SLEEP]
+    )
+    status: Optional[List[TaskStatus]] = Field(
+        None,
+        title="status",
+        description="Optional, cancel the tasks in one of the status, only PENDING and PROCESSING tasks are cancelled.",
+        examples=[[TaskStatus.PENDING]],
+    )
+    created_after: Optional[datetime] = Field(
+        None,
+        title="created_after",
+        description="Optional, cancel the tasks created at or after the UTC time.",
+        examples=["2020-06-09 10:25:47.116777"],
+    )
+    created_before: Optional[datetime] = Field(
+        None,
+        title="created_before",
+        description="Optional, cancel the tasks created before the UTC time.",
+        examples=["2020-06-09 10:25:47.116777"],
+    )
+
+    @root_validator(skip_on_failure=True)
+    def check_any_condition(cls, values: Dict[str, Any]) -> Dict[str, Any]:
+        if all(value is None for value in values.values()):
+            raise ValueError("at least one of ids, type, status, created_after and created_before should be set")
+        return values
+
+
+class CancelTasksResult(BaseModel):
+    """The result of Cancel Tasks in batch."""
+
+    cancelled_ids: List[str] = Field(..., title="cancelled_ids", description="The ids of the cancelled tasks.")
+    not_cancellable_ids: List[str] = Field(
+        ...,
+        title="not_cancellable_ids",
+        description="The requested ids not cancelled, the tasks are finished or do not exist.",
+    )
+
+
+class TaskCount(BaseModel):
+    """The number of tasks in a status of a type."""
+
+    status: TaskStatus = Field(..., title="status", description="The status of the tasks", examples=[TaskStatus.PENDING])
+    type: TaskType = Field(..., title="type", description="The type of the tasks", examples=[TaskType.SLEEP])
+    count: int = Field(..., title="count", description="The number of the tasks", examples=[0])
@@ -1 +1,40 @@
-TASK_QUEUE_NAME = "task_processing_system:task_queue"
+from app.enum.task import TaskPriority
+
+# the priority streams share the hash tag in braces, so a redis cluster keeps them in one slot and a consumer can read
+# them by one XREADGROUP
+TASK_QUEUE_NAME = "{task_processing_system:task_queue}"
+TASK_PRIORITY_QUEUE_NAMES = {
+    TaskPriority.HIGH: f"{TASK_QUEUE_NAME}:high",
+    TaskPriority.NORMAL: TASK_QUEUE_NAME,
+    TaskPriority.LOW: f"{TASK_QUEUE_NAME}:low",
+}
+# the task types not routed by TASK_TYPE_ROUTES are published to the streams of the default route above, the streams of
+# the other routes have their own hash tags
+DEFAULT_TASK_ROUTE = "default"
+TASK_ROUTE_QUEUE_NAME_TEMPLATE = "{{task_processing_system:task_queue:{route}}}"
+# the delayed messages of a route are kept in the sorted set named by its normal priority stream and this suffix
+TASK_DELAYED_QUEUE_NAME_SUFFIX = ":delayed"
+# the ids of cancelled tasks are broadcast to all workers by this stream, it is read without a consumer group
+TASK_CANCEL_STREAM_NAME = "task_processing_system:task_cancel"
+TASK_CANCEL_STREAM_MAX_LENGTH = 10000
+# the messages failed too many times are moved to this stream with their errors, it is read by the operators
+TASK_DEAD_LETTER_STREAM_NAME = "task_processing_system:task_dead_letter"
+TASK_DEAD_LETTER_STREAM_MAX_LENGTH = 100000
+
+# the committed status transitions of the tasks are published to this stream, it is read without a consumer group by
+# the status hub of every api process, see app/utils/task/status_events.py
+TASK_STATUS_STREAM_NAME = "task_processing_system:task_status"
+TASK_STATUS_STREAM_MAX_LENGTH = 100000
+
+# the redis hash caching a task, see app/utils/task/status_cache.py
+TASK_CACHE_KEY_TEMPLATE = "task_processing_system:task:{task_id}"
+
+# the version of self-describing task messages, the messages without version only have the task_id
+TASK_MESSAGE_VERSION = "2"
+# the serialized parameters longer than this are not put in the message, the worker reads them from the db instead
+TASK_MESSAGE_PARAMETERS_MAX_LENGTH = 4096
+# the field of a retried message counting the previous attempts, a message without it is the first attempt
+TASK_MESSAGE_ATTEMPT_FIELD = "attempt"
+
+# the parameter of a task to override the deadline in seconds of its handler
+TASK_TIMEOUT_PARAMETER_NAME = "timeout_seconds"
@@ -52,6 +52,78 @@ class Settings(BaseSettings):
     REDIS_PORT: int = 6379
     IS_REDIS_CLUSTER: bool = False
 
+    # task
+    # put the type and parameters in the stream message, so the worker does not read the task from the db
+    TASK_MESSAGE_SELF_DESCRIBING: bool = True
+    # route the task types to their own streams, e.g. {"SLEEP": "slow"}, the other types share the default streams
+    TASK_TYPE_ROUTES: Dict[str, str] = {}
+    # cache the tasks in redis for polling their status, see app/utils/task/status_cache.py
+    TASK_STATUS_CACHE_ENABLED: bool = True
+    TASK_STATUS_CACHE_TTL_SECONDS: int = 3600
+    TASK_STATUS_CACHE_ACTIVE_TTL_SECONDS: int = 60
+    # publish the status transitions to TASK_STATUS_STREAM_NAME, streamed by GET /api/v1/tasks:events
+    TASK_STATUS_EVENTS_ENABLED: bool = True
+    # the max number of task ids streamed by one request, and the seconds between the keep-alive comments of a stream
+    TASK_EVENTS_MAX_TASK_IDS: int = 1000
+    TASK_EVENTS_HEARTBEAT_SECONDS: float = 15
+    # the max number of events buffered for a slow client, the oldest ones are dropped beyond it
+    TASK_EVENTS_BUFFER_SIZE: int = 1000
+    # the max seconds a request waits for the task to be finished, see the wait parameter of the task endpoints
+    TASK_WAIT_MAX_SECONDS: float = 60
+    # write the task messages to the outbox table in the transaction of the tasks, they are published by the outbox
+    # relay of the api processes, so creating a task does not depend on redis, see app/utils/task/outbox.py
+    TASK_OUTBOX_ENABLED: bool = False
+    # the relay drains the outbox when a task is created by its process, or every interval for the other entries
+    TASK_OUTBOX_RELAY_INTERVAL_SECONDS: float = 1
+    TASK_OUTBOX_RELAY_BATCH_SIZE: int = 500
+    # the max number of tasks created by one batch request
+    TASK_BATCH_MAX_SIZE: int = 1000
+    # the max number of tasks listed by one page
+    TASK_LIST_MAX_LIMIT: int = 1000
+    # how the total of a task listing is got by default, COUNTED, ESTIMATED, EXACT or NONE, see TaskTotalMode
+    TASK_LIST_TOTAL_MODE: str = "COUNTED"
+
+    # worker
+    WORKER_MAX_IN_FLIGHT: int = 10
+    # the task types handled by a worker, all types if it is empty, every route of them is consumed by its own consumer
+    # with its own concurrency, e.g. {"slow": 2}, WORKER_MAX_IN_FLIGHT by default
+    WORKER_TASK_TYPES: List[str] = []
+    WORKER_ROUTE_MAX_IN_FLIGHT: Dict[str, int] = {}
+    WORKER_MAX_READ_COUNT: int = 100
+    # the read weights of the priority streams, every priority is read at least once per sum(weights) messages
+    WORKER_QUEUE_WEIGHTS: Dict[str, int] = {"HIGH": 6, "NORMAL": 3, "LOW": 1}
+    WORKER_RECLAIM_INTERVAL_SECONDS: float = 5
+    WORKER_RECLAIM_BATCH_SIZE: int = 100
+    WORKER_ACK_BATCH_SIZE: int = 100
+    WORKER_ACK_FLUSH_INTERVAL_SECONDS: float = 0.005
+    # a pending message idled longer than the min idle time is reclaimed by other consumers, e.g. {"SLEEP": 60000}
+    # overrides it for the long tasks, the leases of in-flight messages are extended every lease interval
+    WORKER_MIN_IDLE_TIME_MS: int = 10 * 1000
+    WORKER_TASK_MIN_IDLE_TIME_MS: Dict[str, int] = {}
+    WORKER_LEASE_INTERVAL_SECONDS: float = 3
+    # the due delayed tasks are published to their streams every promote interval, in batches
+    WORKER_PROMOTE_INTERVAL_SECONDS: float = 0.5
+    WORKER_PROMOTE_BATCH_SIZE: int = 1000
+    WORKER_TRIM_INTERVAL_SECONDS: float = 60
+    # write the terminal task status by batches, see app/worker/task_status_writer.py
+    WORKER_STATUS_WRITE_BEHIND: bool = False
+    WORKER_STATUS_FLUSH_INTERVAL_SECONDS: float = 0.05
+    WORKER_STATUS_FLUSH_SIZE: int = 200
+    # the deadline in seconds of each task type, e.g. {"SLEEP": 60}, a task can override it by its parameters
+    WORKER_TASK_TIMEOUT_SECONDS: Dict[str, float] = {}
+    # the retries of each failed task type, e.g. {"SLEEP": 3}, by an exponential backoff from the base delay to the max
+    WORKER_TASK_MAX_RETRIES: Dict[str, int] = {}
+    WORKER_RETRY_BASE_DELAY_SECONDS: float = 1
+    WORKER_RETRY_MAX_DELAY_SECONDS: float = 300
+    # a reclaimed message delivered more times is moved to the dead-letter stream without processing
+    WORKER_MAX_DELIVERY_COUNT: int = 5
+    # the process pool of the CPU-bound handlers, see app/worker/process_pool.py, None means the number of CPUs
+    WORKER_PROCESS_POOL_SIZE: Optional[int] = None
+    WORKER_PROCESS_POOL_MAX_TASKS_PER_CHILD: int = 1000
+    WORKER_PROCESSES: int = 1
+    WORKER_REPORT_INTERVAL_SECONDS: float = 30
+    WORKER_DRAIN_TIMEOUT_SECONDS: float = 60
+
     class Config:  # type: ignore
         case_sensitive = True
         env_file = ".env"
@@ -1,15 +1,15 @@
 """db operation for task"""
 
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
-from sqlalchemy import func, select, update
+from sqlalchemy import DateTime, Integer, Text, cast, column, func, insert, select, text, tuple_, update, values
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database.models.task import Task
+from app.database.models.task_count import TaskCount
 from app.enum.task import TaskStatus, TaskType
-from app.utils.db import as_order_by_expression
 from app.utils.exceptions.db import EntryWithIDNotExist
 from app.utils.logging.logger import get_logger
 
@@ -35,6 +35,9 @@ async def create_task(
         db.add(task)
         if auto_commit:
             await db.commit()
+        else:
+            # the server defaults like id are only generated by the INSERT
+            await db.flush()
         await db.refresh(task)
         return task
     except Exception as e:
@@ -44,25 +47,62 @@ async def create_task(
         raise e
 
 
+async def create_tasks(
+    db: AsyncSession,
+    tasks: List[Dict[str, Any]],
+    auto_commit: bool = True,
+) -> List[Task]:
+    """
+    Create many tasks by one multi-row INSERT ... RETURNING, return the created tasks in the order of `tasks`.
+    Each task has type, status and parameters.
+    """
+    if not tasks:
+        return []
+
+    query = insert(Task).returning(Task, sort_by_parameter_order=True)
+    try:
+        created_tasks = list((await db.execute(query, tasks)).scalars().all())
+        if auto_commit:
+            await db.commit()
+        return created_tasks
+    except Exception as e:
+        if auto_commit:
+            await db.rollback()
+        logger.error(f"Failed to create {len(tasks)} tasks: {e}")
+        raise e
+
+
 async def list_tasks(
     db: AsyncSession,
-    offset: int = 0,
-    limit: int = 0,
-    order_by: str = "created_at:desc",
+    limit: int,
+    after: Optional[Tuple[datetime, str]] = None,
+    descending: bool = True,
     status_list: Optional[List[TaskStatus]] = None,
+    type: Optional[TaskType] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
 ) -> List[Task]:
     """
-    Get tasks by conditions
+    Get at most `limit` tasks by conditions ordered by (created_at, id), the page starts after the key `after`.
+    The keyset pagination reads the same number of rows however deep the page is, see the indexes of Task.
     """
     query = select(Task)
     if status_list is not None:
         query = query.where(Task.status.in_(status_list))
-    if offset:
-        query = query.offset(offset)
-    if limit:
-        query = query.limit(limit)
-    for expression in as_order_by_expression(Task, order_by):
-        query = query.order_by(expression)
+    if type is not None:
+        query = query.where(Task.type == type)
+    if created_after is not None:
+        query = query.where(Task.created_at >= created_after)
+    if created_before is not None:
+        query = query.where(Task.created_at < created_before)
+    sort_key = tuple_(Task.created_at, Task.id)
+    if after is not None:
+        query = query.where(sort_key < tuple_(*after) if descending else sort_key > tuple_(*after))
+    if descending:
+        query = query.order_by(Task.created_at.desc(), Task.id.desc())
+    else:
+        query = query.order_by(Task.created_at.asc(), Task.id.asc())
+    query = query.limit(limit)
 
     result = await db.execute(query)
     return list(result.scalars().all())
@@ -79,20 +119,107 @@ async def get_task(db: AsyncSession, id: str) -> Task:
     return result.scalars().one()
 
 
+async def get_tasks_by_ids(db: AsyncSession, ids: List[str]) -> List[Task]:
+    """
+    Get the existing tasks of the ids
+    """
+    if not ids:
+        return []
+    query = select(Task).where(Task.id.in_(ids))
+    result = await db.execute(query)
+    return list(result.scalars().all())
+
+
 async def count_tasks(
     db: AsyncSession,
     status_list: Optional[List[TaskStatus]] = None,
+    type: Optional[TaskType] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
 ) -> int:
     """
-    Get tasks by conditions
+    Count tasks by conditions
     """
     query = select(func.count()).select_from(Task)
     if status_list is not None:
         query = query.where(Task.status.in_(status_list))
+    if type is not None:
+        query = query.where(Task.type == type)
+    if created_after is not None:
+        query = query.where(Task.created_at >= created_after)
+    if created_before is not None:
+        query = query.where(Task.created_at < created_before)
     result = await db.execute(query)
     return result.scalars().one()
 
 
+async def count_tasks_by_counters(
+    db: AsyncSession,
+    status_list: Optional[List[TaskStatus]] = None,
+    type: Optional[TaskType] = None,
+) -> int:
+    """
+    Count tasks by conditions from the counts maintained by the triggers, it reads the shards of the counts only
+    """
+    query = select(func.coalesce(func.sum(TaskCount.count), 0))
+    if status_list is not None:
+        query = query.where(TaskCount.status.in_(status_list))
+    if type is not None:
+        query = query.where(TaskCount.type == type)
+    result = await db.execute(query)
+    return int(result.scalars().one())
+
+
+async def get_task_counts(db: AsyncSession) -> List[Tuple[TaskStatus, TaskType, int]]:
+    """
+    Get the number of tasks by status and type from the counts maintained by the triggers
+    """
+    total = func.sum(TaskCount.count)
+    query = (
+        select(TaskCount.status, TaskCount.type, total)
+        .group_by(TaskCount.status, TaskCount.type)
+        .having(total != 0)
+        .order_by(TaskCount.status, TaskCount.type)
+    )
+    result = await db.execute(query)
+    return [(TaskStatus(status), TaskType(type), int(count)) for status, type, count in result.all()]
+
+
+async def estimate_task_count(db: AsyncSession) -> Optional[int]:
+    """
+    Get the number of tasks estimated by the planner, updated by VACUUM, ANALYZE and autovacuum.
+    Return None if the table is never analyzed.
+    """
+    query = text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table_name AS regclass)")
+    result = await db.execute(query, {"table_name": Task.__tablename__})
+    estimate = result.scalars().one()
+    return int(estimate) if estimate >= 0 else None
+
+
+async def claim_task(
+    db: AsyncSession,
+    task_id: str,
+    started_at: datetime,
+    auto_commit: bool = True,
+) -> Optional[Task]:
+    """
+    Move the task from PENDING to PROCESSING in one conditional update, return None if the task is not PENDING
+    """
+    query = (
+        update(Task)
+        .values(status=TaskStatus.PROCESSING, started_at=started_at)
+        .where(Task.id == task_id, Task.status == TaskStatus.PENDING)
+        .returning(Task)
+    )
+    task = (await db.execute(query)).scalars().one_or_none()
+    if auto_commit:
+        if task is None:
+            await db.rollback()
+        else:
+            await db.commit()
+    return task
+
+
 async def update_task(
     db: AsyncSession,
     task_id: str,
@@ -102,10 +229,11 @@ async def update_task(
     error_code: Optional[int] = None,
     started_at: Optional[datetime] = None,
     ended_at: Optional[datetime] = None,
+    current_status_list: Optional[List[TaskStatus]] = None,
     auto_commit: bool = True,
 ) -> Task:
     """
-    Update the task by id
+    Update the task by id, if current_status_list is given, only update the task in one of these status
     """
     data = {}
     if result is not None:
@@ -121,7 +249,10 @@ async def update_task(
     if ended_at is not None:
         data["ended_at"] = ended_at
 
-    query = update(Task).values(**data).where(Task.id == task_id).returning(Task)
+    query = update(Task).values(**data).where(Task.id == task_id)
+    if current_status_list is not None:
+        query = query.where(Task.status.in_(current_status_list))
+    query = query.returning(Task)
     try:
         task = (await db.execute(query)).scalars().one()
         if auto_commit:
@@ -131,3 +262,106 @@ async def update_task(
         if auto_commit:
             await db.rollback()
         raise EntryWithIDNotExist(entry_name=Task.__tablename__, id=task_id)
+
+
+async def cancel_tasks(
+    db: AsyncSession,
+    cancellable_status_list: List[TaskStatus],
+    ids: Optional[List[str]] = None,
+    type: Optional[TaskType] = None,
+    status_list: Optional[List[TaskStatus]] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+    auto_commit: bool = True,
+) -> List[str]:
+    """
+    Cancel the tasks matching all the given conditions by one conditional UPDATE ... RETURNING id, only the tasks in
+    one of cancellable_status_list are cancelled. Return the ids of the cancelled tasks.
+    """
+    query = (
+        update(Task)
+        .values(status=TaskStatus.CANCELED)
+        .where(Task.status.in_(cancellable_status_list))
+        .returning(Task.id)
+        .execution_options(synchronize_session=False)
+    )
+    if ids is not None:
+        query = query.where(Task.id.in_(ids))
+    if type is not None:
+        query = query.where(Task.type == type)
+    if status_list is not None:
+        query = query.where(Task.status.in_(status_list))
+    if created_after is not None:
+        query = query.where(Task.created_at >= created_after)
+    if created_before is not None:
+        query = query.where(Task.created_at < created_before)
+    try:
+        cancelled_ids = list((await db.execute(query)).scalars().all())
+        if auto_commit:
+            await db.commit()
+        return cancelled_ids
+    except Exception as e:
+        if auto_commit:
+            await db.rollback()
+        logger.error(f"Failed to cancel tasks: {e}")
+        raise e
+
+
+async def bulk_update_tasks(
+    db: AsyncSession,
+    updates: List[Dict[str, Any]],
+    current_status_list: Optional[List[TaskStatus]] = None,
+    auto_commit: bool = True,
+) -> List[str]:
+    """
+    Update many tasks by one UPDATE task ... FROM (VALUES ...) statement, return the ids of the updated tasks.
+    Each update has id, status, ended_at, error_message and error_code, a None error field keeps the current value.
+    If current_status_list is given, only update the tasks in one of these status.
+    """
+    if not updates:
+        return []
+
+    task_updates = values(
+        column("id", Text),
+        column("status", Text),
+        column("ended_at", DateTime),
+        column("error_message", Text),
+        column("error_code", Integer),
+        name="task_update",
+    ).data(
+        [
+            (
+                data["id"],
+                TaskStatus(data["status"]).value,
+                data["ended_at"],
+                data.get("error_message"),
+                data.get("error_code"),
+            )
+            for data in updates
+        ]
+    )
+    query = (
+        update(Task)
+        .where(Task.id == task_updates.c.id)
+        .values(
+            status=task_updates.c.status,
+            ended_at=task_updates.c.ended_at,
+            # the NULLs in VALUES are rendered untyped, cast them to match the columns
+            error_message=func.coalesce(cast(task_updates.c.error_message, Text), Task.error_message),
+            error_code=func.coalesce(cast(task_updates.c.error_code, Integer), Task.error_code),
+        )
+        .returning(Task.id)
+        .execution_options(synchronize_session=False)
+    )
+    if current_status_list is not None:
+        query = query.where(Task.status.in_(current_status_list))
+    try:
+        updated_ids = list((await db.execute(query)).scalars().all())
+        if auto_commit:
+            await db.commit()
+        return updated_ids
+    except Exception as e:
+        if auto_commit:
+            await db.rollback()
+        logger.error(f"Failed to update {len(updates)} tasks: {e}")
+        raise e
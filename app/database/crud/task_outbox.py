@@ -0,0 +1,52 @@
+"""db operation for task outbox"""
+
+from typing import Any, Dict, List
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.models.task_outbox import TaskOutbox
+from app.utils.logging.logger import get_logger
+
+logger = get_logger()
+
+
+async def create_outbox_entries(
+    db: AsyncSession,
+    entries: List[Dict[str, Any]],
+    auto_commit: bool = True,
+):
+    """
+    Create the outbox entries by one multi-row INSERT, in the transaction of the tasks if auto_commit is False.
+    Each entry has task_id, queue_name, message, and optional delayed_queue_name and run_at.
+    """
+    if not entries:
+        return
+    try:
+        await db.execute(insert(TaskOutbox), entries)
+        if auto_commit:
+            await db.commit()
+    except Exception as e:
+        if auto_commit:
+            await db.rollback()
+        logger.error(f"Failed to create {len(entries)} outbox entries: {e}")
+        raise e
+
+
+async def take_outbox_entries(db: AsyncSession, limit: int) -> List[TaskOutbox]:
+    """
+    Delete at most `limit` oldest outbox entries and return them ordered by id, the caller commits after publishing them.
+    The entries taken by other uncommitted transactions are skipped, so the relays of many processes never take the
+    same entry, and a rollback puts the entries back.
+    """
+    oldest_entry_ids = (
+        select(TaskOutbox.id).order_by(TaskOutbox.id).limit(limit).with_for_update(skip_locked=True).scalar_subquery()
+    )
+    query = (
+        delete(TaskOutbox)
+        .where(TaskOutbox.id.in_(oldest_entry_ids))
+        .returning(TaskOutbox)
+        .execution_options(synchronize_session=False)
+    )
+    entries = list((await db.execute(query)).scalars().all())
+    return sorted(entries, key=lambda entry: entry.id)
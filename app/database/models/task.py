@@ -1,7 +1,7 @@
 from datetime import datetime
 from typing import Any, Dict, Optional
 
-from sqlalchemy import DateTime, Integer, Text, func, text
+from sqlalchemy import DateTime, Index, Integer, Text, func, text
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column
 
@@ -15,9 +15,15 @@ class Task(Base):
     """
 
     __tablename__ = "task"
+    # the keyset pagination orders by (created_at, id), optionally filtered by status or type
+    __table_args__ = (
+        Index("ix_task_created_at_id", "created_at", "id"),
+        Index("ix_task_status_created_at_id", "status", "created_at", "id"),
+        Index("ix_task_type_created_at_id", "type", "created_at", "id"),
+    )
 
     id: Mapped[str] = mapped_column("id", Text, primary_key=True, server_default=text("uuid_generate_v4()"))
-    type: Mapped[TaskType] = mapped_column("type", Text, comment="Task type", index=True)
+    type: Mapped[TaskType] = mapped_column("type", Text, comment="Task type")
     result: Mapped[Optional[Dict[str, Any]]] = mapped_column(
         "result", JSONB, comment="Result of the task execution", nullable=True
     )
@@ -32,7 +38,6 @@ class Task(Base):
         nullable=False,
         comment="The task status",
         server_default=text(f"'{TaskStatus.PENDING}'"),
-        index=True,
     )
     created_at: Mapped[datetime] = mapped_column(
         "created_at",
@@ -40,7 +45,6 @@ class Task(Base):
         comment="The time when the task was created",
         nullable=False,
         server_default=func.now(),
-        index=True,
     )
     updated_at: Mapped[datetime] = mapped_column(
         "updated_at",
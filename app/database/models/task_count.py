@@ -0,0 +1,24 @@
+from sqlalchemy import BigInteger, Integer, Text, text
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.database.models.base import Base
+from app.enum.task import TaskStatus, TaskType
+
+
+class TaskCount(Base):
+    """
+    ORM class for TaskCount, the number of tasks by status and type.
+
+    The rows are maintained by the triggers of the task table, see the migration 7c4e1a9b3d2f. The count of a status
+    and type is split into shards, a trigger adds to a random shard, so the concurrent writers rarely wait for the
+    same row, and the count is the sum of the shards.
+    """
+
+    __tablename__ = "task_count"
+
+    status: Mapped[TaskStatus] = mapped_column("status", Text, primary_key=True, comment="The task status")
+    type: Mapped[TaskType] = mapped_column("type", Text, primary_key=True, comment="Task type")
+    shard: Mapped[int] = mapped_column("shard", Integer, primary_key=True, comment="The shard of the count")
+    count: Mapped[int] = mapped_column(
+        "count", BigInteger, nullable=False, comment="The number of tasks added to the shard", server_default=text("0")
+    )
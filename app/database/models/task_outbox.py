@@ -0,0 +1,38 @@
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import BigInteger, DateTime, Identity, Text, func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.database.models.base import Base
+
+
+class TaskOutbox(Base):
+    """
+    ORM class for TaskOutbox, the task messages to publish, written in the transaction creating the tasks.
+
+    The entries are published and deleted by the outbox relay, see app/utils/task/outbox.py.
+    """
+
+    __tablename__ = "task_outbox"
+
+    id: Mapped[int] = mapped_column("id", BigInteger, Identity(), primary_key=True)
+    task_id: Mapped[str] = mapped_column("task_id", Text, nullable=False, comment="The id of the task of the message")
+    queue_name: Mapped[str] = mapped_column(
+        "queue_name", Text, nullable=False, comment="The stream the message is published to"
+    )
+    message: Mapped[Dict[str, str]] = mapped_column("message", JSONB, nullable=False, comment="The fields of the message")
+    delayed_queue_name: Mapped[Optional[str]] = mapped_column(
+        "delayed_queue_name", Text, nullable=True, comment="The sorted set keeping the message until run_at"
+    )
+    run_at: Mapped[Optional[datetime]] = mapped_column(
+        "run_at", DateTime, nullable=True, comment="The UTC time to publish the message, null means immediately"
+    )
+    created_at: Mapped[datetime] = mapped_column(
+        "created_at",
+        DateTime,
+        comment="The time when the entry was created",
+        nullable=False,
+        server_default=func.now(),
+    )
@@ -11,7 +11,28 @@ class TaskStatus(str, Enum):
     FAILED = "FAILED"
 
 
+class TaskPriority(str, Enum):
+    """The priority of a task decides the stream it is published to, see TASK_PRIORITY_QUEUE_NAMES."""
+
+    HIGH = "HIGH"
+    NORMAL = "NORMAL"
+    LOW = "LOW"
+
+
 class TaskType(str, Enum):
     """ """
 
     SLEEP = "SLEEP"
+
+
+class TaskTotalMode(str, Enum):
+    """How the total of a task listing is got, see get_tasks."""
+
+    # the counts maintained by the triggers by status and type, a created_at range is counted by the index
+    COUNTED = "COUNTED"
+    # the planner estimate of the table size without filters, the counts otherwise
+    ESTIMATED = "ESTIMATED"
+    # count(*) the matched tasks
+    EXACT = "EXACT"
+    # no total
+    NONE = "NONE"
@@ -9,8 +9,10 @@ from app.api import health
 from app.api.v1.api import api_router
 from app.core.config import settings
 from app.database.init_db import init_db
+from app.middleware.depends import get_task_status_hub
 from app.utils.logging.logger import get_logger
 from app.utils.middleware.app_version import AppVersionMiddleware
+from app.utils.task.outbox import get_task_outbox_relay
 
 DEFAULT_ERROR_CODE = 1
 DEFAULT_RESPONSE_HEADER = {"Access-Control-Allow-Origin": "*"}
@@ -45,8 +47,12 @@ def get_application() -> FastAPI:
 async def lifespan(app: FastAPI):
     if settings.DO_INIT_DB:
         await init_db(app)
+    if settings.TASK_OUTBOX_ENABLED:
+        get_task_outbox_relay().start()
     logger.info("local swagger url: http://0.0.0.0:8000/docs")
     yield
+    await get_task_outbox_relay().stop()
+    await get_task_status_hub().close()
 
 
 logger = get_logger()
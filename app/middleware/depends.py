@@ -9,6 +9,7 @@ from app.core.config import settings
 from app.database.db import session_factory
 from app.utils.logging.logger import get_logger
 from app.utils.redis import setup_redis_connection
+from app.utils.task.status_events import TaskStatusHub
 
 DEFAULT_HOST = "127.0.0.1"
 DEFAULT_PORT = 6379
@@ -49,3 +50,11 @@ global_redis_session = setup_redis_connection(
     is_cluster=settings.IS_REDIS_CLUSTER,
     retry_on_error=[ConnectionError, TimeoutError],
 )
+
+
+def get_task_status_hub() -> TaskStatusHub:
+    """Get the status hub shared by the requests of this process."""
+    return global_task_status_hub
+
+
+global_task_status_hub = TaskStatusHub(global_redis_session)
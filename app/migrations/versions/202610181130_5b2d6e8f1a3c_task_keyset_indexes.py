@@ -0,0 +1,47 @@
+"""task keyset indexes
+
+Revision ID: 5b2d6e8f1a3c
+Revises: 9e5379dac196
+Create Date: 2026-10-18 11:30:12.403511
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5b2d6e8f1a3c"
+down_revision = "9e5379dac196"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the indexes are built without locking the writes of the task table, which cannot run in a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_task_created_at_id", "task", ["created_at", "id"], unique=False, postgresql_concurrently=True
+        )
+        op.create_index(
+            "ix_task_status_created_at_id",
+            "task",
+            ["status", "created_at", "id"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_task_type_created_at_id", "task", ["type", "created_at", "id"], unique=False, postgresql_concurrently=True
+        )
+        # the single column indexes are the prefixes of the composite ones
+        op.drop_index("ix_task_type", table_name="task", postgresql_concurrently=True)
+        op.drop_index("ix_task_status", table_name="task", postgresql_concurrently=True)
+        op.drop_index("ix_task_created_at", table_name="task", postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index("ix_task_created_at", "task", ["created_at"], unique=False, postgresql_concurrently=True)
+        op.create_index("ix_task_status", "task", ["status"], unique=False, postgresql_concurrently=True)
+        op.create_index("ix_task_type", "task", ["type"], unique=False, postgresql_concurrently=True)
+        op.drop_index("ix_task_type_created_at_id", table_name="task", postgresql_concurrently=True)
+        op.drop_index("ix_task_status_created_at_id", table_name="task", postgresql_concurrently=True)
+        op.drop_index("ix_task_created_at_id", table_name="task", postgresql_concurrently=True)
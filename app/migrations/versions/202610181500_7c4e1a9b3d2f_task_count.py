@@ -0,0 +1,103 @@
+"""task count
+
+Revision ID: 7c4e1a9b3d2f
+Revises: 5b2d6e8f1a3c
+Create Date: 2026-10-18 15:00:41.218730
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7c4e1a9b3d2f"
+down_revision = "5b2d6e8f1a3c"
+branch_labels = None
+depends_on = None
+
+# the number of shards of a count, the concurrent writers of the same status and type add to different rows
+TASK_COUNT_SHARDS = 16
+
+
+def upgrade():
+    op.create_table(
+        "task_count",
+        sa.Column("status", sa.Text(), nullable=False, comment="The task status"),
+        sa.Column("type", sa.Text(), nullable=False, comment="Task type"),
+        sa.Column("shard", sa.Integer(), nullable=False, comment="The shard of the count"),
+        sa.Column(
+            "count",
+            sa.BigInteger(),
+            server_default=sa.text("0"),
+            nullable=False,
+            comment="The number of tasks added to the shard",
+        ),
+        sa.PrimaryKeyConstraint("status", "type", "shard"),
+    )
+    # the triggers run once per statement on the transition tables, so a multi-row insert or update adds to each
+    # status and type once, and an update keeping the status is counted -1 and +1 which is dropped
+    op.execute(
+        f"""
+        CREATE FUNCTION task_count_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO task_count (status, type, shard, count)
+                SELECT status, type, floor(random() * {TASK_COUNT_SHARDS})::int, count(*)
+                FROM new_rows GROUP BY status, type
+                ON CONFLICT (status, type, shard) DO UPDATE SET count = task_count.count + EXCLUDED.count;
+            ELSIF TG_OP = 'UPDATE' THEN
+                INSERT INTO task_count (status, type, shard, count)
+                SELECT status, type, floor(random() * {TASK_COUNT_SHARDS})::int, sum(delta)
+                FROM (
+                    SELECT status, type, -1 AS delta FROM old_rows
+                    UNION ALL
+                    SELECT status, type, 1 AS delta FROM new_rows
+                ) AS changes
+                GROUP BY status, type HAVING sum(delta) <> 0
+                ON CONFLICT (status, type, shard) DO UPDATE SET count = task_count.count + EXCLUDED.count;
+            ELSE
+                INSERT INTO task_count (status, type, shard, count)
+                SELECT status, type, floor(random() * {TASK_COUNT_SHARDS})::int, -count(*)
+                FROM old_rows GROUP BY status, type
+                ON CONFLICT (status, type, shard) DO UPDATE SET count = task_count.count + EXCLUDED.count;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    # the writes of the task table wait until the counts are filled and the triggers are created by this transaction,
+    # so no task is counted twice or missed
+    op.execute("LOCK TABLE task IN SHARE ROW EXCLUSIVE MODE")
+    op.execute(
+        """
+        CREATE TRIGGER task_count_on_insert AFTER INSERT ON task
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION task_count_changed()
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER task_count_on_update AFTER UPDATE ON task
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION task_count_changed()
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER task_count_on_delete AFTER DELETE ON task
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION task_count_changed()
+        """
+    )
+    op.execute(
+        "INSERT INTO task_count (status, type, shard, count) SELECT status, type, 0, count(*) FROM task GROUP BY status, type"
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER task_count_on_delete ON task")
+    op.execute("DROP TRIGGER task_count_on_update ON task")
+    op.execute("DROP TRIGGER task_count_on_insert ON task")
+    op.execute("DROP FUNCTION task_count_changed()")
+    op.drop_table("task_count")
@@ -1,5 +1,9 @@
-from typing import List, Type
+import base64
+import binascii
+import json
+from typing import Any, List, Type
 
+from app.utils.exceptions.data_validation import InvalidCursorError
 from app.utils.exceptions.db import InvalidOrderDirection, OrderColumnNotExist
 from app.utils.logging.logger import get_logger
 
@@ -32,3 +36,23 @@ def as_order_by_expression(model: Type["Base"], expression: str) -> List["UnaryE
         result.append(order_function())
 
     return result
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """Encode the sort key of the last row of a page to an opaque cursor, the values should be JSON serializable."""
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode()
+
+
+def decode_cursor(cursor: str, length: int) -> List[Any]:
+    """Decode the cursor encoded by `encode_cursor` to the `length` values of the sort key.
+
+    Raises:
+        InvalidCursorError: The cursor is not encoded by `encode_cursor`, or has another number of values.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursorError(cursor=cursor)
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursorError(cursor=cursor)
+    return values
@@ -51,7 +51,8 @@ class BaseCustomException(Exception, metaclass=CodeErrorCollector):
         self.parameters = {
             attr: getattr(self, attr)
             for attr in dir(self)
-            if not attr.startswith("_") and attr not in ("args", "with_traceback", "dict", "parse_obj", "parse_raw")
+            if not attr.startswith("_")
+            and attr not in ("args", "with_traceback", "add_note", "dict", "parse_obj", "parse_raw")
         }
         self.message = self._message.format(**self.parameters)
         self.code = self._code
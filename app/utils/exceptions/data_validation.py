@@ -102,3 +102,24 @@ class DuplicateDataError(BaseCustomException):
     _status_code = HTTPStatus.BAD_REQUEST
     _code = 30008
     _message = "The data {data} is duplicated."
+
+
+@dataclass
+class InvalidCursorError(BaseCustomException):
+    """InvalidCursorError."""
+
+    cursor: str
+    _status_code = HTTPStatus.BAD_REQUEST
+    _code = 30009
+    _message = "The cursor: {cursor} is invalid."
+
+
+@dataclass
+class TooManyValuesError(BaseCustomException):
+    """TooManyValuesError."""
+
+    parameter: str
+    max_count: int
+    _status_code = HTTPStatus.BAD_REQUEST
+    _code = 30010
+    _message = "The parameter: {parameter} has more than {max_count} values."
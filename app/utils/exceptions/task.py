@@ -31,3 +31,33 @@ class JobCannotBeCancelled(BaseCustomException):
     _status_code = HTTPStatus.INTERNAL_SERVER_ERROR
     _code = 40001
     _message = "task cannot be cancelled, current status: {current_status}, allowed status: {allowed_status}."
+
+
+@dataclass
+class TaskTimeoutError(BaseCustomException):
+    """TaskTimeoutError."""
+
+    timeout: float
+    _status_code = HTTPStatus.INTERNAL_SERVER_ERROR
+    _code = 40002
+    _message = "task execution exceeded the deadline: {timeout} seconds."
+
+
+@dataclass
+class TaskDeliveryExceeded(BaseCustomException):
+    """TaskDeliveryExceeded."""
+
+    delivery_count: int
+    max_delivery_count: int
+    _status_code = HTTPStatus.INTERNAL_SERVER_ERROR
+    _code = 40003
+    _message = "task message was delivered {delivery_count} times, exceeded the max delivery count: {max_delivery_count}."
+
+
+@dataclass
+class TaskAbandoned(BaseCustomException):
+    """TaskAbandoned."""
+
+    _status_code = HTTPStatus.INTERNAL_SERVER_ERROR
+    _code = 40004
+    _message = "task was left PROCESSING by a consumer which stopped handling it, its outcome is unknown."
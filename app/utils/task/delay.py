@@ -0,0 +1,87 @@
+"""
+Schedule the task messages to be published later.
+
+The delayed messages of a route are kept in a sorted set scored by the due time in epoch milliseconds, the promoter of
+the worker moves the due ones to their streams in batches by a Lua script, so a message is never promoted twice even if
+many workers promote the same sorted set. The sorted set shares the hash tag of the streams of its route.
+"""
+
+import json
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Union
+
+import redis
+
+# KEYS[1]: the sorted set of the delayed messages, KEYS[2..]: the streams the messages may be published to
+# ARGV[1]: now in epoch milliseconds, ARGV[2]: the max number of messages to promote
+# returns the number of promoted messages
+PROMOTE_DUE_MESSAGES_SCRIPT = """
+local entries = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #entries == 0 then
+    return 0
+end
+for _, entry in ipairs(entries) do
+    local delayed_message = cjson.decode(entry)
+    local fields = {}
+    for name, value in pairs(delayed_message['message']) do
+        table.insert(fields, name)
+        table.insert(fields, value)
+    end
+    redis.call('XADD', delayed_message['queue'], '*', unpack(fields))
+end
+-- the entries are the lowest scores of the sorted set
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #entries - 1)
+return #entries
+"""
+
+
+def to_epoch_ms(time: datetime) -> int:
+    """Convert a datetime to epoch milliseconds, a datetime without timezone is regarded as UTC."""
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return int(time.timestamp() * 1000)
+
+
+async def schedule_message(
+    redis: Union[redis.Redis, redis.RedisCluster],
+    delayed_queue_name: str,
+    queue_name: str,
+    message: Dict[str, str],
+    run_at: datetime,
+):
+    """Keep the message in the delayed queue until `run_at`, then it is published to `queue_name` by the promoter."""
+    await redis.zadd(delayed_queue_name, {build_delayed_entry(queue_name, message): to_epoch_ms(run_at)})  # type: ignore
+
+
+def build_delayed_entry(queue_name: str, message: Dict[str, str]) -> str:
+    """Build the member of the delayed queue keeping the message and its stream."""
+    return json.dumps({"queue": queue_name, "message": message}, separators=(",", ":"), sort_keys=True)
+
+
+def add_publish_commands(
+    pipeline: Any,
+    queue_name: str,
+    message: Dict[str, str],
+    delayed_queue_name: Optional[str] = None,
+    run_at: Optional[datetime] = None,
+    now: Optional[datetime] = None,
+):
+    """Add the commands publishing the message to the pipeline, or keeping it in the delayed queue if `run_at` is later
+    than `now`. The streams are not capped, the acknowledged messages are trimmed by the workers.
+    """
+    if delayed_queue_name is not None and run_at is not None and now is not None and to_epoch_ms(run_at) > to_epoch_ms(now):
+        pipeline.zadd(delayed_queue_name, {build_delayed_entry(queue_name, message): to_epoch_ms(run_at)})
+    else:
+        pipeline.xadd(queue_name, fields=message)
+
+
+async def promote_due_messages(
+    redis: Union[redis.Redis, redis.RedisCluster],
+    delayed_queue_name: str,
+    queue_names: List[str],
+    now: datetime,
+    batch_size: int,
+) -> int:
+    """Publish at most `batch_size` due messages of the delayed queue atomically, return the number of them."""
+    promote = redis.register_script(PROMOTE_DUE_MESSAGES_SCRIPT)
+    return await promote(keys=[delayed_queue_name, *queue_names], args=[to_epoch_ms(now), batch_size])  # type: ignore
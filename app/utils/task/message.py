@@ -0,0 +1,62 @@
+"""
+Build and parse the task messages in the stream.
+
+A legacy message only has `task_id`, the worker has to read the task from the DB.
+A self-describing message also carries `version`, `type` and the serialized `parameters`, so the worker can dispatch it
+without reading the DB. The parameters are left out if they are too large, the claim of the task reads them instead.
+A retried message also carries the number of the previous attempts in `attempt`.
+"""
+
+import json
+from typing import Dict, Optional
+
+from app.const.task import TASK_MESSAGE_ATTEMPT_FIELD, TASK_MESSAGE_PARAMETERS_MAX_LENGTH, TASK_MESSAGE_VERSION
+from app.database.models.task import Task
+from app.enum.task import TaskStatus, TaskType
+
+
+def build_task_message(task: Task, self_describing: bool = True) -> Dict[str, str]:
+    """Build the stream message of the task, the parameters are left out if they are too large."""
+    message = {"task_id": task.id}
+    if not self_describing:
+        return message
+
+    message.update({"version": TASK_MESSAGE_VERSION, "type": TaskType(task.type).value})
+    serialized_parameters = json.dumps(task.parameters or {}, separators=(",", ":"))
+    if len(serialized_parameters) <= TASK_MESSAGE_PARAMETERS_MAX_LENGTH:
+        message["parameters"] = serialized_parameters
+    return message
+
+
+def parse_task_message(message: Dict[str, str]) -> Optional[Task]:
+    """Build a transient PENDING task from a self-describing message, return None for a legacy message.
+
+    The parameters of the task are None if the message left them out.
+
+    Raises:
+        KeyError: The message does not have task_id, or a self-describing message misses the type.
+        ValueError: The type or parameters of a self-describing message is invalid.
+    """
+    task_id = message["task_id"]
+    if message.get("version") != TASK_MESSAGE_VERSION:
+        return None
+
+    return Task(
+        id=task_id,
+        type=TaskType(message["type"]),
+        parameters=json.loads(message["parameters"]) if "parameters" in message else None,
+        status=TaskStatus.PENDING,
+    )
+
+
+def get_message_attempt(message: Dict[str, str]) -> int:
+    """Return the number of the previous attempts of the message, 0 for a message never retried."""
+    try:
+        return int(message.get(TASK_MESSAGE_ATTEMPT_FIELD, 0))
+    except ValueError:
+        return 0
+
+
+def build_retry_message(message: Dict[str, str], attempt: int) -> Dict[str, str]:
+    """Copy the message for its retry after `attempt` previous attempts."""
+    return {**message, TASK_MESSAGE_ATTEMPT_FIELD: str(attempt)}
@@ -0,0 +1,126 @@
+"""
+Publish the task messages written to the outbox table in the transactions of the tasks.
+
+The relay takes the oldest entries by batches, publishes them by one redis pipeline and deletes them in one transaction,
+the entries are put back if publishing fails, so a task committed while redis is unreachable is published once it is
+back. A message is published at least once, if the transaction fails after publishing it is published again, a worker
+only claims a PENDING task, so the duplicate is acknowledged without running the task twice.
+"""
+
+import asyncio
+from typing import List, Optional, Union
+
+import redis
+
+from app.core.config import settings
+from app.database.crud import task_outbox as crud_task_outbox
+from app.database.models.task_outbox import TaskOutbox
+from app.middleware.depends import get_db_session_context_manager, get_redis_session
+from app.utils.logging.logger import get_logger
+from app.utils.task.delay import add_publish_commands
+from app.utils.time import get_utc_now_without_timezone
+
+DEFAULT_RELAY_INTERVAL_SECONDS = 1
+DEFAULT_RELAY_BATCH_SIZE = 500
+RELAY_RETRY_INTERVAL = 1
+
+logger = get_logger()
+
+
+async def publish_outbox_entries(redis: Union[redis.Redis, redis.RedisCluster], entries: List[TaskOutbox]):
+    """Publish the messages of the entries by one pipeline, the delayed ones not due yet are scheduled."""
+    now = get_utc_now_without_timezone()
+    pipeline = redis.pipeline(transaction=False)
+    for entry in entries:
+        add_publish_commands(
+            pipeline,
+            queue_name=entry.queue_name,
+            message=entry.message,
+            delayed_queue_name=entry.delayed_queue_name,
+            run_at=entry.run_at,
+            now=now,
+        )
+    await pipeline.execute()
+
+
+class TaskOutboxRelay:
+    """Drain the outbox when it is notified, or every `interval` seconds for the entries of the other processes."""
+
+    def __init__(
+        self,
+        redis_connection: Union[redis.Redis, redis.RedisCluster],
+        interval: float = DEFAULT_RELAY_INTERVAL_SECONDS,
+        batch_size: int = DEFAULT_RELAY_BATCH_SIZE,
+    ):
+        if batch_size < 1:
+            raise ValueError(f"batch_size should be greater than 0, got {batch_size}")
+
+        self._redis_connection = redis_connection
+        self._interval = interval
+        self._batch_size = batch_size
+        self._relay: Optional[asyncio.Task] = None
+        # created when the relay is started, so it belongs to the running event loop
+        self._notified: Optional[asyncio.Event] = None
+
+    def start(self):
+        """Start the background relay."""
+        if self._relay is None:
+            self._notified = asyncio.Event()
+            self._relay = asyncio.create_task(self._relay_periodically())
+
+    async def stop(self):
+        """Stop the background relay, the remaining entries are published by the other relays or the next start."""
+        if self._relay is not None:
+            self._relay.cancel()
+            await asyncio.gather(self._relay, return_exceptions=True)
+            self._relay = None
+
+    def notify(self):
+        """Drain the outbox now, the entries of a committed transaction are waiting."""
+        if self._notified is not None:
+            self._notified.set()
+
+    async def _relay_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._notified.wait(), timeout=self._interval)  # type: ignore
+            except asyncio.TimeoutError:
+                pass
+            self._notified.clear()  # type: ignore
+            try:
+                await self.relay()
+            except Exception as e:
+                logger.error(f"TaskOutboxRelay: Failed to relay the outbox entries, error: {e}")
+                await asyncio.sleep(RELAY_RETRY_INTERVAL)
+
+    async def relay(self) -> int:
+        """Publish the entries until the outbox is drained, return the number of them.
+
+        Raises:
+            Exception: The error raised by the db or redis, the batch is kept in the outbox.
+        """
+        relayed_count = 0
+        while True:
+            async with get_db_session_context_manager() as db:
+                entries = await crud_task_outbox.take_outbox_entries(db=db, limit=self._batch_size)
+                if entries:
+                    await publish_outbox_entries(redis=self._redis_connection, entries=entries)
+                    await db.commit()
+            relayed_count += len(entries)
+            if len(entries) < self._batch_size:
+                break
+        if relayed_count:
+            logger.debug(f"TaskOutboxRelay: Published {relayed_count} outbox entries.")
+        return relayed_count
+
+
+def get_task_outbox_relay() -> TaskOutboxRelay:
+    """Get the outbox relay of this process, it is started by the lifespan of the app with TASK_OUTBOX_ENABLED."""
+    return global_task_outbox_relay
+
+
+global_task_outbox_relay = TaskOutboxRelay(
+    get_redis_session(),
+    interval=settings.TASK_OUTBOX_RELAY_INTERVAL_SECONDS,
+    batch_size=settings.TASK_OUTBOX_RELAY_BATCH_SIZE,
+)
@@ -0,0 +1,50 @@
+"""
+Decide the streams of the tasks.
+
+A task type is routed to a stream group by `settings.TASK_TYPE_ROUTES`, each route has one stream per priority, and one
+sorted set of the delayed messages sharing the hash tag of the streams.
+"""
+
+from typing import Dict
+
+from app.const.task import (
+    DEFAULT_TASK_ROUTE,
+    TASK_DELAYED_QUEUE_NAME_SUFFIX,
+    TASK_PRIORITY_QUEUE_NAMES,
+    TASK_ROUTE_QUEUE_NAME_TEMPLATE,
+)
+from app.core.config import settings
+from app.enum.task import TaskPriority, TaskType
+
+
+def get_task_route(type: TaskType) -> str:
+    """Return the route of the task type."""
+    return settings.TASK_TYPE_ROUTES.get(TaskType(type).value, DEFAULT_TASK_ROUTE)
+
+
+def get_route_queue_names(route: str) -> Dict[TaskPriority, str]:
+    """Return the stream name of each priority of the route."""
+    if route == DEFAULT_TASK_ROUTE:
+        return TASK_PRIORITY_QUEUE_NAMES
+
+    queue_name = TASK_ROUTE_QUEUE_NAME_TEMPLATE.format(route=route)
+    return {
+        TaskPriority.HIGH: f"{queue_name}:high",
+        TaskPriority.NORMAL: queue_name,
+        TaskPriority.LOW: f"{queue_name}:low",
+    }
+
+
+def get_task_queue_name(type: TaskType, priority: TaskPriority = TaskPriority.NORMAL) -> str:
+    """Return the stream a task of the type and priority is published to."""
+    return get_route_queue_names(get_task_route(type))[priority]
+
+
+def get_route_delayed_queue_name(route: str) -> str:
+    """Return the sorted set of the delayed messages of the route."""
+    return f"{get_route_queue_names(route)[TaskPriority.NORMAL]}{TASK_DELAYED_QUEUE_NAME_SUFFIX}"
+
+
+def get_task_delayed_queue_name(type: TaskType) -> str:
+    """Return the sorted set a delayed task of the type is kept in."""
+    return get_route_delayed_queue_name(get_task_route(type))
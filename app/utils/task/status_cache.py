@@ -0,0 +1,115 @@
+"""
+Cache the tasks in redis hashes, so polling the status of a task does not reach the db.
+
+The writers of the task status write the committed rows through to the cache, a reader fills the cache from the db on a
+miss without overwriting the fields written through in the meantime, so a slow reader never caches a stale status.
+A hash only having the fields written through is a miss as well. The terminal tasks are kept for
+`TASK_STATUS_CACHE_TTL_SECONDS`, the others for `TASK_STATUS_CACHE_ACTIVE_TTL_SECONDS`, so a lost write is not kept long.
+"""
+
+import json
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, List, Optional, Union
+
+import redis
+
+from app.const.task import TASK_CACHE_KEY_TEMPLATE
+from app.core.config import settings
+from app.database.models.task import Task
+from app.enum.task import TaskStatus
+
+TERMINAL_STATUS_LIST = [TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.CANCELED]
+JSON_FIELDS = ("parameters", "result")
+# a hash without this field only has the status written through by the task ids, it is a miss
+COMPLETE_ENTRY_FIELD = "created_at"
+
+
+def get_task_cache_key(task_id: str) -> str:
+    return TASK_CACHE_KEY_TEMPLATE.format(task_id=task_id)
+
+
+def _get_ttl(status: TaskStatus) -> int:
+    if TaskStatus(status) in TERMINAL_STATUS_LIST:
+        return settings.TASK_STATUS_CACHE_TTL_SECONDS
+    return settings.TASK_STATUS_CACHE_ACTIVE_TTL_SECONDS
+
+
+def _serialize_task(task: Task) -> Dict[str, str]:
+    fields: Dict[str, Any] = {
+        "id": task.id,
+        "type": task.type,
+        "status": task.status,
+        "parameters": task.parameters,
+        "result": task.result,
+        "error_code": task.error_code,
+        "error_message": task.error_message,
+        "created_at": task.created_at,
+        "updated_at": task.updated_at,
+        "started_at": task.started_at,
+        "ended_at": task.ended_at,
+    }
+    serialized_fields = {}
+    for name, value in fields.items():
+        if value is None:
+            continue
+        if name in JSON_FIELDS:
+            value = json.dumps(value, separators=(",", ":"))
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, Enum):
+            value = value.value
+        serialized_fields[name] = str(value)
+    return serialized_fields
+
+
+async def get_cached_task(redis: Union[redis.Redis, redis.RedisCluster], task_id: str) -> Optional[Dict[str, Any]]:
+    """Return the fields of the cached task, None on a miss."""
+    fields = await redis.hgetall(get_task_cache_key(task_id))  # type: ignore
+    if not fields or COMPLETE_ENTRY_FIELD not in fields:
+        return None
+    return {name: json.loads(value) if name in JSON_FIELDS else value for name, value in fields.items()}
+
+
+async def fill_cached_task(redis: Union[redis.Redis, redis.RedisCluster], task: Task):
+    """Cache the task read from the db, the fields written through since it was read are kept."""
+    key = get_task_cache_key(task.id)
+    pipeline = redis.pipeline(transaction=False)
+    for name, value in _serialize_task(task).items():
+        pipeline.hsetnx(key, name, value)
+    pipeline.expire(key, _get_ttl(task.status))
+    await pipeline.execute()
+
+
+async def cache_tasks(redis: Union[redis.Redis, redis.RedisCluster], tasks: List[Task]):
+    """Write the committed tasks through to the cache."""
+    if not tasks:
+        return
+    pipeline = redis.pipeline(transaction=False)
+    for task in tasks:
+        key = get_task_cache_key(task.id)
+        pipeline.hset(key, mapping=_serialize_task(task))
+        pipeline.expire(key, _get_ttl(task.status))
+    await pipeline.execute()
+
+
+async def cache_task_status(redis: Union[redis.Redis, redis.RedisCluster], task_ids: List[str], status: TaskStatus):
+    """Write the committed status of the tasks through to the cache, when only their ids are known."""
+    if not task_ids:
+        return
+    pipeline = redis.pipeline(transaction=False)
+    for task_id in task_ids:
+        key = get_task_cache_key(task_id)
+        pipeline.hset(key, "status", TaskStatus(status).value)
+        pipeline.expire(key, _get_ttl(status))
+    await pipeline.execute()
+
+
+async def invalidate_cached_tasks(redis: Union[redis.Redis, redis.RedisCluster], task_ids: List[str]):
+    """Remove the tasks from the cache, when their committed status is unknown."""
+    if not task_ids:
+        return
+    pipeline = redis.pipeline(transaction=False)
+    for task_id in task_ids:
+        pipeline.delete(get_task_cache_key(task_id))
+    await pipeline.execute()
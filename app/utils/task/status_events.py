@@ -0,0 +1,193 @@
+"""
+Publish the committed status transitions of the tasks, and fan them out to the subscribers of an api process.
+
+The transitions are added to a capped stream instead of a pub/sub channel, a redis cluster client has no pub/sub, and
+a reader reconnecting after an error continues from the last id it read without missing any event. Every api process
+reads the stream by one `TaskStatusHub` without a consumer group, and hands the events to its subscriptions, so the
+number of streaming clients does not change the load of redis or the db.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple, Union
+
+import redis
+
+from app.const.task import TASK_STATUS_STREAM_MAX_LENGTH, TASK_STATUS_STREAM_NAME
+from app.enum.task import TaskStatus, TaskType
+from app.utils.logging.logger import get_logger
+
+XREAD_LAST_ID = "0-0"
+DEFAULT_READ_COUNT = 1000
+DEFAULT_READ_BLOCK_MS = 3 * 1000
+READ_RETRY_INTERVAL = 1
+DEFAULT_BUFFER_SIZE = 1000
+
+TaskStatusEvent = Dict[str, str]
+
+logger = get_logger()
+
+
+def build_task_status_event(task_id: str, status: TaskStatus, type: Optional[TaskType] = None) -> TaskStatusEvent:
+    event = {"task_id": task_id, "status": TaskStatus(status).value}
+    if type is not None:
+        event["type"] = TaskType(type).value
+    return event
+
+
+async def publish_task_status_events(redis: Union[redis.Redis, redis.RedisCluster], events: List[TaskStatusEvent]):
+    """Publish the committed status transitions by one pipeline."""
+    if not events:
+        return
+    pipeline = redis.pipeline(transaction=False)
+    for event in events:
+        pipeline.xadd(TASK_STATUS_STREAM_NAME, fields=event, maxlen=TASK_STATUS_STREAM_MAX_LENGTH, approximate=True)
+    await pipeline.execute()
+
+
+class TaskStatusSubscription:
+    """The status events of the tasks in `task_ids`, or matching `status_list` and `type`, in the order published.
+
+    The events not taken yet are buffered up to `buffer_size`, the oldest ones are dropped beyond it, so a slow client
+    only misses the intermediate transitions but always gets the latest one.
+    """
+
+    def __init__(
+        self,
+        task_ids: Optional[List[str]] = None,
+        status_list: Optional[List[TaskStatus]] = None,
+        type: Optional[TaskType] = None,
+        buffer_size: int = DEFAULT_BUFFER_SIZE,
+    ):
+        self.task_ids = set(task_ids) if task_ids is not None else None
+        self._status_values = {TaskStatus(status).value for status in status_list} if status_list is not None else None
+        self._type_value = TaskType(type).value if type is not None else None
+        self._events: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+
+    def matches(self, event: TaskStatusEvent) -> bool:
+        if self.task_ids is not None and event.get("task_id") not in self.task_ids:
+            return False
+        if self._status_values is not None and event.get("status") not in self._status_values:
+            return False
+        if self._type_value is not None and event.get("type") != self._type_value:
+            return False
+        return True
+
+    def put(self, event_id: str, event: TaskStatusEvent):
+        if self._events.full():
+            self._events.get_nowait()
+        self._events.put_nowait((event_id, event))
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Tuple[str, TaskStatusEvent]]:
+        """Return the next (stream id, event), None if there is none in `timeout` seconds."""
+        if not self._events.empty():
+            return self._events.get_nowait()
+        try:
+            return await asyncio.wait_for(self._events.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class TaskStatusHub:
+    """Read the status stream by one reader and fan the events out to the subscriptions of this process.
+
+    The reader is started by the first subscription, and only delivers the events published after it started.
+    The subscriptions of task ids are indexed by the ids, so an event is only matched against the subscriptions of its
+    task and the subscriptions by filter.
+    """
+
+    def __init__(
+        self,
+        redis_connection: Union[redis.Redis, redis.RedisCluster],
+        stream_name: str = TASK_STATUS_STREAM_NAME,
+        read_count: int = DEFAULT_READ_COUNT,
+        read_block_ms: int = DEFAULT_READ_BLOCK_MS,
+    ):
+        self._redis_connection = redis_connection
+        self._stream_name = stream_name
+        self._read_count = read_count
+        self._read_block_ms = read_block_ms
+        self._task_subscriptions: Dict[str, Set[TaskStatusSubscription]] = {}
+        self._filter_subscriptions: Set[TaskStatusSubscription] = set()
+        self._reader: Optional[asyncio.Task] = None
+        # created when the reader is started, so it belongs to the running event loop
+        self._reader_ready: Optional[asyncio.Event] = None
+
+    @asynccontextmanager
+    async def subscribe(
+        self,
+        task_ids: Optional[List[str]] = None,
+        status_list: Optional[List[TaskStatus]] = None,
+        type: Optional[TaskType] = None,
+        buffer_size: int = DEFAULT_BUFFER_SIZE,
+    ) -> AsyncIterator[TaskStatusSubscription]:
+        """Subscribe the status events, every event published after entering the context is delivered.
+
+        The current status of the tasks should be read after entering the context, so no transition is missed.
+        """
+        subscription = TaskStatusSubscription(task_ids=task_ids, status_list=status_list, type=type, buffer_size=buffer_size)
+        if subscription.task_ids is not None:
+            for task_id in subscription.task_ids:
+                self._task_subscriptions.setdefault(task_id, set()).add(subscription)
+        else:
+            self._filter_subscriptions.add(subscription)
+        try:
+            await self._start()
+            yield subscription
+        finally:
+            if subscription.task_ids is not None:
+                for task_id in subscription.task_ids:
+                    task_subscriptions = self._task_subscriptions.get(task_id)
+                    if task_subscriptions is not None:
+                        task_subscriptions.discard(subscription)
+                        if not task_subscriptions:
+                            del self._task_subscriptions[task_id]
+            else:
+                self._filter_subscriptions.discard(subscription)
+
+    async def close(self):
+        """Stop the reader, it is started again by the next subscription."""
+        if self._reader is not None:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+            self._reader = None
+
+    async def _start(self):
+        if self._reader is None or self._reader.done():
+            self._reader_ready = asyncio.Event()
+            self._reader = asyncio.create_task(self._read_events(self._reader_ready))
+        await self._reader_ready.wait()  # type: ignore
+
+    async def _read_events(self, reader_ready: asyncio.Event):
+        last_id = None
+        while True:
+            try:
+                if last_id is None:
+                    # only the events published after the reader started are delivered
+                    last_messages = await self._redis_connection.xrevrange(self._stream_name, count=1)  # type: ignore
+                    last_id = last_messages[0][0] if last_messages else XREAD_LAST_ID
+                    reader_ready.set()
+                response = await self._redis_connection.xread(  # type: ignore
+                    streams={self._stream_name: last_id},
+                    count=self._read_count,
+                    block=self._read_block_ms,
+                )
+            except Exception as e:
+                logger.error(f"TaskStatusHub: Failed to read the status events, error: {e}")
+                # the subscribers do not wait for redis, no event can be published while it is unreachable anyway
+                reader_ready.set()
+                await asyncio.sleep(READ_RETRY_INTERVAL)
+                continue
+
+            for _, messages in response or []:
+                for message_id, event in messages:
+                    last_id = message_id
+                    self._dispatch(message_id, event)
+
+    def _dispatch(self, event_id: str, event: TaskStatusEvent):
+        for subscription in self._task_subscriptions.get(event.get("task_id"), ()):  # type: ignore
+            if subscription.matches(event):
+                subscription.put(event_id, event)
+        for subscription in self._filter_subscriptions:
+            if subscription.matches(event):
+                subscription.put(event_id, event)
@@ -1,13 +1,20 @@
-from typing import Dict, Optional, Union
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Union
 
 import redis
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.const.task import TASK_QUEUE_NAME
+from app.const.task import TASK_CANCEL_STREAM_MAX_LENGTH, TASK_CANCEL_STREAM_NAME
+from app.core.config import settings
 from app.database.crud import task as crud_task
+from app.database.crud import task_outbox as crud_task_outbox
 from app.database.models.task import Task
-from app.enum.task import TaskStatus, TaskType
+from app.enum.task import TaskPriority, TaskStatus, TaskType
 from app.utils.logging.logger import get_logger
+from app.utils.task.delay import add_publish_commands, schedule_message, to_epoch_ms
+from app.utils.task.message import build_task_message
+from app.utils.task.queue import get_task_delayed_queue_name, get_task_queue_name
+from app.utils.time import get_utc_now_without_timezone, to_utc_without_timezone
 
 logger = get_logger()
 
@@ -17,6 +24,8 @@ async def create_and_publish_task(
     redis: Union[redis.Redis, redis.RedisCluster],
     type: TaskType,
     parameters: Optional[Dict[str, str]] = None,
+    priority: TaskPriority = TaskPriority.NORMAL,
+    run_at: Optional[datetime] = None,
 ) -> Task:
     """
     Create a new task and submit it to the executor.
@@ -25,23 +34,173 @@ async def create_and_publish_task(
         db: The sqlalchemy AsyncSession.
         type: The type of task to create.
         parameters: Optional parameters to pass to the task.
+        priority: The priority of the task, it decides the stream the task is published to with the type.
+        run_at: Optional time to publish the task, a datetime without timezone is regarded as UTC.
+            The task is published immediately if it is None or in the past.
     Returns:
         The newly created and submitted task.
+
+    With TASK_OUTBOX_ENABLED the message is written to the outbox in the transaction of the task instead, it is
+    published by the outbox relay, so the request does not depend on redis.
     """
+    queue_name = get_task_queue_name(type, priority)
+    if settings.TASK_OUTBOX_ENABLED:
+        task = await crud_task.create_task(
+            db=db, type=type, status=TaskStatus.PENDING, parameters=parameters, auto_commit=False
+        )
+        await crud_task_outbox.create_outbox_entries(db=db, entries=[build_outbox_entry(task, queue_name, run_at)])
+        return task
+
     task = await crud_task.create_task(db=db, type=type, status=TaskStatus.PENDING, parameters=parameters)
-    await publish_task_to_queue(redis=redis, queue_name=TASK_QUEUE_NAME, task_id=task.id)
+    if run_at is not None and to_epoch_ms(run_at) > to_epoch_ms(get_utc_now_without_timezone()):
+        await schedule_task(
+            redis=redis,
+            delayed_queue_name=get_task_delayed_queue_name(type),
+            queue_name=queue_name,
+            task=task,
+            run_at=run_at,
+        )
+    else:
+        await publish_task_to_queue(redis=redis, queue_name=queue_name, task=task)
     return task
 
 
+async def create_and_publish_tasks(
+    db: AsyncSession,
+    redis: Union[redis.Redis, redis.RedisCluster],
+    tasks: List[Dict[str, Any]],
+) -> List[Task]:
+    """
+    Create the tasks by one INSERT and publish or schedule all of them by one redis pipeline.
+
+    Args:
+        db: The sqlalchemy AsyncSession.
+        tasks: The definitions of the tasks, each has `type`, and optional `parameters`, `priority` and `run_at`,
+            see `create_and_publish_task`.
+    Returns:
+        The created tasks in the order of `tasks`.
+
+    With TASK_OUTBOX_ENABLED the messages are written to the outbox in the transaction of the tasks instead.
+    """
+    created_tasks = await crud_task.create_tasks(
+        db=db,
+        tasks=[
+            {"type": definition["type"], "status": TaskStatus.PENDING, "parameters": definition.get("parameters")}
+            for definition in tasks
+        ],
+        auto_commit=not settings.TASK_OUTBOX_ENABLED,
+    )
+    if settings.TASK_OUTBOX_ENABLED:
+        await crud_task_outbox.create_outbox_entries(
+            db=db,
+            entries=[
+                build_outbox_entry(
+                    task,
+                    get_task_queue_name(task.type, definition.get("priority", TaskPriority.NORMAL)),
+                    definition.get("run_at"),
+                )
+                for definition, task in zip(tasks, created_tasks)
+            ],
+        )
+        return created_tasks
+
+    now = get_utc_now_without_timezone()
+    pipeline = redis.pipeline(transaction=False)
+    for definition, task in zip(tasks, created_tasks):
+        add_publish_commands(
+            pipeline,
+            queue_name=get_task_queue_name(task.type, definition.get("priority", TaskPriority.NORMAL)),
+            message=build_task_message(task, self_describing=settings.TASK_MESSAGE_SELF_DESCRIBING),
+            delayed_queue_name=get_task_delayed_queue_name(task.type),
+            run_at=definition.get("run_at"),
+            now=now,
+        )
+    try:
+        await pipeline.execute()
+        logger.info(f"Messages of {len(created_tasks)} task(s) published")
+    except Exception as e:
+        logger.error(f"Failed to publish messages of {len(created_tasks)} task(s), error:{e}.")
+        raise e
+    return created_tasks
+
+
+def build_outbox_entry(task: Task, queue_name: str, run_at: Optional[datetime] = None) -> Dict[str, Any]:
+    """Build the outbox entry of the task message, the fields of `crud_task_outbox.create_outbox_entries`.
+
+    `run_at` is stored in UTC without timezone like the other times of the db, it is regarded as UTC without timezone.
+    """
+    return {
+        "task_id": task.id,
+        "queue_name": queue_name,
+        "message": build_task_message(task, self_describing=settings.TASK_MESSAGE_SELF_DESCRIBING),
+        "delayed_queue_name": get_task_delayed_queue_name(task.type) if run_at is not None else None,
+        "run_at": to_utc_without_timezone(run_at) if run_at is not None else None,
+    }
+
+
 async def publish_task_to_queue(
     redis: Union[redis.Redis, redis.RedisCluster],
     queue_name: str,
-    task_id: str,
+    task: Task,
 ):
-    message = {"task_id": task_id}
+    """
+    Publish the task message to the stream.
+
+    The stream is not capped, an unprocessed message is never dropped, the acknowledged messages are trimmed by the
+    workers, see app/utils/task/trim.py.
+    """
+    message = build_task_message(task, self_describing=settings.TASK_MESSAGE_SELF_DESCRIBING)
     try:
         await redis.xadd(queue_name, fields=message)  # type: ignore
         logger.info(f"Message value {message} published to queue({queue_name})")
     except Exception as e:
         logger.error(f"Failed to publish message value {message} to queue({queue_name}), error:{e}.")
         raise e
+
+
+async def schedule_task(
+    redis: Union[redis.Redis, redis.RedisCluster],
+    delayed_queue_name: str,
+    queue_name: str,
+    task: Task,
+    run_at: datetime,
+):
+    """Keep the task in the delayed queue, it is published to the queue at `run_at` by the workers."""
+    message = build_task_message(task, self_describing=settings.TASK_MESSAGE_SELF_DESCRIBING)
+    try:
+        await schedule_message(
+            redis=redis, delayed_queue_name=delayed_queue_name, queue_name=queue_name, message=message, run_at=run_at
+        )
+        logger.info(f"Message value {message} scheduled to queue({queue_name}) at {run_at}")
+    except Exception as e:
+        logger.error(f"Failed to schedule message value {message} to queue({queue_name}), error:{e}.")
+        raise e
+
+
+async def publish_task_cancellations(
+    redis: Union[redis.Redis, redis.RedisCluster],
+    task_ids: List[str],
+):
+    """
+    Broadcast the cancelled task ids to the workers, so the running handlers of them are stopped.
+
+    Args:
+        redis: The redis connection.
+        task_ids: The ids of the cancelled tasks.
+    """
+    if not task_ids:
+        return
+    pipeline = redis.pipeline(transaction=False)
+    for task_id in task_ids:
+        pipeline.xadd(
+            TASK_CANCEL_STREAM_NAME,
+            fields={"task_id": task_id},
+            maxlen=TASK_CANCEL_STREAM_MAX_LENGTH,
+            approximate=True,
+        )
+    try:
+        await pipeline.execute()
+        logger.info(f"Cancellations of {len(task_ids)} task(s) published to queue({TASK_CANCEL_STREAM_NAME})")
+    except Exception as e:
+        logger.error(f"Failed to publish cancellations of {len(task_ids)} task(s), error:{e}.")
+        raise e
@@ -0,0 +1,48 @@
+"""
+Trim the acknowledged messages of the task streams.
+
+An entry can be removed once every consumer group of the stream has read and acknowledged it, i.e. it is older than
+the oldest pending entry of every group, and not newer than the last entry delivered to every group. The streams are
+trimmed by XTRIM MINID with this id, so the unprocessed entries are never removed, whatever the backlog is.
+"""
+
+from typing import Optional, Union
+
+import redis
+
+
+def _parse_stream_id(stream_id: str):
+    milliseconds, _, sequence = stream_id.partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+async def get_trim_min_id(redis: Union[redis.Redis, redis.RedisCluster], stream_name: str) -> Optional[str]:
+    """Return the id of the oldest entry still needed by a consumer group, None if the stream should not be trimmed.
+
+    A stream without groups is not trimmed, its entries are not read by anyone yet.
+    """
+    groups = await redis.xinfo_groups(stream_name)  # type: ignore
+    if not groups:
+        return None
+
+    min_ids = []
+    for group in groups:
+        if group["pending"]:
+            # the pending entries of the group are not acknowledged yet, the oldest one is kept
+            pending_summary = await redis.xpending(stream_name, group["name"])  # type: ignore
+            min_ids.append(pending_summary["min"] or group["last-delivered-id"])
+        else:
+            # the entries after the last delivered one are not read by the group yet, it is kept to be safe
+            min_ids.append(group["last-delivered-id"])
+    return min(min_ids, key=_parse_stream_id)
+
+
+async def trim_acked_messages(redis: Union[redis.Redis, redis.RedisCluster], stream_name: str) -> int:
+    """Remove the entries of the stream acknowledged by all of its consumer groups, return the number removed.
+
+    The trim is approximate, redis only removes whole macro nodes, so a few acknowledged entries may be kept.
+    """
+    min_id = await get_trim_min_id(redis, stream_name)
+    if min_id is None:
+        return 0
+    return await redis.xtrim(stream_name, minid=min_id, approximate=True)  # type: ignore
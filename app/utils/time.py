@@ -4,3 +4,10 @@ from datetime import datetime, timezone
 def get_utc_now_without_timezone() -> datetime:
     """Return now with a datetime with timezone not aware and the timezone is set to UTC."""
     return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def to_utc_without_timezone(time: datetime) -> datetime:
+    """Convert a datetime to UTC without timezone, a datetime without timezone is regarded as UTC already."""
+    if time.tzinfo is None:
+        return time
+    return time.astimezone(timezone.utc).replace(tzinfo=None)
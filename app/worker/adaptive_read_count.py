@@ -0,0 +1,60 @@
+from typing import Optional
+
+MIN_READ_MESSAGE_COUNT = 1
+MAX_READ_MESSAGE_COUNT = 100
+PREFETCH_WINDOW_SECONDS = 0.05
+LATENCY_SMOOTHING_FACTOR = 0.2
+
+
+class AdaptiveReadCount:
+    """Decide how many messages a consumer should read from the stream at once.
+
+    The count grows multiplicatively while reads come back full (there is a backlog) and shrinks while they come back
+    mostly empty (the stream is idle). Every read is capped by the free in-flight capacity, plus the slots that are
+    expected to be released within `prefetch_window` according to the smoothed handler latency, so short tasks are
+    prefetched while long tasks are never read before a slot can take them.
+    """
+
+    def __init__(
+        self,
+        min_count: int = MIN_READ_MESSAGE_COUNT,
+        max_count: int = MAX_READ_MESSAGE_COUNT,
+        prefetch_window: float = PREFETCH_WINDOW_SECONDS,
+    ):
+        if not 0 < min_count <= max_count:
+            raise ValueError(f"Invalid read count range: {min_count}~{max_count}")
+
+        self._min_count = min_count
+        self._max_count = max_count
+        self._prefetch_window = prefetch_window
+        self._count = min_count
+        self._latency: Optional[float] = None
+
+    @property
+    def latency(self) -> Optional[float]:
+        """The exponentially smoothed handler latency in seconds, None if no task has been observed yet."""
+        return self._latency
+
+    def observe_latency(self, elapsed: float):
+        """Record the time elapsed by a handler."""
+        if self._latency is None:
+            self._latency = elapsed
+        else:
+            self._latency += LATENCY_SMOOTHING_FACTOR * (elapsed - self._latency)
+
+    def observe_read(self, requested: int, received: int):
+        """Grow the count when a read is full and shrink it when the read is less than half full."""
+        if requested <= 0:
+            return
+        if received >= requested:
+            self._count = min(self._count * 2, self._max_count)
+        elif received * 2 < requested:
+            self._count = max(self._count // 2, self._min_count)
+
+    def next_count(self, free_slots: int, in_flight: int) -> int:
+        """Return the number of messages to read, 0 means the consumer should wait for a free slot first."""
+        prefetch = 0
+        if self._latency is not None and in_flight > 0:
+            prefetch = int(in_flight * min(1.0, self._prefetch_window / max(self._latency, 1e-6)))
+
+        return max(0, min(self._count, free_slots + prefetch))
@@ -1,20 +1,31 @@
 import asyncio
 import time
 import uuid
-from typing import Dict, List, Optional, Union
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 import redis.asyncio as async_redis
 from redis import ResponseError
 
+from app.const.task import TASK_DEAD_LETTER_STREAM_MAX_LENGTH, TASK_TIMEOUT_PARAMETER_NAME
 from app.database.crud import task as crud_task
 from app.database.models.task import Task
 from app.enum.task import TaskStatus, TaskType
 from app.middleware.depends import get_db_session_context_manager
+from app.utils.exceptions.db import EntryWithIDNotExist
+from app.utils.exceptions.task import TaskAbandoned, TaskDeliveryExceeded, TaskTimeoutError
 from app.utils.logging.logger import get_logger
+from app.utils.task.delay import promote_due_messages, schedule_message
+from app.utils.task.message import build_retry_message, get_message_attempt, parse_task_message
+from app.utils.task.status_cache import cache_tasks, invalidate_cached_tasks
+from app.utils.task.status_events import TaskStatusEvent, build_task_status_event, publish_task_status_events
+from app.utils.task.trim import trim_acked_messages
 from app.utils.time import get_utc_now_without_timezone
+from app.worker.adaptive_read_count import MAX_READ_MESSAGE_COUNT, AdaptiveReadCount
 from app.worker.task_handler.base_handler import BaseHandler
+from app.worker.task_status_writer import TaskStatusWriter
+from app.worker.weighted_round_robin import WeightedRoundRobin
 
-DEFAULT_READ_MESSAGE_COUNT = 1
 CLAIM_RETRY_INTERVAL = 1
 XGROUPCREATE_SPECIAL_ID = "$"
 XREADGROUP_SPECIAL_ID = ">"
@@ -23,8 +34,23 @@ XREADGROUP_DEFAULT_COUNT = 1
 XPENDING_START = "-"
 XPENDING_END = "+"
 XPENDING_DEFAULT_COUNT = 1
+XAUTOCLAIM_START_ID = "0-0"
 MIN_IDLE_TIME_MS = 10 * 1000
+DEFAULT_LEASE_INTERVAL_SECONDS = MIN_IDLE_TIME_MS / 1000 / 3
+XCLAIM_MAX_MESSAGE_COUNT = 1000
+DEFAULT_RECLAIM_INTERVAL_SECONDS = 5
+DEFAULT_RECLAIM_BATCH_SIZE = 100
+DEFAULT_ACK_BATCH_SIZE = 100
+DEFAULT_ACK_FLUSH_INTERVAL_SECONDS = 0.005
+ACK_FLUSH_RETRY_INTERVAL = 1
+XREAD_LAST_ID = "0-0"
+CANCELLATION_READ_COUNT = 100
 MESSAGE_LIMIT_LENGTH = 1024
+DEFAULT_MAX_IN_FLIGHT = 1
+DEFAULT_PROMOTE_INTERVAL_SECONDS = 0.5
+DEFAULT_PROMOTE_BATCH_SIZE = 1000
+STATUS_WRITE_MAX_RETRY_COUNT = 3
+STATUS_WRITE_RETRY_INTERVAL = 0.5
 
 logger = get_logger()
 
@@ -39,27 +65,168 @@ class BaseTaskConsumer:
         queue_name: str,
         consumer_group_name: str = "default_group",
         max_retry_count: int = 3,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        max_read_count: int = MAX_READ_MESSAGE_COUNT,
+        reclaim_interval: float = DEFAULT_RECLAIM_INTERVAL_SECONDS,
+        reclaim_batch_size: int = DEFAULT_RECLAIM_BATCH_SIZE,
+        ack_batch_size: int = DEFAULT_ACK_BATCH_SIZE,
+        ack_flush_interval: float = DEFAULT_ACK_FLUSH_INTERVAL_SECONDS,
+        status_writer: Optional[TaskStatusWriter] = None,
+        cancel_stream_name: Optional[str] = None,
+        min_idle_time: int = MIN_IDLE_TIME_MS,
+        task_min_idle_times: Optional[Dict[TaskType, int]] = None,
+        lease_interval: float = DEFAULT_LEASE_INTERVAL_SECONDS,
+        queue_weights: Optional[Dict[str, int]] = None,
+        delayed_queue_name: Optional[str] = None,
+        promote_interval: float = DEFAULT_PROMOTE_INTERVAL_SECONDS,
+        promote_batch_size: int = DEFAULT_PROMOTE_BATCH_SIZE,
+        dead_letter_stream_name: Optional[str] = None,
+        max_delivery_count: Optional[int] = None,
+        trim_interval: Optional[float] = None,
+        status_cache_enabled: bool = False,
+        status_events_enabled: bool = False,
     ):
+        """
+        Args:
+            queue_name: The stream of the tasks.
+            queue_weights: The read weights of the streams, e.g. {high: 6, queue_name: 3, low: 1}, it should include
+                `queue_name`. The streams share the in-flight slots by their weights, a stream without messages
+                leaves its share to the others. None means only reading `queue_name`.
+            delayed_queue_name: The sorted set of the delayed messages published to the streams of this consumer,
+                the due ones are promoted every `promote_interval` seconds by batches. None means no promotion. The
+                failed tasks are retried by the retry policies of their handlers through it, None means no retry.
+            dead_letter_stream_name: The stream of the messages of the tasks failed at their last attempts, and of
+                the reclaimed messages delivered more than `max_delivery_count` times, None means no dead letter.
+            max_delivery_count: A reclaimed message delivered more times is failed without processing, so a message
+                crashing its consumer is not reclaimed forever. None means no limit.
+            trim_interval: The acknowledged messages of the streams are trimmed every `trim_interval` seconds, the
+                messages pending or not read by any consumer group are kept. None means no trim.
+            status_cache_enabled: Write the status transitions through to the task cache in redis.
+            status_events_enabled: Publish the committed status transitions to the status stream.
+        """
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight should be greater than 0, got {max_in_flight}")
+        if max_delivery_count is not None and max_delivery_count < 1:
+            raise ValueError(f"max_delivery_count should be greater than 0, got {max_delivery_count}")
+        task_min_idle_times = task_min_idle_times or {}
+        shortest_min_idle_time = min([min_idle_time, *task_min_idle_times.values()])
+        if lease_interval * 1000 >= shortest_min_idle_time:
+            raise ValueError(
+                f"lease_interval({lease_interval}s) should be shorter than the min idle time({shortest_min_idle_time}ms)"
+            )
+
+        queue_weights = queue_weights or {queue_name: 1}
+        if queue_name not in queue_weights:
+            raise ValueError(f"queue_weights should include the queue_name: {queue_name}")
 
         self._redis_connection = redis_connection
         self._task_handlers = task_handlers
-        self._stream_name = queue_name
+        self._stream_names = list(queue_weights)
+        self._stream_read_shares = WeightedRoundRobin(queue_weights)
         self._consumer_group_name = consumer_group_name
         self._consumer_name = f"{consumer_group_name}_{uuid.uuid4()}"
-        self._task = None
         self._max_retry_count = max_retry_count
+        self._max_in_flight = max_in_flight
+        self._in_flight_slots = asyncio.Semaphore(max_in_flight)
+        self._in_flight_tasks: Set[asyncio.Task] = set()
+        self._read_count = AdaptiveReadCount(max_count=max_read_count)
+        self._reclaim_interval = reclaim_interval
+        self._reclaim_batch_size = reclaim_batch_size
+        self._reclaim_start_ids = {stream_name: XAUTOCLAIM_START_ID for stream_name in self._stream_names}
+        self._pending_scan_start_ids = {stream_name: XPENDING_START for stream_name in self._stream_names}
+        self._min_idle_time = min_idle_time
+        self._task_min_idle_times = task_min_idle_times
+        self._lease_interval = lease_interval
+        self._in_flight_message_ids: Dict[str, Set[str]] = {stream_name: set() for stream_name in self._stream_names}
+        self._ack_batch_size = ack_batch_size
+        self._ack_flush_interval = ack_flush_interval
+        self._pending_ack_message_ids: Dict[str, List[str]] = {stream_name: [] for stream_name in self._stream_names}
+        self._ack_batch_full = asyncio.Event()
+        self._ack_buffered = asyncio.Event()
+        self._status_writer = status_writer
+        self._cancel_stream_name = cancel_stream_name
+        self._delayed_queue_name = delayed_queue_name
+        self._promote_interval = promote_interval
+        self._promote_batch_size = promote_batch_size
+        self._dead_letter_stream_name = dead_letter_stream_name
+        self._max_delivery_count = max_delivery_count
+        self._trim_interval = trim_interval
+        self._status_cache_enabled = status_cache_enabled
+        self._status_events_enabled = status_events_enabled
+        self._running_handlers: Dict[str, asyncio.Future] = {}
+        self._cancelled_task_ids: Set[str] = set()
+        self._is_stopping = False
+        self._processed_count = 0
+
+    @property
+    def processed_count(self) -> int:
+        """The number of messages acknowledged by this consumer."""
+        return self._processed_count
+
+    def stop(self):
+        """Stop reading new messages, `run` returns after the in-flight tasks are drained."""
+        logger.info(f"TaskConsumer: Stopping the consumer({self._consumer_name}).")
+        self._is_stopping = True
 
     async def run(self):
-        """Continuously runs the EventBusConsumer to handle pending and new messages."""
+        """Continuously runs the EventBusConsumer to handle new messages, pending messages are reclaimed by a janitor."""
         await self._create_consumer_group_if_not_exists()
+        for handler in self._task_handlers.values():
+            await handler.start()
+        if self._status_writer:
+            self._status_writer.start()
+        ack_flusher = asyncio.create_task(self._flush_acks_periodically())
+        cancellation_listener = None
+        if self._cancel_stream_name:
+            cancellation_listener = asyncio.create_task(self._listen_for_cancellations())
+        lease_keeper = asyncio.create_task(self._extend_leases_periodically())
+        promoter = None
+        if self._delayed_queue_name:
+            promoter = asyncio.create_task(self._promote_due_messages_periodically())
+        trimmer = None
+        if self._trim_interval:
+            trimmer = asyncio.create_task(self._trim_streams_periodically())
+        janitor = None
+        try:
+            await self._reclaim_pending_messages()
+            janitor = asyncio.create_task(self._reclaim_pending_messages_periodically())
+            await self._consume_new_messages()
+        finally:
+            await self._cancel_background_task(janitor)
+            await self._cancel_background_task(promoter)
+            await self._cancel_background_task(trimmer)
+            # keep listening for cancellations and extending leases until the in-flight tasks are drained
+            await self._wait_in_flight_tasks()
+            await self._cancel_background_task(cancellation_listener)
+            await self._cancel_background_task(lease_keeper)
+            for handler in self._task_handlers.values():
+                await handler.stop()
+            if self._status_writer:
+                await self._status_writer.stop()
+            await self._cancel_background_task(ack_flusher)
+            await self._flush_acks()
+
+    @staticmethod
+    async def _cancel_background_task(background_task: Optional[asyncio.Task]):
+        if background_task is not None:
+            background_task.cancel()
+            await asyncio.gather(background_task, return_exceptions=True)
+
+    async def _consume_new_messages(self):
         retried_count = 0
-        while True:
+        while not self._is_stopping:
             messages = []
+            count = self._read_count.next_count(
+                free_slots=self._max_in_flight - len(self._in_flight_tasks),
+                in_flight=len(self._in_flight_tasks),
+            )
+            if count == 0:
+                await asyncio.wait(self._in_flight_tasks, return_when=asyncio.FIRST_COMPLETED)
+                continue
             try:
-                messages = await self._auto_claim_messages(count=DEFAULT_READ_MESSAGE_COUNT)
+                messages = await self._get_new_messages(count=count)
                 retried_count = 0
-                if not messages:
-                    messages = await self._get_new_messages(count=DEFAULT_READ_MESSAGE_COUNT)
+                self._read_count.observe_read(requested=count, received=len(messages))
             except KeyboardInterrupt:
                 logger.info(f"KeyboardInterrupt, stop the consumer group({self._consumer_group_name})")
                 break
@@ -74,124 +241,699 @@ class BaseTaskConsumer:
                 retried_count += 1
                 continue
 
-            for message in messages:
-                await self._process_message(message=message)
+            for stream_name, message in messages:
+                await self._dispatch_message(stream_name=stream_name, message=message)
 
-    async def _create_consumer_group_if_not_exists(self):
-        groups = []
+    async def _reclaim_pending_messages_periodically(self):
+        """The janitor, reclaims the messages idled too long in other consumers every `reclaim_interval` seconds."""
+        while not self._is_stopping:
+            await asyncio.sleep(self._reclaim_interval)
+            await self._reclaim_pending_messages()
+
+    async def _reclaim_pending_messages(self):
+        for stream_name in self._stream_names:
+            await self._reclaim_stream_pending_messages(stream_name)
+
+    async def _reclaim_stream_pending_messages(self, stream_name: str):
+        # never claim more than the free slots, otherwise the claimed messages idle in this consumer instead
+        count = min(self._reclaim_batch_size, self._max_in_flight - len(self._in_flight_tasks))
+        if count <= 0:
+            return
         try:
-            groups = await self._redis_connection.xinfo_groups(self._stream_name)
-        except ResponseError as e:
-            if str(e) == "no such key":
-                groups = []
+            if self._task_min_idle_times:
+                messages = await self._claim_idle_messages_by_task_type(stream_name=stream_name, count=count)
             else:
-                raise e
+                messages = await self._auto_claim_messages(
+                    stream_name=stream_name, count=count, min_idle_time=self._min_idle_time
+                )
+            if messages and self._max_delivery_count:
+                messages = await self._fail_undeliverable_messages(stream_name=stream_name, messages=messages)
+        except Exception as e:
+            logger.error(f"TaskConsumer: Failed to reclaim pending messages of stream({stream_name}), error: {e}")
+            return
 
-        group = next((group for group in groups if group["name"] == self._consumer_group_name), None)
-        if not group:
-            logger.info(f"Create a new group({self._consumer_group_name}) in stream({self._stream_name})")
-            await self._redis_connection.xgroup_create(
-                name=self._stream_name,
-                groupname=self._consumer_group_name,
-                id=XGROUPCREATE_SPECIAL_ID,
-                mkstream=True,
+        if messages:
+            logger.info(f"TaskConsumer: Reclaimed {len(messages)} pending message(s) of stream({stream_name}).")
+        for message in messages:
+            await self._dispatch_message(stream_name=stream_name, message=message, is_reclaimed=True)
+
+    async def _claim_idle_messages_by_task_type(self, stream_name: str, count: int) -> List[dict]:
+        """Claim the pending messages idled longer than the min idle time of their task types.
+
+        XAUTOCLAIM only supports one min idle time, so the idle entries are listed by XPENDING, their types are read
+        from the stream, and the ones idled long enough are claimed by XCLAIM grouped by the min idle time.
+        """
+        pending_entries = await self._redis_connection.xpending_range(
+            name=stream_name,
+            groupname=self._consumer_group_name,
+            min=self._pending_scan_start_ids[stream_name],
+            max=XPENDING_END,
+            count=count,
+            idle=min([self._min_idle_time, *self._task_min_idle_times.values()]),
+        )
+        # continue from the last scanned entry next time, so the entries not idled long enough do not block the others
+        self._pending_scan_start_ids[stream_name] = (
+            f"({pending_entries[-1]['message_id']}" if len(pending_entries) >= count else XPENDING_START
+        )
+        if not pending_entries:
+            return []
+
+        pipeline = self._redis_connection.pipeline(transaction=False)
+        for entry in pending_entries:
+            pipeline.xrange(stream_name, min=entry["message_id"], max=entry["message_id"], count=1)
+        entry_messages = await pipeline.execute()
+
+        message_ids_by_min_idle_time: Dict[int, List[str]] = {}
+        for entry, messages in zip(pending_entries, entry_messages):
+            task_type = messages[0][1].get("type") if messages else None
+            min_idle_time = self._task_min_idle_times.get(task_type, self._min_idle_time)  # type: ignore
+            if entry["time_since_delivered"] >= min_idle_time:
+                message_ids_by_min_idle_time.setdefault(min_idle_time, []).append(entry["message_id"])
+
+        claimed_messages = []
+        for min_idle_time, message_ids in message_ids_by_min_idle_time.items():
+            claimed_messages.extend(
+                await self._redis_connection.xclaim(
+                    name=stream_name,
+                    groupname=self._consumer_group_name,
+                    consumername=self._consumer_name,
+                    min_idle_time=min_idle_time,
+                    message_ids=message_ids,
+                )
             )
+        return claimed_messages
+
+    async def _fail_undeliverable_messages(self, stream_name: str, messages: List[dict]) -> List[dict]:
+        """Fail the claimed messages delivered more than the max delivery count, return the others.
+
+        The delivery counts are read by XPENDING in one round trip, the failed messages are moved to the dead-letter
+        stream and acknowledged, so they are not reclaimed again.
+        """
+        pipeline = self._redis_connection.pipeline(transaction=False)
+        for message_id, _ in messages:
+            pipeline.xpending_range(stream_name, self._consumer_group_name, min=message_id, max=message_id, count=1)
+        pending_entries = await pipeline.execute()
+
+        deliverable_messages = []
+        for message, entries in zip(messages, pending_entries):
+            delivery_count = entries[0]["times_delivered"] if entries else 0
+            if delivery_count <= self._max_delivery_count:  # type: ignore
+                deliverable_messages.append(message)
+                continue
+
+            message_id, task_payload = message
+            error = TaskDeliveryExceeded(
+                delivery_count=delivery_count, max_delivery_count=self._max_delivery_count  # type: ignore
+            )
+            logger.error(f"TaskConsumer: Message {message_id} of stream({stream_name}) failed, error: {error}")
+            try:
+                task_id = (task_payload or {}).get("task_id")
+                if task_id:
+                    await self._fail_task(task_id=task_id, error=error)
+                await self._dead_letter(stream_name, message_id, task_payload, error)
+            except Exception as e:
+                # the message is left pending, it is failed again when it is reclaimed next time
+                logger.error(f"TaskConsumer: Failed to dead-letter message {message_id} of stream({stream_name}), error: {e}")
+                continue
+            await self._ack_message(stream_name=stream_name, message_id=message_id)
+        return deliverable_messages
+
+    async def _dead_letter(self, stream_name: str, message_id: str, task_payload: Optional[dict], error: Exception):
+        """Copy the message to the dead-letter stream with its stream, id and error, do nothing without the stream."""
+        if not self._dead_letter_stream_name:
+            return
+        await self._redis_connection.xadd(
+            self._dead_letter_stream_name,
+            fields={
+                **(task_payload or {}),
+                "queue": stream_name,
+                "message_id": message_id,
+                "error": str(error),
+                "error_code": getattr(error, "code", 1),
+            },
+            maxlen=TASK_DEAD_LETTER_STREAM_MAX_LENGTH,
+            approximate=True,
+        )
+
+    async def _extend_leases_periodically(self):
+        """The lease keeper, resets the idle time of the in-flight messages, so they are not reclaimed by others."""
+        while True:
+            await asyncio.sleep(self._lease_interval)
+            for stream_name, in_flight_message_ids in self._in_flight_message_ids.items():
+                message_ids = list(in_flight_message_ids)
+                for start in range(0, len(message_ids), XCLAIM_MAX_MESSAGE_COUNT):
+                    try:
+                        await self._redis_connection.xclaim(
+                            name=stream_name,
+                            groupname=self._consumer_group_name,
+                            consumername=self._consumer_name,
+                            min_idle_time=0,
+                            message_ids=message_ids[start : start + XCLAIM_MAX_MESSAGE_COUNT],
+                            justid=True,
+                        )
+                    except Exception as e:
+                        logger.error(
+                            f"TaskConsumer: Failed to extend the leases of in-flight messages of stream({stream_name}), "
+                            f"error: {e}"
+                        )
+
+    async def _promote_due_messages_periodically(self):
+        """The promoter, publishes the due delayed messages to their streams, a full batch is followed immediately."""
+        while True:
+            promoted_count = 0
+            try:
+                promoted_count = await promote_due_messages(
+                    redis=self._redis_connection,  # type: ignore
+                    delayed_queue_name=self._delayed_queue_name,  # type: ignore
+                    queue_names=self._stream_names,
+                    now=get_utc_now_without_timezone(),
+                    batch_size=self._promote_batch_size,
+                )
+            except Exception as e:
+                logger.error(f"TaskConsumer: Failed to promote delayed messages of {self._delayed_queue_name}, error: {e}")
+            if promoted_count:
+                logger.info(f"TaskConsumer: Promoted {promoted_count} delayed message(s) of {self._delayed_queue_name}.")
+            if promoted_count < self._promote_batch_size:
+                await asyncio.sleep(self._promote_interval)
+
+    async def _trim_streams_periodically(self):
+        """The trimmer, removes the messages acknowledged by all consumer groups every `trim_interval` seconds."""
+        while True:
+            await asyncio.sleep(self._trim_interval)  # type: ignore
+            for stream_name in self._stream_names:
+                try:
+                    trimmed_count = await trim_acked_messages(redis=self._redis_connection, stream_name=stream_name)
+                except Exception as e:
+                    logger.error(f"TaskConsumer: Failed to trim stream({stream_name}), error: {e}")
+                    continue
+                if trimmed_count:
+                    logger.info(f"TaskConsumer: Trimmed {trimmed_count} acknowledged message(s) of stream({stream_name}).")
+
+    async def _listen_for_cancellations(self):
+        """Cancel the running handlers of the tasks published to the cancel stream.
+
+        The cancel stream is read without a consumer group, so every consumer receives every cancellation.
+        """
+        last_id = None
+        while True:
+            try:
+                if last_id is None:
+                    # only the cancellations published after the consumer started are relevant
+                    last_messages = await self._redis_connection.xrevrange(self._cancel_stream_name, count=1)
+                    last_id = last_messages[0][0] if last_messages else XREAD_LAST_ID
+                response = await self._redis_connection.xread(
+                    streams={self._cancel_stream_name: last_id},
+                    count=CANCELLATION_READ_COUNT,
+                    block=XREADGROUP_BLOCK_MS,
+                )
+            except Exception as e:
+                logger.error(f"TaskConsumer: Failed to read cancellations, error: {e}")
+                await asyncio.sleep(CLAIM_RETRY_INTERVAL)
+                continue
+
+            for _, messages in response or []:
+                for message_id, payload in messages:
+                    last_id = message_id
+                    self._cancel_running_handler(payload.get("task_id"))
+
+    def _cancel_running_handler(self, task_id: Optional[str]):
+        running_handler = self._running_handlers.get(task_id) if task_id else None
+        if running_handler is None or running_handler.done():
+            return
+        logger.info(f"TaskConsumer: Task id: {task_id} is cancelled, stop its handler.")
+        self._cancelled_task_ids.add(task_id)
+        running_handler.cancel()
+
+    async def _dispatch_message(self, stream_name: str, message: dict, is_reclaimed: bool = False):
+        """Run the message as a background asyncio task once an in-flight slot is free."""
+        await self._in_flight_slots.acquire()
+        in_flight_task = asyncio.create_task(
+            self._process_message(stream_name=stream_name, message=message, is_reclaimed=is_reclaimed)
+        )
+        self._in_flight_tasks.add(in_flight_task)
+        in_flight_task.add_done_callback(self._on_in_flight_task_done)
+
+    def _on_in_flight_task_done(self, in_flight_task: asyncio.Task):
+        self._in_flight_tasks.discard(in_flight_task)
+        self._in_flight_slots.release()
+
+    async def _wait_in_flight_tasks(self):
+        """Wait for all in-flight messages to be processed, used to drain the consumer on shutdown."""
+        if self._in_flight_tasks:
+            logger.info(f"TaskConsumer: Waiting for {len(self._in_flight_tasks)} in-flight task(s) to finish.")
+            await asyncio.gather(*self._in_flight_tasks, return_exceptions=True)
+
+    async def _create_consumer_group_if_not_exists(self):
+        for stream_name in self._stream_names:
+            groups = []
+            try:
+                groups = await self._redis_connection.xinfo_groups(stream_name)
+            except ResponseError as e:
+                if str(e) == "no such key":
+                    groups = []
+                else:
+                    raise e
+
+            group = next((group for group in groups if group["name"] == self._consumer_group_name), None)
+            if not group:
+                logger.info(f"Create a new group({self._consumer_group_name}) in stream({stream_name})")
+                await self._redis_connection.xgroup_create(
+                    name=stream_name,
+                    groupname=self._consumer_group_name,
+                    id=XGROUPCREATE_SPECIAL_ID,
+                    mkstream=True,
+                )
 
         return self
 
     async def _auto_claim_messages(
-        self, count: Optional[int] = XPENDING_DEFAULT_COUNT, min_idle_time: int = MIN_IDLE_TIME_MS
+        self, stream_name: str, count: Optional[int] = XPENDING_DEFAULT_COUNT, min_idle_time: int = MIN_IDLE_TIME_MS
     ) -> List[dict]:
-        _, claimed_messages, _ = await self._redis_connection.xautoclaim(
-            name=self._stream_name,
+        next_start_id, claimed_messages, *_ = await self._redis_connection.xautoclaim(
+            name=stream_name,
             groupname=self._consumer_group_name,
             consumername=self._consumer_name,
             min_idle_time=min_idle_time,
+            start_id=self._reclaim_start_ids[stream_name],
             count=count,
         )
+        self._reclaim_start_ids[stream_name] = next_start_id or XAUTOCLAIM_START_ID
         return claimed_messages
 
     async def _get_new_messages(
-        self, block_time: Optional[int] = XREADGROUP_BLOCK_MS, count: Optional[int] = XREADGROUP_DEFAULT_COUNT
-    ) -> List[dict]:
+        self, block_time: Optional[int] = XREADGROUP_BLOCK_MS, count: int = XREADGROUP_DEFAULT_COUNT
+    ) -> List[Tuple[str, dict]]:
+        """Read at most `count` new messages, return them with their stream names.
+
+        The count is shared among the streams by their weights, the share of a drained stream goes to the streams which
+        still have a backlog. The streams are only blocked on when all of them are empty.
+        """
+        if len(self._stream_names) == 1:
+            return await self._read_streams(streams=self._stream_names, count=count, block_time=block_time)
+
+        counts = self._stream_read_shares.allocate(count)
+        messages_by_stream = await self._read_streams_by_counts(counts)
+        received_count = sum(len(messages) for messages in messages_by_stream.values())
+        # a stream returning its whole share may have more messages, a stream returning less is drained
+        backlogged_stream_names = [
+            stream_name for stream_name, messages in messages_by_stream.items() if len(messages) >= counts[stream_name]
+        ]
+        if received_count < count and backlogged_stream_names:
+            extra_messages_by_stream = await self._read_streams_by_counts(
+                self._stream_read_shares.allocate(count - received_count, names=backlogged_stream_names)
+            )
+            for stream_name, messages in extra_messages_by_stream.items():
+                messages_by_stream[stream_name].extend(messages)
+
+        results = [
+            (stream_name, message)
+            for stream_name in self._stream_names
+            for message in messages_by_stream.get(stream_name, [])
+        ]
+        if results:
+            return results
+        return await self._read_streams(streams=self._stream_names, count=XREADGROUP_DEFAULT_COUNT, block_time=block_time)
+
+    async def _read_streams(
+        self, streams: List[str], count: int, block_time: Optional[int] = None
+    ) -> List[Tuple[str, dict]]:
+        """Read at most `count` new messages from each of the streams by one XREADGROUP."""
         new_messages = await self._redis_connection.xreadgroup(
             groupname=self._consumer_group_name,
             consumername=self._consumer_name,
-            streams={self._stream_name: XREADGROUP_SPECIAL_ID},
+            streams={stream_name: XREADGROUP_SPECIAL_ID for stream_name in streams},
             count=count,
             block=block_time,
         )
         results = []
-        for queue_messages in new_messages:
-            _, messages, *_ = queue_messages
-            results.extend(messages)
+        for queue_messages in new_messages or []:
+            stream_name, messages, *_ = queue_messages
+            results.extend((stream_name, message) for message in messages)
 
         return results
 
-    async def _ack_message(self, message_id: str):
-        try:
-            await self._redis_connection.xack(self._stream_name, self._consumer_group_name, message_id)
-            logger.info(f"Acknowledged message({message_id}).")
-        except Exception as e:
-            logger.error(f"Failed to acknowledge message({message_id}), error:{e}")
+    async def _read_streams_by_counts(self, counts: Dict[str, int]) -> Dict[str, List[dict]]:
+        """Read new messages from the streams without blocking, each stream with its own count, in one round trip."""
+        counts = {stream_name: count for stream_name, count in counts.items() if count > 0}
+        pipeline = self._redis_connection.pipeline(transaction=False)
+        for stream_name, count in counts.items():
+            pipeline.xreadgroup(
+                groupname=self._consumer_group_name,
+                consumername=self._consumer_name,
+                streams={stream_name: XREADGROUP_SPECIAL_ID},
+                count=count,
+            )
+        responses = await pipeline.execute()
+
+        messages_by_stream: Dict[str, List[dict]] = {stream_name: [] for stream_name in counts}
+        for stream_name, response in zip(counts, responses):
+            for _, messages, *_ in response or []:
+                messages_by_stream[stream_name].extend(messages)
+        return messages_by_stream
+
+    async def _ack_message(self, stream_name: str, message_id: str):
+        """Buffer the acknowledgement, it is flushed with others by the ack flusher."""
+        self._pending_ack_message_ids[stream_name].append(message_id)
+        self._ack_buffered.set()
+        if self._pending_ack_count >= self._ack_batch_size:
+            self._ack_batch_full.set()
+
+    @property
+    def _pending_ack_count(self) -> int:
+        return sum(len(message_ids) for message_ids in self._pending_ack_message_ids.values())
+
+    async def _flush_acks_periodically(self):
+        """The ack flusher, flushes the buffered acknowledgements when the batch is full or every `ack_flush_interval`.
+
+        It sleeps until an acknowledgement is buffered, so an idle consumer does not wake up every interval.
+        """
+        while True:
+            await self._ack_buffered.wait()
+            try:
+                await asyncio.wait_for(self._ack_batch_full.wait(), timeout=self._ack_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._ack_batch_full.clear()
+            if not await self._flush_acks():
+                # keep the event set, the remaining ids are retried after backing off, so an outage is not hammered
+                await asyncio.sleep(ACK_FLUSH_RETRY_INTERVAL)
+                continue
+            if self._pending_ack_count == 0:
+                self._ack_buffered.clear()
+
+    async def _flush_acks(self) -> bool:
+        """Flush the buffered acknowledgements, return False if a flush failed and its ids are kept for the next one."""
+        is_flushed = True
+        for stream_name, pending_ack_message_ids in self._pending_ack_message_ids.items():
+            while pending_ack_message_ids:
+                # the ids are removed after XACK succeeded, so they are retried if the flush fails or is cancelled
+                message_ids = pending_ack_message_ids[: self._ack_batch_size]
+                try:
+                    await self._redis_connection.xack(stream_name, self._consumer_group_name, *message_ids)
+                except Exception as e:
+                    logger.error(f"Failed to acknowledge {len(message_ids)} message(s) of stream({stream_name}), error:{e}")
+                    is_flushed = False
+                    break
+                del pending_ack_message_ids[: len(message_ids)]
+                self._processed_count += len(message_ids)
+                logger.debug(f"Acknowledged {len(message_ids)} message(s) of stream({stream_name}).")
+        return is_flushed
 
-    async def _on_start(self, task: Task):
-        logger.info(f"Task id: {task.id} started.")
+    async def _on_start(self, task: Task) -> Optional[Task]:
+        """Claim the task from PENDING to PROCESSING, return None if the task is not PENDING anymore."""
         async with get_db_session_context_manager() as db:
-            await crud_task.update_task(
-                db=db,
-                task_id=task.id,
-                status=TaskStatus.PROCESSING,
-                started_at=get_utc_now_without_timezone(),
-            )
+            claimed_task = await crud_task.claim_task(db=db, task_id=task.id, started_at=get_utc_now_without_timezone())
+        if claimed_task is not None:
+            logger.info(f"Task id: {task.id} started.")
+            await self._on_tasks_committed([claimed_task])
+        return claimed_task
 
     async def _on_finish(self, task: Task):
         logger.info(f"Task id: {task.id} finished.")
+        await self._update_task_status(
+            task=task,
+            status=TaskStatus.COMPLETED,
+            ended_at=get_utc_now_without_timezone(),
+        )
+
+    async def _on_cancel(self, task: Task):
+        logger.info(f"Task id: {task.id} cancelled.")
         async with get_db_session_context_manager() as db:
-            await crud_task.update_task(
-                db=db,
-                task_id=task.id,
-                status=TaskStatus.COMPLETED,
-                ended_at=get_utc_now_without_timezone(),
-            )
+            try:
+                cancelled_task = await crud_task.update_task(
+                    db=db,
+                    task_id=task.id,
+                    status=TaskStatus.CANCELED,
+                    ended_at=get_utc_now_without_timezone(),
+                    current_status_list=[TaskStatus.PROCESSING, TaskStatus.CANCELED],
+                )
+            except EntryWithIDNotExist:
+                logger.warning(f"The task: {task.id} is not {TaskStatus.CANCELED.value} anymore, skip updating it")
+                return
+        await self._on_tasks_committed([cancelled_task])
 
     async def _on_error(self, task: Task, error: Exception):
         logger.warning(f"Task id: {task.id} raised an error: {error.__class__.__name__} {error}.")
+        await self._update_task_status(
+            task=task,
+            status=TaskStatus.FAILED,
+            ended_at=get_utc_now_without_timezone(),
+            error_message=str(error),
+            error_code=getattr(error, "code", 1),
+        )
+
+    async def _on_retry(self, stream_name: str, task_payload: dict, task: Task, error: Exception, delay: float):
+        """Move the task back to PENDING and publish its message again after `delay` seconds.
+
+        A task cancelled in the meantime is not retried. If the message cannot be scheduled, the error is raised and the
+        call can be repeated, the task is PENDING so it is claimed again if the message is reclaimed instead.
+        """
+        attempt = get_message_attempt(task_payload) + 1
+        logger.warning(
+            f"Task id: {task.id} raised an error: {error.__class__.__name__} {error}, retry #{attempt} in {delay:.1f}s."
+        )
+        async with get_db_session_context_manager() as db:
+            try:
+                pending_task = await crud_task.update_task(
+                    db=db,
+                    task_id=task.id,
+                    status=TaskStatus.PENDING,
+                    # PENDING if a previous call committed it but failed to schedule the message
+                    current_status_list=[TaskStatus.PROCESSING, TaskStatus.PENDING],
+                )
+            except EntryWithIDNotExist:
+                logger.warning(f"The task: {task.id} is not {TaskStatus.PROCESSING.value} anymore, skip retrying it")
+                return
+        await self._on_tasks_committed([pending_task])
+        await schedule_message(
+            redis=self._redis_connection,  # type: ignore
+            delayed_queue_name=self._delayed_queue_name,  # type: ignore
+            queue_name=stream_name,
+            message=build_retry_message(task_payload, attempt=attempt),
+            run_at=get_utc_now_without_timezone() + timedelta(seconds=delay),
+        )
+
+    def _get_retry_delay(self, handler: Optional[BaseHandler], task_payload: dict) -> Optional[float]:
+        """Return the delay before retrying the failed task by the retry policy of its handler, None for no retry."""
+        if handler is None or handler.retry_policy is None or not self._delayed_queue_name:
+            return None
+        return handler.retry_policy.get_delay(get_message_attempt(task_payload))
+
+    async def _fail_task(
+        self,
+        task_id: str,
+        error: Exception,
+        current_status_list: Tuple[TaskStatus, ...] = (TaskStatus.PENDING, TaskStatus.PROCESSING),
+    ):
+        """Fail a task in `current_status_list` which is not handled, e.g. its message is undeliverable."""
         async with get_db_session_context_manager() as db:
-            await crud_task.update_task(
-                db=db,
-                task_id=task.id,
-                status=TaskStatus.FAILED,
-                ended_at=get_utc_now_without_timezone(),
-                error_message=str(error),
-                error_code=getattr(error, "code", 1),
+            try:
+                failed_task = await crud_task.update_task(
+                    db=db,
+                    task_id=task_id,
+                    status=TaskStatus.FAILED,
+                    ended_at=get_utc_now_without_timezone(),
+                    error_message=str(error),
+                    error_code=getattr(error, "code", 1),
+                    current_status_list=list(current_status_list),
+                )
+            except EntryWithIDNotExist:
+                logger.warning(f"The task: {task_id} is finished already, skip failing it")
+                return
+        await self._on_tasks_committed([failed_task])
+
+    async def _update_task_status(
+        self,
+        task: Task,
+        status: TaskStatus,
+        ended_at: datetime,
+        error_message: Optional[str] = None,
+        error_code: Optional[int] = None,
+    ):
+        """Write the terminal status of a PROCESSING task, returns after it is committed.
+
+        The write-behind writer is used if there is one. A task cancelled in the meantime is kept CANCELED.
+        The committed task is written through to the cache, or removed from it if the writer does not return it.
+        """
+        if self._status_writer:
+            is_updated = await self._status_writer.write(
+                id=task.id,
+                status=status,
+                ended_at=ended_at,
+                error_message=error_message,
+                error_code=error_code,
             )
+            await self._invalidate_cached_tasks([task.id])
+            if is_updated and self._status_events_enabled:
+                await self._publish_status_events([build_task_status_event(task_id=task.id, status=status, type=task.type)])
+            return
+
+        async with get_db_session_context_manager() as db:
+            try:
+                updated_task = await crud_task.update_task(
+                    db=db,
+                    task_id=task.id,
+                    status=status,
+                    ended_at=ended_at,
+                    error_message=error_message,
+                    error_code=error_code,
+                    current_status_list=[TaskStatus.PROCESSING],
+                )
+            except EntryWithIDNotExist:
+                logger.warning(f"The task: {task.id} is not {TaskStatus.PROCESSING.value} anymore, skip updating it")
+                return
+        await self._on_tasks_committed([updated_task])
+
+    async def _on_tasks_committed(self, tasks: List[Task]):
+        """Write the committed tasks through to the cache and publish their status transitions."""
+        await self._cache_tasks(tasks)
+        if self._status_events_enabled:
+            await self._publish_status_events(
+                [build_task_status_event(task_id=task.id, status=task.status, type=task.type) for task in tasks]
+            )
+
+    async def _cache_tasks(self, tasks: List[Task]):
+        """Write the committed tasks through to the cache, a failure only leaves the cache stale until it expires."""
+        if not self._status_cache_enabled:
+            return
+        try:
+            await cache_tasks(redis=self._redis_connection, tasks=tasks)
+        except Exception as e:
+            logger.error(f"TaskConsumer: Failed to cache {len(tasks)} task(s), error: {e}")
+
+    async def _publish_status_events(self, events: List[TaskStatusEvent]):
+        """Publish the status transitions, a failure only delays the streaming clients until they read the task."""
+        try:
+            await publish_task_status_events(redis=self._redis_connection, events=events)
+        except Exception as e:
+            logger.error(f"TaskConsumer: Failed to publish {len(events)} task status event(s), error: {e}")
+
+    async def _invalidate_cached_tasks(self, task_ids: List[str]):
+        if not self._status_cache_enabled:
+            return
+        try:
+            await invalidate_cached_tasks(redis=self._redis_connection, task_ids=task_ids)
+        except Exception as e:
+            logger.error(f"TaskConsumer: Failed to invalidate {len(task_ids)} cached task(s), error: {e}")
+
+    async def _run_handler(self, handler: BaseHandler, task: Task):
+        """Run the handler as a cancellable future, so a cancellation of the task stops it immediately.
+
+        Raises:
+            TaskTimeoutError: The handler is cancelled because it exceeded the deadline of the task.
+        """
+        timeout = self._get_task_timeout(handler, task)
+        running_handler = asyncio.ensure_future(handler.handle(task))
+        self._running_handlers[task.id] = running_handler
+        try:
+            await asyncio.wait_for(running_handler, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise TaskTimeoutError(timeout=timeout)  # type: ignore
+        finally:
+            self._running_handlers.pop(task.id, None)
+
+    @staticmethod
+    def _get_task_timeout(handler: BaseHandler, task: Task) -> Optional[float]:
+        """Return the deadline in seconds from the task parameters, or from the handler if the task does not set it."""
+        timeout = (task.parameters or {}).get(TASK_TIMEOUT_PARAMETER_NAME)
+        if timeout is None:
+            return handler.timeout
+        try:
+            timeout = float(timeout)
+            if timeout <= 0:
+                raise ValueError(timeout)
+        except (TypeError, ValueError):
+            logger.warning(f"The task: {task.id} has an invalid {TASK_TIMEOUT_PARAMETER_NAME}: {timeout}, ignore it")
+            return handler.timeout
+        return timeout
+
+    async def _write_outcome(
+        self,
+        stream_name: str,
+        message_id: str,
+        task_payload: dict,
+        task: Task,
+        handler: Optional[BaseHandler],
+        is_cancelled: bool,
+        handler_error: Optional[Exception],
+    ):
+        """Write the outcome of the handled task, the writes are conditional so a failed call can be repeated."""
+        if is_cancelled:
+            await self._on_cancel(task)
+        elif handler_error is not None:
+            retry_delay = self._get_retry_delay(handler, task_payload)
+            if retry_delay is not None:
+                await self._on_retry(stream_name, task_payload, task, handler_error, retry_delay)
+            else:
+                await self._on_error(task, handler_error)
+                await self._dead_letter(stream_name, message_id, task_payload, handler_error)
+        else:
+            await self._on_finish(task)
 
     async def _process_message(
         self,
+        stream_name: str,
         message: dict,
+        is_reclaimed: bool = False,
     ):
+        """Claim and handle the task of the message, and ack the message after the outcome is written.
+
+        A reclaimed message of a PROCESSING task was left by a consumer which stopped handling it, e.g. it crashed or
+        failed to write the outcome, so the task is failed instead of being left PROCESSING forever.
+        """
+        message_id = None
         try:
             message_id, task_payload = message
-            async with get_db_session_context_manager() as db:
-                self._task = await crud_task.get_task(db=db, id=task_payload["task_id"])
-            if self._task.status == TaskStatus.PENDING:
+            self._in_flight_message_ids[stream_name].add(message_id)
+            task = parse_task_message(task_payload) or Task(id=task_payload["task_id"])
+            # the claim returns the whole row, so a legacy message does not need another read
+            claimed_task = await self._on_start(task)
+            if claimed_task is None:
+                logger.warning(f"The task: {task.id} is not {TaskStatus.PENDING.value}, skip it")
+                if is_reclaimed:
+                    await self._fail_task(task_id=task.id, error=TaskAbandoned(), current_status_list=(TaskStatus.PROCESSING,))
+            else:
+                task = claimed_task
+                is_cancelled = False
+                handler_error: Optional[Exception] = None
+                handler: Optional[BaseHandler] = None
                 try:
-                    handler = self._task_handlers.get(self._task.type)
+                    handler = self._task_handlers.get(task.type)
                     if not handler:
-                        logger.error(f"TaskConsumer: Failed to get handler for task type: {self._task.type}")
-                        raise Exception(f"TaskConsumer: Failed to get handler for task type: {self._task.type}")
-                    await self._on_start(self._task)
+                        logger.error(f"TaskConsumer: Failed to get handler for task type: {task.type}")
+                        raise Exception(f"TaskConsumer: Failed to get handler for task type: {task.type}")
                     start_time = time.time()
-                    await handler.handle(self._task)
-                    logger.info(
-                        f"TaskConsumer: Task id: {self._task.id} finished, time elapsed: " f"{time.time() - start_time }s"
-                    )
-                    await self._on_finish(self._task)
+                    await self._run_handler(handler, task)
+                    elapsed = time.time() - start_time
+                    self._read_count.observe_latency(elapsed)
+                    logger.info(f"TaskConsumer: Task id: {task.id} finished, time elapsed: " f"{elapsed}s")
+                except asyncio.CancelledError:
+                    if task.id not in self._cancelled_task_ids:
+                        raise
+                    is_cancelled = True
                 except Exception as e:
-                    await self._on_error(self._task, e)
-            else:
-                logger.warning(f"The task: {self._task.id} is in {self._task.status}, skip it")
-            await self._ack_message(message_id)
+                    handler_error = e
+                finally:
+                    self._cancelled_task_ids.discard(task.id)
+
+                # a failed status write is not an error of the task, it is retried, then the message is left unacked
+                for retried_count in range(STATUS_WRITE_MAX_RETRY_COUNT + 1):
+                    try:
+                        await self._write_outcome(
+                            stream_name, message_id, task_payload, task, handler, is_cancelled, handler_error
+                        )
+                        break
+                    except Exception as e:
+                        if retried_count >= STATUS_WRITE_MAX_RETRY_COUNT:
+                            logger.error(
+                                f"TaskConsumer: Failed to write the status of task id: {task.id} after {retried_count} "
+                                f"retries, leave the message unacked, error: {e}"
+                            )
+                            return
+                        logger.warning(f"TaskConsumer: Failed to write the status of task id: {task.id}, error: {e}")
+                        await asyncio.sleep(STATUS_WRITE_RETRY_INTERVAL * 2**retried_count)
+            await self._ack_message(stream_name=stream_name, message_id=message_id)
         except Exception as e:
             logger.error(f"TaskConsumer: Failed to process message: {message}, error:{e}")
+        finally:
+            self._in_flight_message_ids[stream_name].discard(message_id)  # type: ignore
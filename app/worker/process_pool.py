@@ -0,0 +1,176 @@
+import asyncio
+import multiprocessing
+import os
+import weakref
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, List, Optional, Set
+
+from app.core.config import settings
+from app.utils.logging.logger import get_logger
+
+DEFAULT_MAX_TASKS_PER_CHILD = 1000
+# spawn the children instead of forking them, so they do not inherit the event loop, db and redis connections
+PROCESS_START_METHOD = "spawn"
+
+logger = get_logger()
+
+_shared_process_pool: Optional["TaskProcessPool"] = None
+
+
+class TaskProcessPool:
+    """A warm process pool running the CPU-bound part of the tasks out of the event loop.
+
+    All the children are spawned by `start`, so the first tasks do not pay for the process startup. The pool is
+    replaced by a new warm one after about `max_tasks_per_child` tasks per child, the old children exit after finishing
+    their tasks, this keeps the memory leaked by the handlers bounded. A broken pool (e.g. a child killed by OOM) is
+    replaced as well. The functions and their arguments are pickled, pass plain data instead of ORM objects.
+
+    A running call cannot be stopped in its child, so when its caller is cancelled (e.g. the task timed out) the pool is
+    replaced as well, and the children of the old pool are terminated once the other calls awaited in them finish.
+
+    The pool can be shared by the handlers of several consumers, every `start` should be paired with a `stop`, and the
+    children are only stopped by the last `stop`, so a consumer stopping first does not stop the pool under the others.
+    """
+
+    def __init__(self, size: Optional[int] = None, max_tasks_per_child: int = DEFAULT_MAX_TASKS_PER_CHILD):
+        """
+        Args:
+            size: The number of children, None means the number of CPUs.
+            max_tasks_per_child: The pool is recycled after it ran `size * max_tasks_per_child` tasks.
+        """
+        size = size or os.cpu_count() or 1
+        if size < 1:
+            raise ValueError(f"size should be greater than 0, got {size}")
+        if max_tasks_per_child < 1:
+            raise ValueError(f"max_tasks_per_child should be greater than 0, got {max_tasks_per_child}")
+
+        self._size = size
+        self._max_task_count = size * max_tasks_per_child
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._submitted_count = 0
+        self._start_lock = asyncio.Lock()
+        self._user_count = 0
+        self._recycler: Optional[asyncio.Task] = None
+        # the futures still awaited by the callers of each pool, and the pools running the abandoned calls
+        self._awaited_futures: "weakref.WeakKeyDictionary[ProcessPoolExecutor, Set[Future]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._abandoned_executors: "weakref.WeakSet[ProcessPoolExecutor]" = weakref.WeakSet()
+        self._executor_processes: "weakref.WeakKeyDictionary[ProcessPoolExecutor, List[multiprocessing.Process]]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    async def start(self):
+        """Spawn the children, do nothing but counting the user if the pool is started already."""
+        self._user_count += 1
+        await self._start_executor()
+
+    async def stop(self):
+        """Release the pool, the last user waits for the running tasks and stops the children."""
+        self._user_count = max(self._user_count - 1, 0)
+        if self._user_count > 0:
+            return
+        if self._recycler is not None:
+            await asyncio.gather(self._recycler, return_exceptions=True)
+            self._recycler = None
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Run `func(*args)` in a child process and return its result, `func` should be a module level function.
+
+        If the caller is cancelled after a child started running the function, the child is terminated once the other
+        calls in the same pool finish, the new calls are run by a new pool in the meantime.
+        """
+        if self._executor is None:
+            await self._start_executor()
+        if self._submitted_count >= self._max_task_count and self._recycler is None:
+            self._recycler = asyncio.create_task(self._recycle())
+
+        executor: ProcessPoolExecutor = self._executor  # type: ignore
+        self._submitted_count += 1
+        future = executor.submit(func, *args)
+        awaited_futures = self._awaited_futures.setdefault(executor, set())
+        awaited_futures.add(future)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                logger.warning("TaskProcessPool: A running call is cancelled, replace the process pool running it.")
+                self._abandoned_executors.add(executor)
+                if self._executor is executor and self._recycler is None:
+                    self._recycler = asyncio.create_task(self._recycle())
+            raise
+        except BrokenProcessPool:
+            logger.error("TaskProcessPool: The process pool is broken, replace it.")
+            if self._executor is executor and self._recycler is None:
+                self._recycler = asyncio.create_task(self._recycle())
+            raise
+        finally:
+            awaited_futures.discard(future)
+            self._terminate_if_abandoned(executor)
+
+    async def _start_executor(self):
+        async with self._start_lock:
+            if self._executor is None:
+                self._executor = await self._create_executor()
+                logger.info(f"TaskProcessPool: Started {self._size} process(es).")
+
+    async def _create_executor(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(
+            max_workers=self._size,
+            mp_context=multiprocessing.get_context(PROCESS_START_METHOD),
+        )
+        loop = asyncio.get_running_loop()
+        # every submission spawns one more child until the pool is full, wait for all of them to be ready
+        await asyncio.gather(*[loop.run_in_executor(executor, os.getpid) for _ in range(self._size)])
+        # ProcessPoolExecutor has no API to stop a running call, keep the children to terminate them if needed
+        self._executor_processes[executor] = list(getattr(executor, "_processes", {}).values())
+        return executor
+
+    async def _recycle(self):
+        try:
+            executor = await self._create_executor()
+        except Exception as e:
+            logger.error(f"TaskProcessPool: Failed to recycle the process pool, error: {e}")
+            return
+        finally:
+            self._recycler = None
+
+        old_executor, self._executor = self._executor, executor
+        self._submitted_count = 0
+        if old_executor is not None:
+            self._terminate_if_abandoned(old_executor)
+            # the tasks submitted to the old pool keep running, its children exit after they finish
+            old_executor.shutdown(wait=False)
+        logger.info(f"TaskProcessPool: Recycled {self._size} process(es).")
+
+    def _terminate_if_abandoned(self, executor: ProcessPoolExecutor):
+        """Terminate the children of a replaced pool running abandoned calls, once no caller awaits that pool."""
+        if executor is self._executor or executor not in self._abandoned_executors:
+            return
+        if self._awaited_futures.get(executor):
+            return
+        self._abandoned_executors.discard(executor)
+        processes = getattr(executor, "_processes", None) or {}
+        for process in {*self._executor_processes.pop(executor, []), *processes.values()}:
+            process.terminate()
+        executor.shutdown(wait=False)
+        logger.info("TaskProcessPool: Terminated the process(es) running the abandoned calls.")
+
+
+def get_shared_process_pool() -> TaskProcessPool:
+    """The process pool shared by the handlers of this process, created by the settings."""
+    global _shared_process_pool
+    if _shared_process_pool is None:
+        _shared_process_pool = TaskProcessPool(
+            size=settings.WORKER_PROCESS_POOL_SIZE,
+            max_tasks_per_child=settings.WORKER_PROCESS_POOL_MAX_TASKS_PER_CHILD,
+        )
+    return _shared_process_pool
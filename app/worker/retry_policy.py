@@ -0,0 +1,40 @@
+import random
+from typing import Optional
+
+DEFAULT_RETRY_BASE_DELAY_SECONDS = 1
+DEFAULT_RETRY_MAX_DELAY_SECONDS = 300
+DEFAULT_RETRY_JITTER = 0.1
+
+
+class RetryPolicy:
+    """Retry a failed task after an exponential backoff, until it failed `max_retries + 1` times.
+
+    The delay before the n-th retry (starting from 0) is `base_delay * 2**n` capped by `max_delay`, spread by `jitter`,
+    so the tasks failed together by an outage are not retried together.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 0,
+        base_delay: float = DEFAULT_RETRY_BASE_DELAY_SECONDS,
+        max_delay: float = DEFAULT_RETRY_MAX_DELAY_SECONDS,
+        jitter: float = DEFAULT_RETRY_JITTER,
+    ):
+        if max_retries < 0:
+            raise ValueError(f"max_retries should not be negative, got {max_retries}")
+        if base_delay < 0 or max_delay < base_delay:
+            raise ValueError(f"0 <= base_delay <= max_delay is required, got {base_delay} and {max_delay}")
+        if not 0 <= jitter < 1:
+            raise ValueError(f"jitter should be in [0, 1), got {jitter}")
+
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def get_delay(self, attempt: int) -> Optional[float]:
+        """Return the delay in seconds before retrying a task failed at `attempt`, None if it should not be retried."""
+        if attempt >= self.max_retries:
+            return None
+        delay = min(self.base_delay * 2**attempt, self.max_delay)
+        return delay * random.uniform(1 - self.jitter, 1)
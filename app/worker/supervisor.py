@@ -0,0 +1,133 @@
+import multiprocessing
+import signal
+import time
+from multiprocessing.sharedctypes import Synchronized
+from typing import Callable, List, Optional
+
+from app.utils.logging.logger import get_logger
+
+SUPERVISE_INTERVAL_SECONDS = 1
+DEFAULT_REPORT_INTERVAL_SECONDS = 30
+DEFAULT_DRAIN_TIMEOUT_SECONDS = 60
+MIN_RESTART_INTERVAL_SECONDS = 1
+MAX_RESTART_INTERVAL_SECONDS = 60
+
+logger = get_logger()
+
+
+class WorkerProcess:
+    """The state of a consumer process owned by the supervisor."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[multiprocessing.Process] = None
+        self.processed_counter: Synchronized = multiprocessing.Value("Q", 0)  # type: ignore
+        self.restart_count = 0
+        self.crash_streak = 0
+        self.started_time = 0.0
+        self.next_start_time = 0.0
+        self.reported_count = 0
+        self.reported_time = time.time()
+
+
+class WorkerSupervisor:
+    """Fork and supervise N consumer processes sharing one configuration.
+
+    The target is called as `target(index, processed_counter)` in every child process, the child should add the number
+    of processed messages to `processed_counter` so the supervisor can report the per-process throughput.
+    Crashed children are restarted with an exponential backoff, SIGTERM and SIGINT are forwarded to children as SIGTERM
+    so they can drain their in-flight tasks, children still alive after `drain_timeout` seconds are killed.
+    """
+
+    def __init__(
+        self,
+        target: Callable[[int, Synchronized], None],
+        process_count: int,
+        report_interval: float = DEFAULT_REPORT_INTERVAL_SECONDS,
+        drain_timeout: float = DEFAULT_DRAIN_TIMEOUT_SECONDS,
+    ):
+        if process_count < 1:
+            raise ValueError(f"process_count should be greater than 0, got {process_count}")
+
+        self._target = target
+        self._workers: List[WorkerProcess] = [WorkerProcess(index=index) for index in range(process_count)]
+        self._report_interval = report_interval
+        self._drain_timeout = drain_timeout
+        self._is_stopping = False
+
+    def run(self):
+        """Start the children and supervise them until SIGTERM or SIGINT is received."""
+        signal.signal(signal.SIGTERM, self._on_stop_signal)
+        signal.signal(signal.SIGINT, self._on_stop_signal)
+        logger.info(f"WorkerSupervisor: Start {len(self._workers)} worker process(es).")
+        last_report_time = time.time()
+        while not self._is_stopping:
+            for worker in self._workers:
+                self._supervise(worker)
+            if time.time() - last_report_time >= self._report_interval:
+                self._report_throughput()
+                last_report_time = time.time()
+            time.sleep(SUPERVISE_INTERVAL_SECONDS)
+
+        self._drain()
+
+    def _on_stop_signal(self, signum, frame):
+        logger.info(f"WorkerSupervisor: Received signal {signal.Signals(signum).name}, draining worker processes.")
+        self._is_stopping = True
+
+    def _supervise(self, worker: WorkerProcess):
+        if worker.process is not None:
+            if worker.process.is_alive():
+                return
+            logger.error(
+                f"WorkerSupervisor: Worker process #{worker.index}(pid: {worker.process.pid}) exited "
+                f"with code {worker.process.exitcode}, restart it."
+            )
+            worker.process = None
+            worker.restart_count += 1
+            # back off only when the process keeps crashing shortly after it started
+            if time.time() - worker.started_time > MAX_RESTART_INTERVAL_SECONDS:
+                worker.crash_streak = 0
+            restart_interval = min(MIN_RESTART_INTERVAL_SECONDS * 2**worker.crash_streak, MAX_RESTART_INTERVAL_SECONDS)
+            worker.crash_streak += 1
+            worker.next_start_time = time.time() + restart_interval
+
+        if time.time() >= worker.next_start_time:
+            worker.process = multiprocessing.Process(
+                target=self._target,
+                args=(worker.index, worker.processed_counter),
+                name=f"task_worker_{worker.index}",
+                daemon=False,
+            )
+            worker.process.start()
+            worker.started_time = time.time()
+            logger.info(f"WorkerSupervisor: Worker process #{worker.index}(pid: {worker.process.pid}) started.")
+
+    def _report_throughput(self):
+        now = time.time()
+        for worker in self._workers:
+            processed_count = worker.processed_counter.value
+            elapsed = max(now - worker.reported_time, 1e-6)
+            logger.info(
+                f"WorkerSupervisor: Worker process #{worker.index}"
+                f"(pid: {worker.process.pid if worker.process else None}, restarts: {worker.restart_count}) "
+                f"processed {processed_count} task(s), {(processed_count - worker.reported_count) / elapsed:.2f} tasks/s."
+            )
+            worker.reported_count = processed_count
+            worker.reported_time = now
+
+    def _drain(self):
+        processes = [worker.process for worker in self._workers if worker.process is not None and worker.process.is_alive()]
+        for process in processes:
+            process.terminate()
+
+        deadline = time.time() + self._drain_timeout
+        for process in processes:
+            process.join(timeout=max(deadline - time.time(), 0))
+            if process.is_alive():
+                logger.error(f"WorkerSupervisor: Worker process(pid: {process.pid}) did not drain in time, kill it.")
+                process.kill()
+                process.join()
+
+        self._report_throughput()
+        logger.info("WorkerSupervisor: All worker processes stopped.")
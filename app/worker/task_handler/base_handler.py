@@ -1,9 +1,28 @@
+from typing import Optional
+
 from app.database.models.task import Task as TaskModel
+from app.worker.retry_policy import RetryPolicy
 
 
 class BaseHandler:
     """Base worker class for running tasks."""
 
+    def __init__(self, timeout: Optional[float] = None, retry_policy: Optional[RetryPolicy] = None):
+        """
+        Args:
+            timeout: The default deadline in seconds of the tasks handled by this handler, None means no deadline.
+                A task can override it by the parameter `TASK_TIMEOUT_PARAMETER_NAME`.
+            retry_policy: The retries of the failed tasks handled by this handler, None means no retry.
+        """
+        self.timeout = timeout
+        self.retry_policy = retry_policy
+
+    async def start(self):
+        """Prepare the resources of the handler, called once before the consumer starts."""
+
+    async def stop(self):
+        """Release the resources of the handler, called once after the consumer drained the in-flight tasks."""
+
     async def handle(self, task: TaskModel):
         """Handle the task, all handlers should implement this."""
         raise NotImplementedError()
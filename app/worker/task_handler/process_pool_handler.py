@@ -0,0 +1,44 @@
+from typing import Any, Dict, Optional
+
+from app.database.models.task import Task as TaskModel
+from app.worker.process_pool import TaskProcessPool, get_shared_process_pool
+from app.worker.retry_policy import RetryPolicy
+from app.worker.task_handler.base_handler import BaseHandler
+
+
+class ProcessPoolHandler(BaseHandler):
+    """Base handler for CPU-bound tasks, the synchronous `run` is executed in a process pool.
+
+    Only the task id and parameters are sent to the child process, and only the return value of `run` is sent back,
+    so `run` should be a staticmethod taking and returning plain data.
+    """
+
+    def __init__(
+        self,
+        timeout: Optional[float] = None,
+        pool: Optional[TaskProcessPool] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+    ):
+        """
+        Args:
+            timeout: See `BaseHandler`, a call exceeding the deadline is abandoned, the pool is replaced and the
+                child running it is terminated once the other calls in the old pool finish.
+            pool: The process pool running the tasks, None means the pool shared by the handlers of this process.
+            retry_policy: See `BaseHandler`.
+        """
+        super().__init__(timeout=timeout, retry_policy=retry_policy)
+        self.pool = pool or get_shared_process_pool()
+
+    async def start(self):
+        await self.pool.start()
+
+    async def stop(self):
+        await self.pool.stop()
+
+    async def handle(self, task: TaskModel):
+        return await self.pool.run(type(self).run, task.id, task.parameters or {})
+
+    @staticmethod
+    def run(task_id: str, parameters: Dict[str, Any]) -> Any:
+        """Handle the task in a child process, all process pool handlers should implement this."""
+        raise NotImplementedError()
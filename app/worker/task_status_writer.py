@@ -0,0 +1,103 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.database.crud import task as crud_task
+from app.enum.task import TaskStatus
+from app.middleware.depends import get_db_session_context_manager
+from app.utils.logging.logger import get_logger
+
+DEFAULT_FLUSH_INTERVAL_SECONDS = 0.05
+DEFAULT_FLUSH_SIZE = 200
+FLUSH_RETRY_INTERVAL = 1
+
+logger = get_logger()
+
+
+class TaskStatusWriter:
+    """Write-behind writer of task status transitions.
+
+    The transitions are collected and flushed by one bulk UPDATE every `flush_interval` seconds or every `flush_size`
+    transitions. `write` returns after the transition is committed, so the caller can acknowledge the message safely.
+    Only PROCESSING tasks are updated, so a task cancelled while running is kept CANCELED.
+    """
+
+    def __init__(self, flush_interval: float = DEFAULT_FLUSH_INTERVAL_SECONDS, flush_size: int = DEFAULT_FLUSH_SIZE):
+        if flush_size < 1:
+            raise ValueError(f"flush_size should be greater than 0, got {flush_size}")
+
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        self._pending_updates: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._batch_full = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the background flusher."""
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self):
+        """Stop the background flusher and flush the remaining transitions."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        while self._pending_updates:
+            await self._flush()
+
+    async def write(self, **data: Any) -> bool:
+        """Queue a transition with the fields of `crud_task.bulk_update_tasks`, wait until it is committed.
+        Return False if the task is not updated, it is not PROCESSING anymore.
+
+        Raises:
+            Exception: The error raised by the db when flushing the batch containing this transition.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending_updates.append((data, future))
+        if len(self._pending_updates) >= self._flush_size:
+            self._batch_full.set()
+        return await future
+
+    async def _flush_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_full.clear()
+            while self._pending_updates:
+                if not await self._flush():
+                    # back off, so the writers retrying during an outage do not hammer the db
+                    await asyncio.sleep(FLUSH_RETRY_INTERVAL)
+
+    async def _flush(self) -> bool:
+        """Flush one batch, return False if it failed, its writers get the error."""
+        batch = self._pending_updates[: self._flush_size]
+        del self._pending_updates[: len(batch)]
+        try:
+            async with get_db_session_context_manager() as db:
+                updated_ids = set(
+                    await crud_task.bulk_update_tasks(
+                        db=db,
+                        updates=[data for data, _ in batch],
+                        current_status_list=[TaskStatus.PROCESSING],
+                    )
+                )
+        except Exception as e:
+            logger.error(f"TaskStatusWriter: Failed to flush {len(batch)} task status transition(s), error: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return False
+        except asyncio.CancelledError:
+            # the batch is taken out already, fail the writers instead of leaving them waiting forever
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
+            raise
+
+        logger.debug(f"TaskStatusWriter: Flushed {len(batch)} task status transition(s).")
+        for data, future in batch:
+            if not future.done():
+                future.set_result(data["id"] in updated_ids)
+        return True
@@ -0,0 +1,41 @@
+from typing import Dict, Iterable, Optional
+
+
+class WeightedRoundRobin:
+    """Share read counts among streams in proportion to their weights (smooth weighted round robin).
+
+    Every unit goes to the stream with the highest accumulated credit, then the credit of the chosen stream is lowered
+    by the total weight. The credits are kept between calls, so a stream gets its share over consecutive reads even if
+    each read is small, and every stream is chosen at least once per `sum(weights)` units, it is never starved.
+    """
+
+    def __init__(self, weights: Dict[str, int]):
+        if not weights:
+            raise ValueError("weights should not be empty")
+        for name, weight in weights.items():
+            if weight < 1:
+                raise ValueError(f"The weight of {name} should be greater than 0, got {weight}")
+
+        self._weights = dict(weights)
+        self._credits = {name: 0 for name in weights}
+
+    @property
+    def names(self):
+        """The names in the order of the weights given."""
+        return list(self._weights)
+
+    def allocate(self, count: int, names: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        """Share `count` units among `names`, all names by default, return the units of each name."""
+        names = list(self._weights) if names is None else list(names)
+        allocation = {name: 0 for name in names}
+        if not names:
+            return allocation
+
+        total_weight = sum(self._weights[name] for name in names)
+        for _ in range(count):
+            for name in names:
+                self._credits[name] += self._weights[name]
+            chosen = max(names, key=self._credits.__getitem__)
+            self._credits[chosen] -= total_weight
+            allocation[chosen] += 1
+        return allocation
@@ -1,31 +1,218 @@
+import argparse
 import asyncio
+import functools
+import signal
+from multiprocessing.sharedctypes import Synchronized
+from typing import Dict, List, Optional, Union
 
-from app.const.task import TASK_QUEUE_NAME
+import redis.asyncio as async_redis
+
+from app.const.task import TASK_CANCEL_STREAM_NAME, TASK_DEAD_LETTER_STREAM_NAME
 from app.core.config import settings
-from app.enum.task import TaskType
+from app.enum.task import TaskPriority, TaskType
 from app.utils.logging.logger import get_logger
 from app.utils.redis import setup_redis_connection
+from app.utils.task.queue import get_route_delayed_queue_name, get_route_queue_names, get_task_route
 from app.worker.base_task_consumer import BaseTaskConsumer
+from app.worker.retry_policy import RetryPolicy
+from app.worker.supervisor import WorkerSupervisor
+from app.worker.task_handler.base_handler import BaseHandler
 from app.worker.task_handler.sleep_handler import SleepHandler
+from app.worker.task_status_writer import TaskStatusWriter
+
+PROCESSED_COUNT_SYNC_INTERVAL_SECONDS = 1
 
 logger = get_logger()
 
 
-async def async_main():
+def build_task_handlers() -> Dict[TaskType, BaseHandler]:
+    """Build the handler of every task type."""
+    return {
+        TaskType.SLEEP: SleepHandler(
+            timeout=settings.WORKER_TASK_TIMEOUT_SECONDS.get(TaskType.SLEEP.value),
+            retry_policy=build_retry_policy(TaskType.SLEEP),
+        ),
+    }
+
+
+def build_retry_policy(task_type: TaskType) -> Optional[RetryPolicy]:
+    """Build the retry policy of the task type by the settings, None if it is not retried."""
+    max_retries = settings.WORKER_TASK_MAX_RETRIES.get(task_type.value, 0)
+    if max_retries <= 0:
+        return None
+    return RetryPolicy(
+        max_retries=max_retries,
+        base_delay=settings.WORKER_RETRY_BASE_DELAY_SECONDS,
+        max_delay=settings.WORKER_RETRY_MAX_DELAY_SECONDS,
+    )
+
+
+def build_task_consumers(
+    redis_connection: Union[async_redis.Redis, async_redis.RedisCluster],
+    task_types: List[TaskType],
+    concurrency: int = settings.WORKER_MAX_IN_FLIGHT,
+) -> List[BaseTaskConsumer]:
+    """Build one consumer for every route of the task types, each of them with the concurrency of its route.
+
+    Raises:
+        ValueError: A task type has no handler, or a route has task types not in `task_types`, the consumer of the
+            route could not handle them.
+    """
+    task_handlers = build_task_handlers()
+    route_task_types: Dict[str, List[TaskType]] = {}
+    for task_type in task_types:
+        if task_type not in task_handlers:
+            raise ValueError(f"No handler for the task type: {task_type.value}")
+        route_task_types.setdefault(get_task_route(task_type), []).append(task_type)
+
+    task_consumers = []
+    for route, route_types in route_task_types.items():
+        missing_types = [
+            task_type.value for task_type in TaskType if get_task_route(task_type) == route and task_type not in route_types
+        ]
+        if missing_types:
+            raise ValueError(f"The task types {missing_types} of the route: {route} should be handled by the worker as well")
+
+        queue_names = get_route_queue_names(route)
+        task_consumers.append(
+            BaseTaskConsumer(
+                redis_connection=redis_connection,
+                queue_name=queue_names[TaskPriority.NORMAL],
+                task_handlers={task_type: task_handlers[task_type] for task_type in route_types},
+                max_in_flight=settings.WORKER_ROUTE_MAX_IN_FLIGHT.get(route, concurrency),
+                max_read_count=settings.WORKER_MAX_READ_COUNT,
+                reclaim_interval=settings.WORKER_RECLAIM_INTERVAL_SECONDS,
+                reclaim_batch_size=settings.WORKER_RECLAIM_BATCH_SIZE,
+                ack_batch_size=settings.WORKER_ACK_BATCH_SIZE,
+                ack_flush_interval=settings.WORKER_ACK_FLUSH_INTERVAL_SECONDS,
+                status_writer=(
+                    TaskStatusWriter(
+                        flush_interval=settings.WORKER_STATUS_FLUSH_INTERVAL_SECONDS,
+                        flush_size=settings.WORKER_STATUS_FLUSH_SIZE,
+                    )
+                    if settings.WORKER_STATUS_WRITE_BEHIND
+                    else None
+                ),
+                cancel_stream_name=TASK_CANCEL_STREAM_NAME,
+                min_idle_time=settings.WORKER_MIN_IDLE_TIME_MS,
+                task_min_idle_times={
+                    TaskType(task_type): min_idle_time
+                    for task_type, min_idle_time in settings.WORKER_TASK_MIN_IDLE_TIME_MS.items()
+                },
+                lease_interval=settings.WORKER_LEASE_INTERVAL_SECONDS,
+                queue_weights={
+                    queue_names[TaskPriority(priority)]: weight for priority, weight in settings.WORKER_QUEUE_WEIGHTS.items()
+                },
+                delayed_queue_name=get_route_delayed_queue_name(route),
+                promote_interval=settings.WORKER_PROMOTE_INTERVAL_SECONDS,
+                promote_batch_size=settings.WORKER_PROMOTE_BATCH_SIZE,
+                dead_letter_stream_name=TASK_DEAD_LETTER_STREAM_NAME,
+                max_delivery_count=settings.WORKER_MAX_DELIVERY_COUNT,
+                trim_interval=settings.WORKER_TRIM_INTERVAL_SECONDS,
+                status_cache_enabled=settings.TASK_STATUS_CACHE_ENABLED,
+                status_events_enabled=settings.TASK_STATUS_EVENTS_ENABLED,
+            )
+        )
+    return task_consumers
+
+
+async def async_main(
+    concurrency: int = settings.WORKER_MAX_IN_FLIGHT,
+    processed_counter: Optional[Synchronized] = None,
+    task_types: Optional[List[TaskType]] = None,
+):
     logger.info("Start API Server worker")
-    task_consumer = BaseTaskConsumer(
+    task_consumers = build_task_consumers(
         redis_connection=setup_redis_connection(
             host=settings.REDIS_HOST,
             port=settings.REDIS_PORT,
             is_cluster=settings.IS_REDIS_CLUSTER,
         ),
-        queue_name=TASK_QUEUE_NAME,
-        task_handlers={
-            TaskType.SLEEP: SleepHandler(),  # type: ignore
-        },
+        task_types=task_types or list(TaskType),
+        concurrency=concurrency,
     )
-    await task_consumer.run()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, functools.partial(_stop_task_consumers, task_consumers))
+
+    if processed_counter is None:
+        await asyncio.gather(*[task_consumer.run() for task_consumer in task_consumers])
+        return
+
+    # the counter keeps the count of the previous runs if this process is restarted by the supervisor
+    base_count = processed_counter.value
+    sync_task = asyncio.create_task(_sync_processed_count(task_consumers, processed_counter, base_count))
+    try:
+        await asyncio.gather(*[task_consumer.run() for task_consumer in task_consumers])
+    finally:
+        sync_task.cancel()
+        processed_counter.value = base_count + _get_processed_count(task_consumers)
+
+
+def _stop_task_consumers(task_consumers: List[BaseTaskConsumer]):
+    for task_consumer in task_consumers:
+        task_consumer.stop()
+
+
+def _get_processed_count(task_consumers: List[BaseTaskConsumer]) -> int:
+    return sum(task_consumer.processed_count for task_consumer in task_consumers)
+
+
+async def _sync_processed_count(task_consumers: List[BaseTaskConsumer], processed_counter: Synchronized, base_count: int):
+    """Publish the processed count of the consumers to the supervisor."""
+    while True:
+        processed_counter.value = base_count + _get_processed_count(task_consumers)
+        await asyncio.sleep(PROCESSED_COUNT_SYNC_INTERVAL_SECONDS)
+
+
+def run_worker_process(
+    index: int, processed_counter: Synchronized, concurrency: int, task_types: Optional[List[TaskType]] = None
+):
+    """The entry of a worker process forked by the supervisor."""
+    # the signal handlers of the supervisor are inherited by fork, reset them until the consumer installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    asyncio.run(async_main(concurrency=concurrency, processed_counter=processed_counter, task_types=task_types))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the task consumers.")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=settings.WORKER_PROCESSES,
+        help="The number of consumer processes, a supervisor is started to manage them if it is greater than 1.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=settings.WORKER_MAX_IN_FLIGHT,
+        help="The maximum number of tasks processed concurrently by the consumer of a route in each consumer process, "
+        "unless the route is set in WORKER_ROUTE_MAX_IN_FLIGHT.",
+    )
+    parser.add_argument(
+        "--task-types",
+        nargs="+",
+        type=TaskType,
+        default=[TaskType(task_type) for task_type in settings.WORKER_TASK_TYPES],
+        help="The task types handled by the consumer processes, all types by default.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.processes <= 1:
+        asyncio.run(async_main(concurrency=args.concurrency, task_types=args.task_types))
+        return
+
+    WorkerSupervisor(
+        target=functools.partial(run_worker_process, concurrency=args.concurrency, task_types=args.task_types),
+        process_count=args.processes,
+        report_interval=settings.WORKER_REPORT_INTERVAL_SECONDS,
+        drain_timeout=settings.WORKER_DRAIN_TIMEOUT_SECONDS,
+    ).run()
 
 
 if __name__ == "__main__":
-    asyncio.run(async_main())
+    main()
@@ -1,15 +1,31 @@
-from unittest.mock import AsyncMock, MagicMock
+import json
+import time
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 from fastapi.testclient import TestClient
 from redis.exceptions import ConnectionError
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import NoResultFound, SQLAlchemyError
 
+from app.const.task import TASK_MESSAGE_PARAMETERS_MAX_LENGTH, TASK_MESSAGE_VERSION, TASK_PRIORITY_QUEUE_NAMES
+from app.core.config import settings
 from app.database.models.task import Task
-from app.enum.task import TaskStatus, TaskType
+from app.enum.task import TaskPriority, TaskStatus, TaskType
 from app.main import app
+from app.middleware.depends import get_task_status_hub
+from app.utils.db import decode_cursor, encode_cursor
+from app.utils.exceptions.data_validation import InvalidCursorError, TooManyValuesError
+from app.utils.exceptions.db import EntryWithIDNotExist
 from app.utils.exceptions.task import JobCannotBeCancelled
-from tests.unit_test.utils import override_get_db, override_get_redis
+from app.utils.task.outbox import get_task_outbox_relay
+from app.utils.task.status_events import TaskStatusHub
+from tests.unit_test.utils import (
+    make_fake_db_async_context_manager,
+    make_fake_status_stream,
+    override_get_db,
+    override_get_redis,
+)
 
 client = TestClient(app)  # type: ignore
 
@@ -66,6 +82,7 @@ async def test_get_tasks_normal_return():
                 "ended_at": "2022-01-01T00:00:00",
             }
         ],
+        "next_cursor": None,
     }
 
 
@@ -149,12 +166,17 @@ async def test_post_cancel_task_normal():
         execute_side_effect=_get_execute_side_effect_for_post_cancel(),
         commit_side_effect=[AsyncMock()],
     ):
-        with override_get_redis(app=app):
+        with override_get_redis(app=app) as fake_redis_connection, patch.object(
+            settings, "TASK_STATUS_CACHE_ENABLED", False
+        ), patch.object(settings, "TASK_STATUS_EVENTS_ENABLED", False):
             response = client.post(
                 "/api/v1/tasks/test-id/cancel",
             )
     assert response.status_code == 200
     assert response.json()["status"] == TaskStatus.CANCELED
+    fake_redis_pipeline = fake_redis_connection.pipeline.return_value
+    assert fake_redis_pipeline.xadd.call_args.kwargs["fields"] == {"task_id": "test-id"}
+    fake_redis_pipeline.execute.assert_called_once()
 
 
 @pytest.mark.asyncio
@@ -245,3 +267,640 @@ def _get_execute_side_effect_for_post_cancel():
     mock_execute_side_effect = [mock_result_1, mock_result_for_update_task]
 
     return mock_execute_side_effect
+
+
+@pytest.mark.asyncio
+async def test_post_tasks_with_priority_should_publish_to_priority_queue():
+    with override_get_db(
+        app=app,
+        commit_side_effect=[AsyncMock()],
+        fake_refresh=_fake_refresh_for_create_task,  # type: ignore
+    ):
+        with override_get_redis(app=app) as fake_redis_connection:
+            response = client.post(
+                "/api/v1/tasks",
+                json={
+                    "type": "SLEEP",
+                    "priority": "HIGH",
+                },
+            )
+    assert response.status_code == 200
+    assert fake_redis_connection.xadd.call_args.args[0] == TASK_PRIORITY_QUEUE_NAMES[TaskPriority.HIGH]
+    # the stream is only trimmed by the workers, a cap on publish would drop unprocessed messages
+    assert "maxlen" not in fake_redis_connection.xadd.call_args.kwargs
+
+
+@pytest.mark.asyncio
+async def test_post_tasks_with_large_parameters_should_publish_message_without_parameters():
+    with override_get_db(
+        app=app,
+        commit_side_effect=[AsyncMock()],
+        fake_refresh=_fake_refresh_for_create_task,  # type: ignore
+    ):
+        with override_get_redis(app=app) as fake_redis_connection:
+            response = client.post(
+                "/api/v1/tasks",
+                json={
+                    "type": "SLEEP",
+                    "parameters": {"data": "x" * TASK_MESSAGE_PARAMETERS_MAX_LENGTH},
+                },
+            )
+    assert response.status_code == 200
+    assert fake_redis_connection.xadd.call_args.kwargs["fields"] == {
+        "task_id": "test",
+        "version": TASK_MESSAGE_VERSION,
+        "type": TaskType.SLEEP.value,
+    }
+
+
+@pytest.mark.asyncio
+async def test_post_tasks_should_publish_to_queue_of_task_type_route():
+    with override_get_db(
+        app=app,
+        commit_side_effect=[AsyncMock()],
+        fake_refresh=_fake_refresh_for_create_task,  # type: ignore
+    ):
+        with override_get_redis(app=app) as fake_redis_connection, patch.object(
+            settings, "TASK_TYPE_ROUTES", {"SLEEP": "slow"}
+        ):
+            response = client.post(
+                "/api/v1/tasks",
+                json={
+                    "type": "SLEEP",
+                    "priority": "LOW",
+                },
+            )
+    assert response.status_code == 200
+    assert fake_redis_connection.xadd.call_args.args[0] == "{task_processing_system:task_queue:slow}:low"
+
+
+@pytest.mark.asyncio
+async def test_post_tasks_with_delay_should_schedule_task():
+    with override_get_db(
+        app=app,
+        commit_side_effect=[AsyncMock()],
+        fake_refresh=_fake_refresh_for_create_task,  # type: ignore
+    ):
+        with override_get_redis(app=app) as fake_redis_connection:
+            response = client.post(
+                "/api/v1/tasks",
+                json={
+                    "type": "SLEEP",
+                    "delay_seconds": 60,
+                },
+            )
+    assert response.status_code == 200
+    fake_redis_connection.xadd.assert_not_called()
+    delayed_queue_name, entries = fake_redis_connection.zadd.call_args.args
+    assert delayed_queue_name == "{task_processing_system:task_queue}:delayed"
+    [(entry, due_time)] = entries.items()
+    assert json.loads(entry)["queue"] == TASK_PRIORITY_QUEUE_NAMES[TaskPriority.NORMAL]
+    assert json.loads(entry)["message"]["task_id"] == "test"
+    assert due_time > (time.time() + 50) * 1000
+
+
+@pytest.mark.asyncio
+async def test_post_tasks_with_run_at_in_past_should_publish_task():
+    with override_get_db(
+        app=app,
+        commit_side_effect=[AsyncMock()],
+        fake_refresh=_fake_refresh_for_create_task,  # type: ignore
+    ):
+        with override_get_redis(app=app) as fake_redis_connection:
+            response = client.post(
+                "/api/v1/tasks",
+                json={
+                    "type": "SLEEP",
+                    "run_at": "2020-06-09T10:25:47+00:00",
+                },
+            )
+    assert response.status_code == 200
+    fake_redis_connection.xadd.assert_called_once()
+    fake_redis_connection.zadd.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_post_tasks_with_run_at_and_delay_should_fail():
+    with override_get_db(app=app):
+        with override_get_redis(app=app):
+            response = client.post(
+                "/api/v1/tasks",
+                json={
+                    "type": "SLEEP",
+                    "run_at": "2020-06-09T10:25:47",
+                    "delay_seconds": 60,
+                },
+            )
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_post_tasks_batch_should_insert_once_and_publish_by_pipeline_in_order():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.all.return_value = [
+        Task(
+            id=f"test-{index}",
+            status=TaskStatus.PENDING,
+            type=TaskType.SLEEP,
+            parameters={"index": index},
+            created_at="2022-01-01 00:00:00",
+            updated_at="2022-01-01 00:00:00",
+        )
+        for index in range(3)
+    ]
+    with override_get_db(app=app, execute_side_effect=[mock_result], commit_side_effect=[AsyncMock()]):
+        with override_get_redis(app=app) as fake_redis_connection:
+            response = client.post(
+                "/api/v1/tasks:batch",
+                json={
+                    "tasks": [
+                        {"type": "SLEEP", "parameters": {"index": 0}},
+                        {"type": "SLEEP", "parameters": {"index": 1}, "priority": "HIGH"},
+                        {"type": "SLEEP", "parameters": {"index": 2}, "delay_seconds": 60},
+                    ]
+                },
+            )
+    assert response.status_code == 200
+    assert response.json()["total"] == 3
+    assert [task["id"] for task in response.json()["data"]] == ["test-0", "test-1", "test-2"]
+    fake_redis_pipeline = fake_redis_connection.pipeline.return_value
+    assert [call.args[0] for call in fake_redis_pipeline.xadd.call_args_list] == [
+        TASK_PRIORITY_QUEUE_NAMES[TaskPriority.NORMAL],
+        TASK_PRIORITY_QUEUE_NAMES[TaskPriority.HIGH],
+    ]
+    assert [call.kwargs["fields"]["task_id"] for call in fake_redis_pipeline.xadd.call_args_list] == ["test-0", "test-1"]
+    fake_redis_pipeline.zadd.assert_called_once()
+    fake_redis_pipeline.execute.assert_called_once()
+    fake_redis_connection.xadd.assert_not_called()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("task_count", [0, settings.TASK_BATCH_MAX_SIZE + 1])
+async def test_post_tasks_batch_with_invalid_size_should_fail(task_count):
+    with override_get_db(app=app):
+        with override_get_redis(app=app):
+            response = client.post(
+                "/api/v1/tasks:batch",
+                json={"tasks": [{"type": "SLEEP"}] * task_count},
+            )
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_post_cancel_tasks_by_ids_should_report_cancelled_and_not_cancellable_ids():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.all.return_value = ["test-1", "test-3"]
+    with override_get_db(app=app, execute_side_effect=[mock_result], commit_side_effect=[AsyncMock()]):
+        with override_get_redis(app=app) as fake_redis_connection, patch.object(
+            settings, "TASK_STATUS_CACHE_ENABLED", False
+        ), patch.object(settings, "TASK_STATUS_EVENTS_ENABLED", False):
+            response = client.post(
+                "/api/v1/tasks:cancel",
+                json={"ids": ["test-1", "test-2", "test-3"]},
+            )
+    assert response.status_code == 200
+    assert response.json() == {"cancelled_ids": ["test-1", "test-3"], "not_cancellable_ids": ["test-2"]}
+    fake_redis_pipeline = fake_redis_connection.pipeline.return_value
+    assert [call.kwargs["fields"] for call in fake_redis_pipeline.xadd.call_args_list] == [
+        {"task_id": "test-1"},
+        {"task_id": "test-3"},
+    ]
+    fake_redis_pipeline.execute.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_post_cancel_tasks_by_filter_should_update_once():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.all.return_value = ["test-1"]
+    with override_get_db(app=app, execute_side_effect=[mock_result], commit_side_effect=[AsyncMock()]) as mock_session:
+        with override_get_redis(app=app):
+            response = client.post(
+                "/api/v1/tasks:cancel",
+                json={"type": "SLEEP", "created_before": "2022-01-01T00:00:00"},
+            )
+    assert response.status_code == 200
+    assert response.json() == {"cancelled_ids": ["test-1"], "not_cancellable_ids": []}
+    mock_session.execute.assert_called_once()
+    query = str(mock_session.execute.call_args.args[0])
+    assert query.startswith("UPDATE task SET status")
+    assert "RETURNING task.id" in query
+
+
+@pytest.mark.asyncio
+async def test_post_cancel_tasks_without_condition_should_fail():
+    with override_get_db(app=app):
+        with override_get_redis(app=app):
+            response = client.post("/api/v1/tasks:cancel", json={})
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_get_task_cache_hit_should_not_read_db():
+    with override_get_db(app=app, execute_side_effect=[SQLAlchemyError("should not read db")]) as mock_session:
+        with override_get_redis(app=app) as fake_redis_connection:
+            fake_redis_connection.hgetall.return_value = {
+                "id": "test",
+                "type": "SLEEP",
+                "status": "PROCESSING",
+                "parameters": '{"a":1}',
+                "created_at": "2022-01-01T00:00:00",
+                "updated_at": "2022-01-01T00:00:01",
+                "started_at": "2022-01-01T00:00:01",
+            }
+            response = client.get("/api/v1/tasks/test")
+    assert response.status_code == 200
+    assert response.json()["status"] == "PROCESSING"
+    assert response.json()["parameters"] == {"a": 1}
+    fake_redis_connection.hgetall.assert_called_once_with("task_processing_system:task:test")
+    mock_session.execute.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_get_task_cache_miss_should_read_db_and_fill_cache_without_overwriting():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one.return_value = Task(
+        id="test",
+        status=TaskStatus.COMPLETED,
+        type=TaskType.SLEEP,
+        parameters={},
+        created_at=datetime(2022, 1, 1),
+        updated_at=datetime(2022, 1, 1),
+    )
+    with override_get_db(app=app, execute_side_effect=[mock_result]):
+        with override_get_redis(app=app) as fake_redis_connection:
+            # only the status written through by the ids is cached, it is a miss
+            fake_redis_connection.hgetall.return_value = {"status": "CANCELED"}
+            response = client.get("/api/v1/tasks/test")
+    assert response.status_code == 200
+    assert response.json()["status"] == "COMPLETED"
+    fake_redis_pipeline = fake_redis_connection.pipeline.return_value
+    filled_fields = {call.args[1]: call.args[2] for call in fake_redis_pipeline.hsetnx.call_args_list}
+    assert filled_fields["status"] == "COMPLETED"
+    assert filled_fields["created_at"] == "2022-01-01T00:00:00"
+    fake_redis_pipeline.expire.assert_called_once_with(
+        "task_processing_system:task:test", settings.TASK_STATUS_CACHE_TTL_SECONDS
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_task_not_exist_should_fail():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one.side_effect = NoResultFound()
+    with override_get_db(app=app, execute_side_effect=[mock_result]):
+        with override_get_redis(app=app) as fake_redis_connection:
+            fake_redis_connection.hgetall.return_value = {}
+            with pytest.raises(EntryWithIDNotExist):
+                client.get("/api/v1/tasks/test")
+
+
+@pytest.mark.asyncio
+async def test_post_cancel_task_should_write_through_cache():
+    with override_get_db(
+        app=app,
+        execute_side_effect=_get_execute_side_effect_for_post_cancel(),
+        commit_side_effect=[AsyncMock()],
+    ):
+        with override_get_redis(app=app) as fake_redis_connection:
+            response = client.post(
+                "/api/v1/tasks/test-id/cancel",
+            )
+    assert response.status_code == 200
+    fake_redis_pipeline = fake_redis_connection.pipeline.return_value
+    assert fake_redis_pipeline.hset.call_args.args == ("task_processing_system:task:test",)
+    assert fake_redis_pipeline.hset.call_args.kwargs["mapping"]["status"] == TaskStatus.CANCELED.value
+    fake_redis_pipeline.expire.assert_called_once_with(
+        "task_processing_system:task:test", settings.TASK_STATUS_CACHE_TTL_SECONDS
+    )
+
+
+def _get_execute_side_effect_for_get_tasks(task_count: int, total: int = 100):
+    mock_result_1 = MagicMock()
+    mock_result_1.scalars.return_value.all.return_value = [
+        Task(
+            id=f"test-{index}",
+            status=TaskStatus.PENDING,
+            type=TaskType.SLEEP,
+            parameters={},
+            created_at=datetime(2022, 1, 1, 0, 0, 10 - index),
+            updated_at=datetime(2022, 1, 1),
+        )
+        for index in range(task_count)
+    ]
+    mock_result_2 = MagicMock()
+    mock_result_2.scalars.return_value.one.return_value = total
+    return [mock_result_1, mock_result_2]
+
+
+@pytest.mark.asyncio
+async def test_get_tasks_should_page_by_cursor():
+    cursor = encode_cursor(["2022-01-01T00:00:20", "test-prev"])
+    with override_get_db(app=app, execute_side_effect=_get_execute_side_effect_for_get_tasks(3)) as mock_session:
+        response = client.get("/api/v1/tasks", params={"limit": 2, "cursor": cursor, "status": ["PENDING", "FAILED"]})
+    assert response.status_code == 200
+    assert [task["id"] for task in response.json()["data"]] == ["test-0", "test-1"]
+    assert decode_cursor(response.json()["next_cursor"], length=2) == ["2022-01-01T00:00:09", "test-1"]
+    list_query = mock_session.execute.call_args_list[0].args[0]
+    compiled_query = list_query.compile()
+    assert "(task.created_at, task.id) < (:param_1, :param_2)" in str(compiled_query)
+    assert "ORDER BY task.created_at DESC, task.id DESC" in str(compiled_query)
+    assert compiled_query.params["param_1"] == datetime(2022, 1, 1, 0, 0, 20)
+    assert compiled_query.params["param_2"] == "test-prev"
+    assert compiled_query.params["param_3"] == 3
+    assert "OFFSET" not in str(compiled_query)
+
+
+@pytest.mark.asyncio
+async def test_get_tasks_last_page_should_not_have_next_cursor():
+    with override_get_db(app=app, execute_side_effect=_get_execute_side_effect_for_get_tasks(2)):
+        response = client.get("/api/v1/tasks", params={"limit": 2, "order": "asc"})
+    assert response.status_code == 200
+    assert len(response.json()["data"]) == 2
+    assert response.json()["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_get_tasks_limit_zero_should_be_capped():
+    with override_get_db(app=app, execute_side_effect=_get_execute_side_effect_for_get_tasks(1)) as mock_session:
+        response = client.get("/api/v1/tasks", params={"limit": 0})
+    assert response.status_code == 200
+    compiled_query = mock_session.execute.call_args_list[0].args[0].compile()
+    assert compiled_query.params["param_1"] == settings.TASK_LIST_MAX_LIMIT + 1
+
+
+@pytest.mark.asyncio
+async def test_get_tasks_limit_over_max_should_fail():
+    with override_get_db(app=app):
+        response = client.get("/api/v1/tasks", params={"limit": settings.TASK_LIST_MAX_LIMIT + 1})
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cursor", ["not-a-cursor", encode_cursor(["not-a-time", "test"]), encode_cursor(["x"])])
+async def test_get_tasks_invalid_cursor_should_fail(cursor):
+    with override_get_db(app=app):
+        with pytest.raises(InvalidCursorError):
+            client.get("/api/v1/tasks", params={"cursor": cursor})
+
+
+@pytest.mark.asyncio
+async def test_get_tasks_total_should_be_counted_by_status_and_type():
+    with override_get_db(app=app, execute_side_effect=_get_execute_side_effect_for_get_tasks(1, total=7)) as mock_session:
+        response = client.get("/api/v1/tasks", params={"status": ["PENDING"], "type": "SLEEP"})
+    assert response.status_code == 200
+    assert response.json()["total"] == 7
+    count_query = str(mock_session.execute.call_args_list[1].args[0])
+    assert "FROM task_count" in count_query
+    assert "task_count.status IN" in count_query
+    assert "task_count.type =" in count_query
+
+
+@pytest.mark.asyncio
+async def test_get_tasks_total_with_created_at_range_should_count_the_range():
+    with override_get_db(app=app, execute_side_effect=_get_execute_side_effect_for_get_tasks(1, total=3)) as mock_session:
+        response = client.get("/api/v1/tasks", params={"created_after": "2022-01-01T00:00:00"})
+    assert response.status_code == 200
+    assert response.json()["total"] == 3
+    count_query = str(mock_session.execute.call_args_list[1].args[0])
+    assert "count(*)" in count_query
+    assert "task.created_at >=" in count_query
+
+
+@pytest.mark.asyncio
+async def test_get_tasks_total_estimated_should_read_pg_class():
+    with override_get_db(app=app, execute_side_effect=_get_execute_side_effect_for_get_tasks(1, total=1000)) as mock_session:
+        response = client.get("/api/v1/tasks", params={"total": "ESTIMATED"})
+    assert response.status_code == 200
+    assert response.json()["total"] == 1000
+    assert "pg_class" in str(mock_session.execute.call_args_list[1].args[0])
+
+
+@pytest.mark.asyncio
+async def test_get_tasks_total_estimated_never_analyzed_should_fall_back_to_counts():
+    execute_side_effect = _get_execute_side_effect_for_get_tasks(1, total=-1)
+    mock_counted_result = MagicMock()
+    mock_counted_result.scalars.return_value.one.return_value = 5
+    with override_get_db(app=app, execute_side_effect=execute_side_effect + [mock_counted_result]) as mock_session:
+        response = client.get("/api/v1/tasks", params={"total": "ESTIMATED"})
+    assert response.status_code == 200
+    assert response.json()["total"] == 5
+    assert "FROM task_count" in str(mock_session.execute.call_args_list[2].args[0])
+
+
+@pytest.mark.asyncio
+async def test_get_tasks_total_none_should_not_count():
+    with override_get_db(app=app, execute_side_effect=_get_execute_side_effect_for_get_tasks(1)) as mock_session:
+        response = client.get("/api/v1/tasks", params={"total": "NONE"})
+    assert response.status_code == 200
+    assert response.json()["total"] is None
+    mock_session.execute.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_get_task_counts_should_return_counts_by_status_and_type():
+    mock_result = MagicMock()
+    mock_result.all.return_value = [("COMPLETED", "SLEEP", 3), ("PENDING", "SLEEP", 2)]
+    with override_get_db(app=app, execute_side_effect=[mock_result]):
+        response = client.get("/api/v1/tasks:counts")
+    assert response.status_code == 200
+    assert response.json() == {
+        "total": 5,
+        "data": [
+            {"status": "COMPLETED", "type": "SLEEP", "count": 3},
+            {"status": "PENDING", "type": "SLEEP", "count": 2},
+        ],
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_task_events_should_stream_current_status_and_transitions_until_finished():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.all.return_value = [
+        Task(id="a", status=TaskStatus.PROCESSING, type=TaskType.SLEEP),
+        Task(id="b", status=TaskStatus.COMPLETED, type=TaskType.SLEEP),
+    ]
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=[mock_result])
+    fake_redis_connection = make_fake_status_stream(
+        [
+            (
+                "task_status",
+                [
+                    ("2-0", {"task_id": "c", "status": "COMPLETED", "type": "SLEEP"}),
+                    ("3-0", {"task_id": "a", "status": "COMPLETED", "type": "SLEEP"}),
+                ],
+            )
+        ]
+    )
+    app.dependency_overrides[get_task_status_hub] = lambda: TaskStatusHub(fake_redis_connection)  # type: ignore
+    try:
+        with patch("app.api.v1.endpoints.task.get_db_session_context_manager", return_value=fake_db_async_context_manager):
+            response = client.get("/api/v1/tasks:events", params={"task_id": ["a", "b"]})
+    finally:
+        app.dependency_overrides.clear()
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text == (
+        'event: status\ndata: {"task_id":"a","status":"PROCESSING","type":"SLEEP"}\n\n'
+        'event: status\ndata: {"task_id":"b","status":"COMPLETED","type":"SLEEP"}\n\n'
+        'id: 3-0\nevent: status\ndata: {"task_id":"a","status":"COMPLETED","type":"SLEEP"}\n\n'
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_task_events_with_too_many_task_ids_should_fail():
+    with patch.object(settings, "TASK_EVENTS_MAX_TASK_IDS", 1):
+        with pytest.raises(TooManyValuesError):
+            client.get("/api/v1/tasks:events", params={"task_id": ["a", "b"]})
+
+
+def _get_task_result(status: TaskStatus):
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one.return_value = Task(
+        id="test",
+        status=status,
+        type=TaskType.SLEEP,
+        parameters={},
+        created_at=datetime(2022, 1, 1),
+        updated_at=datetime(2022, 1, 1),
+    )
+    return mock_result
+
+
+@pytest.mark.asyncio
+async def test_get_task_with_wait_should_return_when_task_finished():
+    fake_redis_connection = make_fake_status_stream(
+        [("task_status", [("2-0", {"task_id": "test", "status": "COMPLETED", "type": "SLEEP"})])]
+    )
+    app.dependency_overrides[get_task_status_hub] = lambda: TaskStatusHub(fake_redis_connection)  # type: ignore
+    with override_get_db(
+        app=app, execute_side_effect=[_get_task_result(TaskStatus.PROCESSING), _get_task_result(TaskStatus.COMPLETED)]
+    ) as mock_session, patch.object(settings, "TASK_STATUS_CACHE_ENABLED", False):
+        response = client.get("/api/v1/tasks/test", params={"wait": 5})
+    assert response.status_code == 200
+    assert response.json()["status"] == TaskStatus.COMPLETED
+    # the db connection is released while waiting
+    mock_session.close.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_get_task_with_wait_should_return_current_task_after_timeout():
+    fake_redis_connection = make_fake_status_stream(
+        [("task_status", [("2-0", {"task_id": "another", "status": "COMPLETED", "type": "SLEEP"})])]
+    )
+    app.dependency_overrides[get_task_status_hub] = lambda: TaskStatusHub(fake_redis_connection)  # type: ignore
+    with override_get_db(app=app, execute_side_effect=[_get_task_result(TaskStatus.PROCESSING)]) as mock_session, patch.object(
+        settings, "TASK_STATUS_CACHE_ENABLED", False
+    ):
+        started_at = time.monotonic()
+        response = client.get("/api/v1/tasks/test", params={"wait": 0.1})
+    assert response.status_code == 200
+    assert response.json()["status"] == TaskStatus.PROCESSING
+    assert time.monotonic() - started_at >= 0.1
+    mock_session.execute.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_post_tasks_with_wait_should_not_wait_for_finished_task():
+    fake_redis_connection = make_fake_status_stream()
+    app.dependency_overrides[get_task_status_hub] = lambda: TaskStatusHub(fake_redis_connection)  # type: ignore
+    with override_get_db(
+        app=app,
+        execute_side_effect=[_get_task_result(TaskStatus.COMPLETED)],
+        commit_side_effect=[AsyncMock()],
+        fake_refresh=_fake_refresh_for_create_task,  # type: ignore
+    ) as mock_session, patch.object(settings, "TASK_STATUS_CACHE_ENABLED", False):
+        with override_get_redis(app=app):
+            response = client.post("/api/v1/tasks", params={"wait": 5}, json={"type": "SLEEP"})
+    assert response.status_code == 200
+    assert response.json()["status"] == TaskStatus.COMPLETED
+    mock_session.close.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_get_task_with_wait_over_max_should_fail():
+    with override_get_db(app=app):
+        response = client.get("/api/v1/tasks/test", params={"wait": settings.TASK_WAIT_MAX_SECONDS + 1})
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_post_tasks_with_outbox_should_write_outbox_in_task_transaction_and_not_publish():
+    fake_outbox_relay = MagicMock()
+    with override_get_db(
+        app=app,
+        execute_side_effect=[MagicMock()],
+        commit_side_effect=[AsyncMock()],
+        fake_refresh=_fake_refresh_for_create_task,  # type: ignore
+    ) as mock_session, patch.object(settings, "TASK_OUTBOX_ENABLED", True):
+        app.dependency_overrides[get_task_outbox_relay] = lambda: fake_outbox_relay
+        with override_get_redis(app=app) as fake_redis_connection:
+            response = client.post("/api/v1/tasks", json={"type": "SLEEP", "priority": "HIGH"})
+    assert response.status_code == 200
+    assert response.json()["id"] == "test"
+    fake_redis_connection.xadd.assert_not_called()
+    fake_redis_connection.pipeline.assert_not_called()
+    # the task is flushed and the outbox entry inserted before the only commit
+    mock_session.flush.assert_awaited_once()
+    mock_session.commit.assert_awaited_once()
+    statement, entries = mock_session.execute.call_args.args
+    assert str(statement).startswith("INSERT INTO task_outbox")
+    assert entries == [
+        {
+            "task_id": "test",
+            "queue_name": TASK_PRIORITY_QUEUE_NAMES[TaskPriority.HIGH],
+            "message": {"task_id": "test", "version": TASK_MESSAGE_VERSION, "type": "SLEEP", "parameters": "{}"},
+            "delayed_queue_name": None,
+            "run_at": None,
+        }
+    ]
+    fake_outbox_relay.notify.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_post_tasks_with_outbox_should_store_run_at_with_offset_in_utc_without_timezone():
+    with override_get_db(
+        app=app,
+        execute_side_effect=[MagicMock()],
+        commit_side_effect=[AsyncMock()],
+        fake_refresh=_fake_refresh_for_create_task,  # type: ignore
+    ) as mock_session, patch.object(settings, "TASK_OUTBOX_ENABLED", True):
+        app.dependency_overrides[get_task_outbox_relay] = lambda: MagicMock()
+        with override_get_redis(app=app):
+            response = client.post("/api/v1/tasks", json={"type": "SLEEP", "run_at": "2020-06-09T12:25:47+02:00"})
+    assert response.status_code == 200
+    _, [entry] = mock_session.execute.call_args.args
+    assert entry["run_at"] == datetime(2020, 6, 9, 10, 25, 47)
+    assert entry["run_at"].tzinfo is None
+    assert entry["delayed_queue_name"] is not None
+
+
+@pytest.mark.asyncio
+async def test_post_tasks_batch_with_outbox_should_write_outbox_in_task_transaction_and_not_publish():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.all.return_value = [
+        Task(
+            id=f"test-{index}",
+            status=TaskStatus.PENDING,
+            type=TaskType.SLEEP,
+            parameters={},
+            created_at=datetime(2022, 1, 1),
+            updated_at=datetime(2022, 1, 1),
+        )
+        for index in range(2)
+    ]
+    with override_get_db(
+        app=app, execute_side_effect=[mock_result, MagicMock()], commit_side_effect=[AsyncMock()]
+    ) as mock_session, patch.object(settings, "TASK_OUTBOX_ENABLED", True):
+        with override_get_redis(app=app) as fake_redis_connection:
+            response = client.post(
+                "/api/v1/tasks:batch",
+                json={"tasks": [{"type": "SLEEP"}, {"type": "SLEEP", "delay_seconds": 60}]},
+            )
+    assert response.status_code == 200
+    fake_redis_connection.pipeline.assert_not_called()
+    mock_session.commit.assert_awaited_once()
+    statement, entries = mock_session.execute.call_args.args
+    assert str(statement).startswith("INSERT INTO task_outbox")
+    assert [(entry["task_id"], entry["delayed_queue_name"] is not None) for entry in entries] == [
+        ("test-0", False),
+        ("test-1", True),
+    ]
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import pytest
+from redis.exceptions import ConnectionError
+from sqlalchemy.dialects.postgresql import asyncpg
+
+from app.database.models.task_outbox import TaskOutbox
+from app.utils.task.outbox import TaskOutboxRelay
+from app.utils.time import get_utc_now_without_timezone
+from tests.unit_test.utils import _make_fake_redis_connection, _make_fake_redis_pipeline, make_fake_db_async_context_manager
+
+
+def _make_outbox_entry(id: int, run_at=None) -> TaskOutbox:
+    return TaskOutbox(
+        id=id,
+        task_id=f"test-{id}",
+        queue_name="queue",
+        message={"task_id": f"test-{id}"},
+        delayed_queue_name="queue:delayed" if run_at is not None else None,
+        run_at=run_at,
+    )
+
+
+def _take_result(entries):
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.all.return_value = entries
+    return mock_result
+
+
+@pytest.mark.asyncio
+async def test_relay_should_publish_entries_by_batches_and_delete_them():
+    fake_db_async_context_manager = make_fake_db_async_context_manager(
+        execute_side_effect=[
+            _take_result([_make_outbox_entry(2), _make_outbox_entry(1)]),
+            _take_result([_make_outbox_entry(3, run_at=get_utc_now_without_timezone() + timedelta(minutes=1))]),
+        ],
+        commit_side_effect=None,
+    )
+    fake_db_session = fake_db_async_context_manager.__aenter__.return_value
+    fake_redis_connection = _make_fake_redis_connection()
+    with patch("app.utils.task.outbox.get_db_session_context_manager", return_value=fake_db_async_context_manager):
+        relayed_count = await TaskOutboxRelay(fake_redis_connection, batch_size=2).relay()  # type: ignore
+
+    assert relayed_count == 3
+    statement = str(fake_db_session.execute.call_args.args[0].compile(dialect=asyncpg.dialect()))
+    assert statement.startswith("DELETE FROM task_outbox")
+    assert "FOR UPDATE SKIP LOCKED" in statement
+    fake_redis_pipeline = fake_redis_connection.pipeline.return_value
+    # the entries are published in the order of their ids
+    assert [call.kwargs["fields"]["task_id"] for call in fake_redis_pipeline.xadd.call_args_list] == ["test-1", "test-2"]
+    assert fake_redis_pipeline.zadd.call_args.args[0] == "queue:delayed"
+    assert fake_redis_pipeline.execute.await_count == 2
+    assert fake_db_session.commit.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_relay_should_keep_entries_when_publish_failed():
+    fake_db_async_context_manager = make_fake_db_async_context_manager(
+        execute_side_effect=[_take_result([_make_outbox_entry(1, run_at=datetime(2022, 1, 1))])],
+        commit_side_effect=None,
+    )
+    fake_db_session = fake_db_async_context_manager.__aenter__.return_value
+    fake_redis_connection = _make_fake_redis_connection()
+    fake_redis_connection.pipeline.return_value = _make_fake_redis_pipeline(execute_side_effect=ConnectionError())
+    with patch("app.utils.task.outbox.get_db_session_context_manager", return_value=fake_db_async_context_manager):
+        with pytest.raises(ConnectionError):
+            await TaskOutboxRelay(fake_redis_connection).relay()  # type: ignore
+
+    # the delayed entry is due already, it is published directly
+    fake_redis_connection.pipeline.return_value.xadd.assert_called_once()
+    fake_db_session.commit.assert_not_awaited()
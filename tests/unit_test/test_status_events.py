@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from app.const.task import TASK_STATUS_STREAM_NAME
+from app.enum.task import TaskStatus, TaskType
+from app.utils.task.status_events import TaskStatusHub, TaskStatusSubscription
+from tests.unit_test.utils import make_fake_status_stream
+
+
+@pytest.mark.asyncio
+async def test_hub_should_fan_out_events_to_matching_subscriptions():
+    fake_redis_connection = make_fake_status_stream(
+        [
+            (
+                TASK_STATUS_STREAM_NAME,
+                [
+                    ("2-0", {"task_id": "a", "status": "PROCESSING", "type": "SLEEP"}),
+                    ("3-0", {"task_id": "b", "status": "COMPLETED", "type": "SLEEP"}),
+                    ("4-0", {"task_id": "a", "status": "COMPLETED", "type": "SLEEP"}),
+                ],
+            )
+        ]
+    )
+    hub = TaskStatusHub(fake_redis_connection)  # type: ignore
+    async with hub.subscribe(task_ids=["a"]) as task_subscription, hub.subscribe(
+        status_list=[TaskStatus.COMPLETED], type=TaskType.SLEEP
+    ) as filter_subscription:
+        task_events = [await task_subscription.get(timeout=1), await task_subscription.get(timeout=1)]
+        filter_events = [await filter_subscription.get(timeout=1), await filter_subscription.get(timeout=1)]
+        assert await task_subscription.get(timeout=0.05) is None
+    await hub.close()
+
+    assert [event_id for event_id, _ in task_events] == ["2-0", "4-0"]
+    assert [event["task_id"] for _, event in filter_events] == ["b", "a"]
+    # the reader starts after the last event published before the first subscription
+    assert fake_redis_connection.xread.call_args_list[0].kwargs["streams"] == {TASK_STATUS_STREAM_NAME: "1-0"}
+    assert hub._task_subscriptions == {}
+    assert hub._filter_subscriptions == set()
+
+
+@pytest.mark.asyncio
+async def test_hub_should_continue_from_last_id_after_read_error():
+    fake_redis_connection = make_fake_status_stream(
+        [(TASK_STATUS_STREAM_NAME, [("2-0", {"task_id": "a", "status": "PROCESSING"})])],
+    )
+    xread = fake_redis_connection.xread.side_effect
+    errors = [ConnectionError("Connection failed")]
+
+    async def xread_failing_once(**kwargs):
+        if fake_redis_connection.xread.call_count == 2 and errors:
+            raise errors.pop()
+        return await xread(**kwargs)
+
+    fake_redis_connection.xread.side_effect = xread_failing_once
+    hub = TaskStatusHub(fake_redis_connection)  # type: ignore
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr("app.utils.task.status_events.READ_RETRY_INTERVAL", 0)
+        async with hub.subscribe(task_ids=["a"]) as subscription:
+            assert (await subscription.get(timeout=1))[0] == "2-0"  # type: ignore
+            while fake_redis_connection.xread.call_count < 3:
+                await asyncio.sleep(0.01)
+    await hub.close()
+
+    assert fake_redis_connection.xread.call_args_list[2].kwargs["streams"] == {TASK_STATUS_STREAM_NAME: "2-0"}
+
+
+@pytest.mark.asyncio
+async def test_subscription_should_drop_oldest_events_when_buffer_full():
+    subscription = TaskStatusSubscription(task_ids=["a"], buffer_size=2)
+    for index, status in enumerate(["PENDING", "PROCESSING", "COMPLETED"]):
+        subscription.put(f"{index}-0", {"task_id": "a", "status": status})
+
+    assert [(await subscription.get(timeout=0))[1]["status"] for _ in range(2)] == ["PROCESSING", "COMPLETED"]  # type: ignore
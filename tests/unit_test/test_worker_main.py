@@ -0,0 +1,39 @@
+from unittest.mock import patch
+
+from app.const.task import TASK_PRIORITY_QUEUE_NAMES
+from app.core.config import settings
+from app.enum.task import TaskPriority, TaskType
+from app.worker_main import build_task_consumers
+from tests.unit_test.utils import _make_fake_redis_connection
+
+
+def test_build_task_consumers_should_use_default_route():
+    task_consumers = build_task_consumers(
+        redis_connection=_make_fake_redis_connection(),  # type: ignore
+        task_types=[TaskType.SLEEP],
+        concurrency=5,
+    )
+
+    assert len(task_consumers) == 1
+    assert sorted(task_consumers[0]._stream_names) == sorted(TASK_PRIORITY_QUEUE_NAMES.values())
+    assert task_consumers[0]._max_in_flight == 5
+
+
+def test_build_task_consumers_should_use_stream_and_concurrency_of_route():
+    with patch.object(settings, "TASK_TYPE_ROUTES", {"SLEEP": "slow"}), patch.object(
+        settings, "WORKER_ROUTE_MAX_IN_FLIGHT", {"slow": 2}
+    ):
+        task_consumers = build_task_consumers(
+            redis_connection=_make_fake_redis_connection(),  # type: ignore
+            task_types=[TaskType.SLEEP],
+            concurrency=5,
+        )
+
+    assert len(task_consumers) == 1
+    assert sorted(task_consumers[0]._stream_names) == [
+        "{task_processing_system:task_queue:slow}",
+        "{task_processing_system:task_queue:slow}:high",
+        "{task_processing_system:task_queue:slow}:low",
+    ]
+    assert task_consumers[0]._max_in_flight == 2
+    assert list(task_consumers[0]._task_handlers) == [TaskType.SLEEP]
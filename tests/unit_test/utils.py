@@ -1,3 +1,4 @@
+import asyncio
 from contextlib import contextmanager
 from typing import Any, Coroutine, List
 from unittest.mock import AsyncMock, MagicMock
@@ -5,6 +6,7 @@ from unittest.mock import AsyncMock, MagicMock
 from fastapi import FastAPI
 
 from app.middleware.depends import get_db_session, get_redis_session
+from app.worker.task_handler.base_handler import BaseHandler
 
 
 @contextmanager
@@ -21,7 +23,7 @@ def override_get_db(
     mock_session.add = MagicMock()
     mock_session.refresh = fake_refresh
     app.dependency_overrides[get_db_session] = lambda: mock_session
-    yield
+    yield mock_session
     app.dependency_overrides.clear()
 
 
@@ -43,8 +45,9 @@ def make_fake_db_async_context_manager(
 
 @contextmanager
 def override_get_redis(app: FastAPI, xadd_side_effect: List[Any] = [AsyncMock()]):
-    app.dependency_overrides[get_redis_session] = lambda: _make_fake_redis_connection(xadd_side_effect)
-    yield
+    fake_redis_connection = _make_fake_redis_connection(xadd_side_effect)
+    app.dependency_overrides[get_redis_session] = lambda: fake_redis_connection
+    yield fake_redis_connection
     app.dependency_overrides.clear()
 
 
@@ -52,13 +55,12 @@ def _make_fake_redis_connection(
     xadd_side_effect: List[Any] = [AsyncMock()],
     xautoclaim_side_effect: List[Any] = [
         (
-            None,
+            "0-0",
             [("message_id", {"task_id": "test_task_id"})],
-            None,
+            [],
         ),
-        KeyboardInterrupt(),
     ],
-    xreadgroup_side_effect: List[Any] = [{}],
+    xreadgroup_side_effect: List[Any] = [KeyboardInterrupt()],
     xgroup_create_side_effect: List[Any] = [[]],
     xinfo_groups_side_effect: List[Any] = [AsyncMock()],
     xack_side_effect: List[Any] = [],
@@ -70,4 +72,31 @@ def _make_fake_redis_connection(
     mock_session.xgroup_create.side_effect = xgroup_create_side_effect
     mock_session.xinfo_groups.side_effect = xinfo_groups_side_effect
     mock_session.xack.side_effect = xack_side_effect
+    mock_session.pipeline = MagicMock(return_value=_make_fake_redis_pipeline())
     return mock_session
+
+
+def _make_fake_redis_pipeline(execute_side_effect: Any = None):
+    """The commands of a pipeline are buffered synchronously, only execute is awaited."""
+    mock_pipeline = MagicMock()
+    mock_pipeline.execute = AsyncMock(side_effect=execute_side_effect)
+    return mock_pipeline
+
+
+def make_fake_handler(timeout=None, retry_policy=None):
+    """A handler mock with the interface of BaseHandler, `handle`, `start` and `stop` are AsyncMock."""
+    return AsyncMock(spec=BaseHandler, timeout=timeout, retry_policy=retry_policy)
+
+
+def make_fake_status_stream(*responses):
+    """A redis mock whose status stream returns the responses by XREAD one by one, and nothing afterwards."""
+
+    async def xread(**kwargs):
+        await asyncio.sleep(0.01)
+        return responses_left.pop(0) if responses_left else []
+
+    responses_left = list(responses)
+    fake_redis_connection = AsyncMock()
+    fake_redis_connection.xrevrange.return_value = [("1-0", {})]
+    fake_redis_connection.xread.side_effect = xread
+    return fake_redis_connection
@@ -0,0 +1,37 @@
+from app.worker.adaptive_read_count import AdaptiveReadCount
+
+
+def test_next_count_grows_under_backlog_and_shrinks_when_idle():
+    read_count = AdaptiveReadCount(min_count=1, max_count=8)
+    for _ in range(5):
+        count = read_count.next_count(free_slots=100, in_flight=0)
+        read_count.observe_read(requested=count, received=count)
+    assert read_count.next_count(free_slots=100, in_flight=0) == 8
+
+    for _ in range(5):
+        count = read_count.next_count(free_slots=100, in_flight=0)
+        read_count.observe_read(requested=count, received=0)
+    assert read_count.next_count(free_slots=100, in_flight=0) == 1
+
+
+def test_next_count_is_capped_by_free_slots():
+    read_count = AdaptiveReadCount(min_count=1, max_count=8)
+    for _ in range(5):
+        read_count.observe_read(requested=1, received=1)
+    assert read_count.next_count(free_slots=3, in_flight=7) == 3
+    assert read_count.next_count(free_slots=0, in_flight=10) == 0
+
+
+def test_next_count_prefetches_for_short_tasks_only():
+    read_count = AdaptiveReadCount(min_count=1, max_count=8, prefetch_window=0.05)
+    for _ in range(5):
+        read_count.observe_read(requested=1, received=1)
+
+    read_count.observe_latency(3)
+    assert read_count.next_count(free_slots=0, in_flight=10) == 0
+
+    short_task_read_count = AdaptiveReadCount(min_count=1, max_count=8, prefetch_window=0.05)
+    for _ in range(5):
+        short_task_read_count.observe_read(requested=1, received=1)
+    short_task_read_count.observe_latency(0.01)
+    assert short_task_read_count.next_count(free_slots=0, in_flight=10) == 8
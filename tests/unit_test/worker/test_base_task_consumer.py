@@ -1,13 +1,20 @@
+import asyncio
+import json
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 from redis.exceptions import ConnectionError
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import NoResultFound, SQLAlchemyError
 
+from app.const.task import TASK_STATUS_STREAM_NAME
 from app.database.models.task import Task
 from app.enum.task import TaskStatus, TaskType
-from app.worker.base_task_consumer import BaseTaskConsumer
-from tests.unit_test.utils import _make_fake_redis_connection, make_fake_db_async_context_manager
+from app.utils.exceptions.task import TaskAbandoned, TaskDeliveryExceeded, TaskTimeoutError
+from app.worker.base_task_consumer import STATUS_WRITE_MAX_RETRY_COUNT, BaseTaskConsumer
+from app.worker.retry_policy import RetryPolicy
+from app.worker.task_handler.base_handler import BaseHandler
+from app.worker.task_status_writer import TaskStatusWriter
+from tests.unit_test.utils import _make_fake_redis_connection, make_fake_db_async_context_manager, make_fake_handler
 
 
 @pytest.mark.asyncio
@@ -30,12 +37,13 @@ async def test_run_normally():
         ]
         mock_result_1.scalars.return_value = mock_scalars_1
 
+        # the reclaimed message of a task which is not PROCESSING does not fail it
         mock_result_2 = MagicMock()
         mock_scalars_2 = MagicMock()
-        mock_scalars_2.one.return_value = 1
+        mock_scalars_2.one.side_effect = NoResultFound()
         mock_result_2.scalars.return_value = mock_scalars_2
 
-        mock_execute_side_effect = [mock_result_1]
+        mock_execute_side_effect = [mock_result_1, mock_result_2]
         return mock_execute_side_effect
 
     db_execute_side_effect = get_execute_side_effect()
@@ -46,7 +54,7 @@ async def test_run_normally():
         fake_redis_connection = _make_fake_redis_connection()
         await BaseTaskConsumer(
             redis_connection=fake_redis_connection,  # type: ignore
-            task_handlers={TaskType.SLEEP: AsyncMock()},
+            task_handlers={TaskType.SLEEP: make_fake_handler()},
             queue_name="test",
         ).run()
     fake_redis_connection.xautoclaim.assert_called()
@@ -74,12 +82,13 @@ async def test_run_redis_connection_error_should_retry():
         ]
         mock_result_1.scalars.return_value = mock_scalars_1
 
+        # the reclaimed message of a task which is not PROCESSING does not fail it
         mock_result_2 = MagicMock()
         mock_scalars_2 = MagicMock()
-        mock_scalars_2.one.return_value = 1
+        mock_scalars_2.one.side_effect = NoResultFound()
         mock_result_2.scalars.return_value = mock_scalars_2
 
-        mock_execute_side_effect = [mock_result_1]
+        mock_execute_side_effect = [mock_result_1, mock_result_2]
         return mock_execute_side_effect
 
     db_execute_side_effect = get_execute_side_effect()
@@ -87,14 +96,14 @@ async def test_run_redis_connection_error_should_retry():
         "app.worker.base_task_consumer.get_db_session_context_manager",
         return_value=make_fake_db_async_context_manager(execute_side_effect=db_execute_side_effect),
     ):
-        fake_redis_connection = _make_fake_redis_connection(xautoclaim_side_effect=[ConnectionError()])
+        fake_redis_connection = _make_fake_redis_connection(xreadgroup_side_effect=[ConnectionError(), ConnectionError()])
         await BaseTaskConsumer(
             redis_connection=fake_redis_connection,  # type: ignore
-            task_handlers={TaskType.SLEEP: AsyncMock()},
+            task_handlers={TaskType.SLEEP: make_fake_handler()},
             queue_name="test",
             max_retry_count=1,
         ).run()
-    assert fake_redis_connection.xautoclaim.call_count == 2
+    assert fake_redis_connection.xreadgroup.call_count == 2
 
 
 @pytest.mark.asyncio
@@ -107,7 +116,7 @@ async def test_run_db_connection_error_should_not_ack():
         fake_redis_connection = _make_fake_redis_connection()
         await BaseTaskConsumer(
             redis_connection=fake_redis_connection,  # type: ignore
-            task_handlers={TaskType.SLEEP: AsyncMock()},
+            task_handlers={TaskType.SLEEP: make_fake_handler()},
             queue_name="test",
             max_retry_count=1,
         ).run()
@@ -134,12 +143,13 @@ async def test_run_message_invalid_should_not_ack():
         ]
         mock_result_1.scalars.return_value = mock_scalars_1
 
+        # the reclaimed message of a task which is not PROCESSING does not fail it
         mock_result_2 = MagicMock()
         mock_scalars_2 = MagicMock()
-        mock_scalars_2.one.return_value = 1
+        mock_scalars_2.one.side_effect = NoResultFound()
         mock_result_2.scalars.return_value = mock_scalars_2
 
-        mock_execute_side_effect = [mock_result_1]
+        mock_execute_side_effect = [mock_result_1, mock_result_2]
         return mock_execute_side_effect
 
     db_execute_side_effect = get_execute_side_effect()
@@ -160,7 +170,7 @@ async def test_run_message_invalid_should_not_ack():
         )
         await BaseTaskConsumer(
             redis_connection=fake_redis_connection,  # type: ignore
-            task_handlers={TaskType.SLEEP: AsyncMock()},
+            task_handlers={TaskType.SLEEP: make_fake_handler()},
             queue_name="test",
         ).run()
 
@@ -185,14 +195,17 @@ async def test_run_cancelled_should_not_run_but_ack():
                 ended_at="2022-01-01 00:00:00",
             )
         ]
+        # the claim does not match a task which is not PENDING
+        mock_scalars_1.one_or_none.return_value = None
         mock_result_1.scalars.return_value = mock_scalars_1
 
+        # the reclaimed message of a task which is not PROCESSING does not fail it
         mock_result_2 = MagicMock()
         mock_scalars_2 = MagicMock()
-        mock_scalars_2.one.return_value = 1
+        mock_scalars_2.one.side_effect = NoResultFound()
         mock_result_2.scalars.return_value = mock_scalars_2
 
-        mock_execute_side_effect = [mock_result_1]
+        mock_execute_side_effect = [mock_result_1, mock_result_2]
         return mock_execute_side_effect
 
     fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=get_execute_side_effect())
@@ -203,7 +216,7 @@ async def test_run_cancelled_should_not_run_but_ack():
         fake_redis_connection = _make_fake_redis_connection()
         await BaseTaskConsumer(
             redis_connection=fake_redis_connection,  # type: ignore
-            task_handlers={TaskType.SLEEP: AsyncMock()},
+            task_handlers={TaskType.SLEEP: make_fake_handler()},
             queue_name="test",
         ).run()
     fake_redis_connection.xautoclaim.assert_called()
@@ -213,3 +226,768 @@ async def test_run_cancelled_should_not_run_but_ack():
 
     fake_db_session = fake_db_async_context_manager.__aenter__.return_value
     fake_db_session.commit.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_run_messages_concurrently_up_to_max_in_flight():
+    class FakeHandler(BaseHandler):
+        def __init__(self):
+            super().__init__()
+            self.running_count = 0
+            self.max_running_count = 0
+
+        async def handle(self, task):
+            self.running_count += 1
+            self.max_running_count = max(self.max_running_count, self.running_count)
+            await asyncio.sleep(0.05)
+            self.running_count -= 1
+
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one_or_none.return_value = Task(
+        id="test", status=TaskStatus.PROCESSING, type=TaskType.SLEEP
+    )
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_async_context_manager.__aenter__.return_value.execute.return_value = mock_result
+    fake_handler = FakeHandler()
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ):
+        fake_redis_connection = _make_fake_redis_connection(
+            xautoclaim_side_effect=[
+                (
+                    None,
+                    [(f"message_id_{i}", {"task_id": "test"}) for i in range(3)],
+                    None,
+                ),
+                KeyboardInterrupt(),
+            ],
+            xack_side_effect=None,
+        )
+        await BaseTaskConsumer(
+            redis_connection=fake_redis_connection,  # type: ignore
+            task_handlers={TaskType.SLEEP: fake_handler},  # type: ignore
+            queue_name="test",
+            max_in_flight=2,
+        ).run()
+
+    assert fake_handler.max_running_count == 2
+    acked_message_ids = [message_id for call in fake_redis_connection.xack.call_args_list for message_id in call.args[2:]]
+    assert sorted(acked_message_ids) == ["message_id_0", "message_id_1", "message_id_2"]
+
+
+@pytest.mark.asyncio
+async def test_run_janitor_reclaims_pending_messages_periodically():
+    async def fake_xreadgroup(*args, **kwargs):
+        await asyncio.sleep(0.1)
+        raise KeyboardInterrupt()
+
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=make_fake_db_async_context_manager(execute_side_effect=None),
+    ):
+        fake_redis_connection = _make_fake_redis_connection(
+            xautoclaim_side_effect=None,
+            xreadgroup_side_effect=fake_xreadgroup,
+        )
+        fake_redis_connection.xautoclaim.return_value = ("0-0", [], [])
+        await BaseTaskConsumer(
+            redis_connection=fake_redis_connection,  # type: ignore
+            task_handlers={TaskType.SLEEP: make_fake_handler()},
+            queue_name="test",
+            reclaim_interval=0.02,
+        ).run()
+
+    assert fake_redis_connection.xautoclaim.call_count > 2
+    fake_redis_connection.xreadgroup.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_stop_should_drain_in_flight_tasks():
+    fake_redis_connection = _make_fake_redis_connection(xreadgroup_side_effect=None, xack_side_effect=None)
+    fake_redis_connection.xreadgroup.return_value = []
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+    )
+
+    async def fake_process_message(stream_name, message, is_reclaimed=False):
+        task_consumer.stop()
+        await asyncio.sleep(0.05)
+        await task_consumer._ack_message(stream_name=stream_name, message_id=message[0])
+
+    with patch.object(task_consumer, "_process_message", side_effect=fake_process_message):
+        await asyncio.wait_for(task_consumer.run(), timeout=1)
+
+    fake_redis_connection.xack.assert_called_once()
+    assert task_consumer.processed_count == 1
+
+
+@pytest.mark.asyncio
+async def test_ack_messages_in_batch():
+    fake_redis_connection = _make_fake_redis_connection(xack_side_effect=None)
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+        ack_batch_size=2,
+    )
+    for message_id in ["1-0", "2-0", "3-0"]:
+        await task_consumer._ack_message(stream_name="test", message_id=message_id)
+    await task_consumer._flush_acks()
+
+    assert [call.args for call in fake_redis_connection.xack.call_args_list] == [
+        ("test", "default_group", "1-0", "2-0"),
+        ("test", "default_group", "3-0"),
+    ]
+    assert task_consumer.processed_count == 3
+
+
+@pytest.mark.asyncio
+async def test_ack_failure_should_keep_message_ids_for_next_flush():
+    fake_redis_connection = _make_fake_redis_connection(xack_side_effect=[ConnectionError(), None])
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+    )
+    await task_consumer._ack_message(stream_name="test", message_id="1-0")
+    await task_consumer._flush_acks()
+    assert task_consumer.processed_count == 0
+
+    await task_consumer._flush_acks()
+    assert fake_redis_connection.xack.call_count == 2
+    assert task_consumer.processed_count == 1
+
+
+@pytest.mark.asyncio
+async def test_run_message_should_claim_task_without_reading_it():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one_or_none.return_value = Task(
+        id="test", status=TaskStatus.PROCESSING, type=TaskType.SLEEP, parameters={"a": 1}
+    )
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_session = fake_db_async_context_manager.__aenter__.return_value
+    fake_db_session.execute.return_value = mock_result
+    fake_handler = make_fake_handler()
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ):
+        fake_redis_connection = _make_fake_redis_connection(
+            xautoclaim_side_effect=[
+                (
+                    "0-0",
+                    [("message_id", {"task_id": "test", "version": "2", "type": "SLEEP", "parameters": '{"a":1}'})],
+                    [],
+                ),
+            ],
+            xack_side_effect=None,
+        )
+        await BaseTaskConsumer(
+            redis_connection=fake_redis_connection,  # type: ignore
+            task_handlers={TaskType.SLEEP: fake_handler},
+            queue_name="test",
+        ).run()
+
+    handled_task = fake_handler.handle.call_args.args[0]
+    assert (handled_task.id, handled_task.type, handled_task.parameters) == ("test", TaskType.SLEEP, {"a": 1})
+    executed_statements = [call.args[0] for call in fake_db_session.execute.call_args_list]
+    assert len(executed_statements) == 2
+    assert all(str(statement).startswith("UPDATE task") for statement in executed_statements)
+    assert executed_statements[-1].compile().params["status"] == TaskStatus.COMPLETED
+    fake_redis_connection.xack.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_run_message_claim_failed_should_not_run_but_ack():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one_or_none.return_value = None
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_async_context_manager.__aenter__.return_value.execute.return_value = mock_result
+    fake_handler = make_fake_handler()
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ):
+        fake_redis_connection = _make_fake_redis_connection(
+            xautoclaim_side_effect=[
+                (
+                    "0-0",
+                    [("message_id", {"task_id": "test", "version": "2", "type": "SLEEP", "parameters": "{}"})],
+                    [],
+                ),
+            ],
+            xack_side_effect=None,
+        )
+        await BaseTaskConsumer(
+            redis_connection=fake_redis_connection,  # type: ignore
+            task_handlers={TaskType.SLEEP: fake_handler},
+            queue_name="test",
+        ).run()
+
+    fake_handler.handle.assert_not_called()
+    fake_redis_connection.xack.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_run_cancellation_should_stop_running_handler():
+    handler_started = asyncio.Event()
+
+    class FakeHandler(BaseHandler):
+        async def handle(self, task):
+            handler_started.set()
+            await asyncio.sleep(10)
+
+    async def fake_xread(*args, **kwargs):
+        if not handler_started.is_set():
+            await handler_started.wait()
+            return [["cancel_stream", [("1-0", {"task_id": "test"})]]]
+        await asyncio.sleep(0.01)
+        return []
+
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one_or_none.return_value = Task(
+        id="test", status=TaskStatus.PROCESSING, type=TaskType.SLEEP
+    )
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_session = fake_db_async_context_manager.__aenter__.return_value
+    fake_db_session.execute.return_value = mock_result
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ):
+        fake_redis_connection = _make_fake_redis_connection(xack_side_effect=None)
+        fake_redis_connection.xrevrange.return_value = []
+        fake_redis_connection.xread.side_effect = fake_xread
+        await asyncio.wait_for(
+            BaseTaskConsumer(
+                redis_connection=fake_redis_connection,  # type: ignore
+                task_handlers={TaskType.SLEEP: FakeHandler()},  # type: ignore
+                queue_name="test",
+                cancel_stream_name="cancel_stream",
+            ).run(),
+            timeout=1,
+        )
+
+    last_statement = fake_db_session.execute.call_args.args[0]
+    assert last_statement.compile().params["status"] == TaskStatus.CANCELED
+    fake_redis_connection.xack.assert_called_once()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "handler_timeout, parameters",
+    [
+        (0.05, {}),
+        (None, {"timeout_seconds": 0.05}),
+        (10, {"timeout_seconds": "0.05"}),
+    ],
+)
+async def test_run_handler_exceeded_deadline_should_fail_with_timeout_error(handler_timeout, parameters):
+    class FakeHandler(BaseHandler):
+        async def handle(self, task):
+            await asyncio.sleep(10)
+
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one_or_none.return_value = Task(
+        id="test", status=TaskStatus.PROCESSING, type=TaskType.SLEEP, parameters=parameters
+    )
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_session = fake_db_async_context_manager.__aenter__.return_value
+    fake_db_session.execute.return_value = mock_result
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ):
+        fake_redis_connection = _make_fake_redis_connection(xack_side_effect=None)
+        await asyncio.wait_for(
+            BaseTaskConsumer(
+                redis_connection=fake_redis_connection,  # type: ignore
+                task_handlers={TaskType.SLEEP: FakeHandler(timeout=handler_timeout)},
+                queue_name="test",
+            ).run(),
+            timeout=1,
+        )
+
+    update_parameters = fake_db_session.execute.call_args.args[0].compile().params
+    assert update_parameters["status"] == TaskStatus.FAILED
+    assert update_parameters["error_code"] == TaskTimeoutError._code
+    fake_redis_connection.xack.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_lease_keeper_should_extend_leases_of_in_flight_messages():
+    fake_redis_connection = _make_fake_redis_connection()
+    fake_redis_connection.xclaim.return_value = []
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+        lease_interval=0.01,
+    )
+    task_consumer._in_flight_message_ids["test"].update({"1-0", "2-0"})
+    lease_keeper = asyncio.create_task(task_consumer._extend_leases_periodically())
+    await asyncio.sleep(0.05)
+    lease_keeper.cancel()
+    await asyncio.gather(lease_keeper, return_exceptions=True)
+
+    fake_redis_connection.xclaim.assert_called()
+    call_kwargs = fake_redis_connection.xclaim.call_args.kwargs
+    assert sorted(call_kwargs["message_ids"]) == ["1-0", "2-0"]
+    assert call_kwargs["min_idle_time"] == 0
+    assert call_kwargs["justid"] is True
+
+
+def test_lease_interval_not_shorter_than_min_idle_time_should_fail():
+    with pytest.raises(ValueError):
+        BaseTaskConsumer(
+            redis_connection=_make_fake_redis_connection(),  # type: ignore
+            task_handlers={TaskType.SLEEP: make_fake_handler()},
+            queue_name="test",
+            task_min_idle_times={TaskType.SLEEP: 1000},
+            lease_interval=1,
+        )
+
+
+@pytest.mark.asyncio
+async def test_reclaim_should_use_min_idle_time_of_task_type():
+    fake_redis_connection = _make_fake_redis_connection()
+    fake_redis_connection.xpending_range.return_value = [
+        {"message_id": "1-0", "consumer": "c", "time_since_delivered": 20000, "times_delivered": 1},
+        {"message_id": "2-0", "consumer": "c", "time_since_delivered": 20000, "times_delivered": 1},
+    ]
+    fake_pipeline = fake_redis_connection.pipeline.return_value
+    fake_pipeline.execute.return_value = [
+        [("1-0", {"task_id": "task_1", "type": TaskType.SLEEP.value})],
+        [("2-0", {"task_id": "task_2"})],
+    ]
+    fake_redis_connection.xclaim.return_value = [("2-0", {"task_id": "task_2"})]
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+        task_min_idle_times={TaskType.SLEEP: 60000},
+    )
+
+    messages = await task_consumer._claim_idle_messages_by_task_type(stream_name="test", count=10)
+
+    assert messages == [("2-0", {"task_id": "task_2"})]
+    assert fake_redis_connection.xpending_range.call_args.kwargs["idle"] == 10000
+    # the SLEEP message has not idled for 60s yet, only the legacy message is claimed with the default min idle time
+    fake_redis_connection.xclaim.assert_called_once()
+    assert fake_redis_connection.xclaim.call_args.kwargs["message_ids"] == ["2-0"]
+    assert fake_redis_connection.xclaim.call_args.kwargs["min_idle_time"] == 10000
+
+
+@pytest.mark.asyncio
+async def test_get_new_messages_should_share_count_by_weights_and_give_drained_share_to_backlog():
+    fake_redis_connection = _make_fake_redis_connection()
+    fake_pipeline = fake_redis_connection.pipeline.return_value
+    fake_pipeline.execute.side_effect = [
+        # the first read by weights, the low stream is drained
+        [
+            [["high", [("h-1", {"task_id": "h1"}), ("h-2", {"task_id": "h2"}), ("h-3", {"task_id": "h3"})]]],
+            [],
+        ],
+        # the share left by the low stream is read from the high stream
+        [[["high", [("h-4", {"task_id": "h4"})]]]],
+    ]
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="high",
+        queue_weights={"high": 3, "low": 1},
+    )
+
+    messages = await task_consumer._get_new_messages(count=4)
+
+    assert [message_id for _, (message_id, _) in messages] == ["h-1", "h-2", "h-3", "h-4"]
+    read_counts = [
+        (call.kwargs["streams"], call.kwargs["count"]) for call in fake_pipeline.xreadgroup.call_args_list
+    ]
+    assert read_counts == [({"high": ">"}, 3), ({"low": ">"}, 1), ({"high": ">"}, 1)]
+    fake_redis_connection.xreadgroup.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_get_new_messages_should_block_on_all_streams_when_all_drained():
+    fake_redis_connection = _make_fake_redis_connection(xreadgroup_side_effect=None)
+    fake_redis_connection.xreadgroup.return_value = [["low", [("l-1", {"task_id": "l1"})]]]
+    fake_redis_connection.pipeline.return_value.execute.return_value = [[], []]
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="high",
+        queue_weights={"high": 3, "low": 1},
+    )
+
+    messages = await task_consumer._get_new_messages(count=4)
+
+    assert messages == [("low", ("l-1", {"task_id": "l1"}))]
+    assert fake_redis_connection.xreadgroup.call_args.kwargs["streams"] == {"high": ">", "low": ">"}
+
+
+@pytest.mark.asyncio
+async def test_ack_flusher_should_sleep_until_ack_buffered():
+    fake_redis_connection = _make_fake_redis_connection(xack_side_effect=None)
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+        ack_flush_interval=0.001,
+    )
+    ack_flusher = asyncio.create_task(task_consumer._flush_acks_periodically())
+    with patch.object(task_consumer, "_flush_acks", wraps=task_consumer._flush_acks) as fake_flush_acks:
+        await asyncio.sleep(0.05)
+        fake_flush_acks.assert_not_called()
+
+        await task_consumer._ack_message(stream_name="test", message_id="1-0")
+        await asyncio.sleep(0.05)
+    ack_flusher.cancel()
+    await asyncio.gather(ack_flusher, return_exceptions=True)
+
+    fake_flush_acks.assert_called_once()
+    fake_redis_connection.xack.assert_called_once_with("test", "default_group", "1-0")
+
+
+@pytest.mark.asyncio
+async def test_ack_flusher_should_back_off_after_failed_flush():
+    fake_redis_connection = _make_fake_redis_connection(xack_side_effect=ConnectionError())
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+        ack_flush_interval=0.001,
+    )
+    with patch("app.worker.base_task_consumer.ACK_FLUSH_RETRY_INTERVAL", 0.1):
+        ack_flusher = asyncio.create_task(task_consumer._flush_acks_periodically())
+        await task_consumer._ack_message(stream_name="test", message_id="1-0")
+        await asyncio.sleep(0.15)
+        ack_flusher.cancel()
+        await asyncio.gather(ack_flusher, return_exceptions=True)
+
+    assert fake_redis_connection.xack.call_count == 2
+    assert task_consumer._pending_ack_message_ids["test"] == ["1-0"]
+
+
+@pytest.mark.asyncio
+async def test_status_write_failure_should_be_retried_then_not_fail_task_and_not_ack():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one_or_none.return_value = Task(
+        id="test", status=TaskStatus.PROCESSING, type=TaskType.SLEEP
+    )
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_async_context_manager.__aenter__.return_value.execute.return_value = mock_result
+    fake_status_writer = AsyncMock(spec=TaskStatusWriter)
+    fake_status_writer.write.side_effect = SQLAlchemyError("Connection failed")
+    fake_redis_connection = _make_fake_redis_connection(xack_side_effect=None)
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+        status_writer=fake_status_writer,
+    )
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ), patch("app.worker.base_task_consumer.STATUS_WRITE_RETRY_INTERVAL", 0):
+        await task_consumer._process_message(stream_name="test", message=("1-0", {"task_id": "test"}))
+    await task_consumer._flush_acks()
+
+    assert fake_status_writer.write.await_count == STATUS_WRITE_MAX_RETRY_COUNT + 1
+    assert fake_status_writer.write.call_args.kwargs["status"] == TaskStatus.COMPLETED
+    fake_redis_connection.xack.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_status_write_transient_failure_should_be_retried_and_acked():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one_or_none.return_value = Task(
+        id="test", status=TaskStatus.PROCESSING, type=TaskType.SLEEP
+    )
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_async_context_manager.__aenter__.return_value.execute.return_value = mock_result
+    fake_status_writer = AsyncMock(spec=TaskStatusWriter)
+    fake_status_writer.write.side_effect = [SQLAlchemyError("Connection failed"), True]
+    fake_redis_connection = _make_fake_redis_connection(xack_side_effect=None)
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+        status_writer=fake_status_writer,
+    )
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ), patch("app.worker.base_task_consumer.STATUS_WRITE_RETRY_INTERVAL", 0):
+        await task_consumer._process_message(stream_name="test", message=("1-0", {"task_id": "test"}))
+    await task_consumer._flush_acks()
+
+    assert fake_status_writer.write.await_count == 2
+    fake_redis_connection.xack.assert_called_once_with("test", "default_group", "1-0")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("is_reclaimed", [True, False])
+async def test_claim_failed_should_fail_processing_task_only_if_message_reclaimed(is_reclaimed):
+    claim_result = MagicMock()
+    claim_result.scalars.return_value.one_or_none.return_value = None
+    fail_result = MagicMock()
+    fail_result.scalars.return_value.one.return_value = Task(id="test", status=TaskStatus.FAILED, type=TaskType.SLEEP)
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_session = fake_db_async_context_manager.__aenter__.return_value
+    fake_db_session.execute.side_effect = [claim_result, fail_result]
+    fake_handler = make_fake_handler()
+    fake_redis_connection = _make_fake_redis_connection(xack_side_effect=None)
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: fake_handler},
+        queue_name="test",
+    )
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ):
+        await task_consumer._process_message(
+            stream_name="test", message=("1-0", {"task_id": "test"}), is_reclaimed=is_reclaimed
+        )
+    await task_consumer._flush_acks()
+
+    fake_handler.handle.assert_not_called()
+    if is_reclaimed:
+        update_parameters = fake_db_session.execute.call_args.args[0].compile().params
+        assert update_parameters["status"] == TaskStatus.FAILED
+        assert update_parameters["error_code"] == TaskAbandoned._code
+        assert update_parameters["status_1"] == [TaskStatus.PROCESSING]
+    else:
+        assert fake_db_session.execute.call_count == 1
+    fake_redis_connection.xack.assert_called_once_with("test", "default_group", "1-0")
+
+
+@pytest.mark.asyncio
+async def test_promoter_should_promote_due_messages_by_batches():
+    fake_redis_connection = _make_fake_redis_connection()
+    # a full batch is followed immediately, the partial one waits for the next interval
+    fake_promote_script = AsyncMock(side_effect=[2, 1, 0])
+    fake_redis_connection.register_script = MagicMock(return_value=fake_promote_script)
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+        delayed_queue_name="test:delayed",
+        promote_interval=10,
+        promote_batch_size=2,
+    )
+    promoter = asyncio.create_task(task_consumer._promote_due_messages_periodically())
+    await asyncio.sleep(0.05)
+    promoter.cancel()
+    await asyncio.gather(promoter, return_exceptions=True)
+
+    assert fake_promote_script.await_count == 2
+    call_kwargs = fake_promote_script.call_args.kwargs
+    assert call_kwargs["keys"] == ["test:delayed", "test"]
+    assert call_kwargs["args"][1] == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_task_with_retries_left_should_be_scheduled_and_acked():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one_or_none.return_value = Task(
+        id="test", status=TaskStatus.PROCESSING, type=TaskType.SLEEP
+    )
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_session = fake_db_async_context_manager.__aenter__.return_value
+    fake_db_session.execute.return_value = mock_result
+    fake_handler = make_fake_handler(retry_policy=RetryPolicy(max_retries=2, base_delay=10, jitter=0))
+    fake_handler.handle.side_effect = Exception("transient")
+    fake_redis_connection = _make_fake_redis_connection(xack_side_effect=None)
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: fake_handler},
+        queue_name="test",
+        delayed_queue_name="test:delayed",
+        dead_letter_stream_name="test:dead_letter",
+    )
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ):
+        await task_consumer._process_message(stream_name="test", message=("1-0", {"task_id": "test", "attempt": "1"}))
+    await task_consumer._flush_acks()
+
+    update_parameters = fake_db_session.execute.call_args.args[0].compile().params
+    assert update_parameters["status"] == TaskStatus.PENDING
+    delayed_queue_name, entries = fake_redis_connection.zadd.call_args.args
+    assert delayed_queue_name == "test:delayed"
+    [entry] = entries
+    assert json.loads(entry) == {"queue": "test", "message": {"task_id": "test", "attempt": "2"}}
+    fake_redis_connection.xadd.assert_not_called()
+    fake_redis_connection.xack.assert_called_once_with("test", "default_group", "1-0")
+
+
+@pytest.mark.asyncio
+async def test_failed_task_without_retries_left_should_fail_and_be_dead_lettered():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one_or_none.return_value = Task(
+        id="test", status=TaskStatus.PROCESSING, type=TaskType.SLEEP
+    )
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_session = fake_db_async_context_manager.__aenter__.return_value
+    fake_db_session.execute.return_value = mock_result
+    fake_handler = make_fake_handler(retry_policy=RetryPolicy(max_retries=2))
+    fake_handler.handle.side_effect = Exception("still broken")
+    fake_redis_connection = _make_fake_redis_connection(xadd_side_effect=None, xack_side_effect=None)
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: fake_handler},
+        queue_name="test",
+        delayed_queue_name="test:delayed",
+        dead_letter_stream_name="test:dead_letter",
+    )
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ):
+        await task_consumer._process_message(stream_name="test", message=("1-0", {"task_id": "test", "attempt": "2"}))
+    await task_consumer._flush_acks()
+
+    update_parameters = fake_db_session.execute.call_args.args[0].compile().params
+    assert update_parameters["status"] == TaskStatus.FAILED
+    fake_redis_connection.zadd.assert_not_called()
+    assert fake_redis_connection.xadd.call_args.args == ("test:dead_letter",)
+    assert fake_redis_connection.xadd.call_args.kwargs["fields"] == {
+        "task_id": "test",
+        "attempt": "2",
+        "queue": "test",
+        "message_id": "1-0",
+        "error": "still broken",
+        "error_code": 1,
+    }
+    fake_redis_connection.xack.assert_called_once_with("test", "default_group", "1-0")
+
+
+@pytest.mark.asyncio
+async def test_reclaimed_message_over_max_delivery_count_should_be_dead_lettered_instead_of_processed():
+    fake_redis_connection = _make_fake_redis_connection(
+        xadd_side_effect=None,
+        xautoclaim_side_effect=[("0-0", [("1-0", {"task_id": "poison"}), ("2-0", {"task_id": "healthy"})], [])],
+    )
+    fake_redis_connection.pipeline.return_value.execute.return_value = [
+        [{"message_id": "1-0", "consumer": "c", "time_since_delivered": 0, "times_delivered": 4}],
+        [{"message_id": "2-0", "consumer": "c", "time_since_delivered": 0, "times_delivered": 2}],
+    ]
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_session = fake_db_async_context_manager.__aenter__.return_value
+    fake_db_session.execute.return_value = MagicMock()
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+        dead_letter_stream_name="test:dead_letter",
+        max_delivery_count=3,
+    )
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ), patch.object(task_consumer, "_dispatch_message") as fake_dispatch_message:
+        await task_consumer._reclaim_stream_pending_messages(stream_name="test")
+
+    fake_dispatch_message.assert_called_once_with(
+        stream_name="test", message=("2-0", {"task_id": "healthy"}), is_reclaimed=True
+    )
+    update_parameters = fake_db_session.execute.call_args.args[0].compile().params
+    assert update_parameters["status"] == TaskStatus.FAILED
+    assert update_parameters["error_code"] == TaskDeliveryExceeded._code
+    dead_letter_fields = fake_redis_connection.xadd.call_args.kwargs["fields"]
+    assert dead_letter_fields["task_id"] == "poison"
+    assert dead_letter_fields["error_code"] == TaskDeliveryExceeded._code
+    assert task_consumer._pending_ack_message_ids["test"] == ["1-0"]
+
+
+@pytest.mark.asyncio
+async def test_trimmer_should_trim_streams_to_oldest_entry_needed_by_groups():
+    fake_redis_connection = _make_fake_redis_connection(xinfo_groups_side_effect=None)
+    fake_redis_connection.xinfo_groups.side_effect = [
+        [
+            # the oldest pending entry of this group is kept
+            {"name": "group_1", "pending": 2, "last-delivered-id": "30-0"},
+            # this group read and acknowledged everything before 25-0, the entries after it are not read yet
+            {"name": "group_2", "pending": 0, "last-delivered-id": "25-0"},
+        ],
+        # a stream without groups is not trimmed
+        [],
+    ]
+    fake_redis_connection.xpending.return_value = {"pending": 2, "min": "9-1", "max": "30-0", "consumers": []}
+    fake_redis_connection.xtrim.return_value = 8
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="high",
+        queue_weights={"high": 3, "low": 1},
+        trim_interval=0.01,
+    )
+    trimmer = asyncio.create_task(task_consumer._trim_streams_periodically())
+    await asyncio.sleep(0.015)
+    trimmer.cancel()
+    await asyncio.gather(trimmer, return_exceptions=True)
+
+    fake_redis_connection.xpending.assert_called_once_with("high", "group_1")
+    fake_redis_connection.xtrim.assert_called_once_with("high", minid="9-1", approximate=True)
+
+
+@pytest.mark.asyncio
+async def test_committed_transitions_should_be_published_to_status_stream():
+    mock_result = MagicMock()
+    mock_result.scalars.return_value.one_or_none.return_value = Task(
+        id="test", status=TaskStatus.PROCESSING, type=TaskType.SLEEP
+    )
+    mock_result.scalars.return_value.one.return_value = Task(id="test", status=TaskStatus.COMPLETED, type=TaskType.SLEEP)
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_async_context_manager.__aenter__.return_value.execute.return_value = mock_result
+    fake_redis_connection = _make_fake_redis_connection(xack_side_effect=None)
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+        status_events_enabled=True,
+    )
+    with patch(
+        "app.worker.base_task_consumer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ):
+        await task_consumer._process_message(stream_name="test", message=("1-0", {"task_id": "test"}))
+
+    fake_redis_pipeline = fake_redis_connection.pipeline.return_value
+    assert [call.args[0] for call in fake_redis_pipeline.xadd.call_args_list] == [TASK_STATUS_STREAM_NAME] * 2
+    assert [call.kwargs["fields"] for call in fake_redis_pipeline.xadd.call_args_list] == [
+        {"task_id": "test", "status": "PROCESSING", "type": "SLEEP"},
+        {"task_id": "test", "status": "COMPLETED", "type": "SLEEP"},
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("is_updated", [True, False])
+async def test_write_behind_transition_should_only_be_published_if_updated(is_updated):
+    fake_status_writer = AsyncMock(spec=TaskStatusWriter)
+    fake_status_writer.write.return_value = is_updated
+    fake_redis_connection = _make_fake_redis_connection()
+    task_consumer = BaseTaskConsumer(
+        redis_connection=fake_redis_connection,  # type: ignore
+        task_handlers={TaskType.SLEEP: make_fake_handler()},
+        queue_name="test",
+        status_writer=fake_status_writer,
+        status_events_enabled=True,
+    )
+    await task_consumer._on_finish(Task(id="test", status=TaskStatus.PROCESSING, type=TaskType.SLEEP))
+
+    fake_redis_pipeline = fake_redis_connection.pipeline.return_value
+    if is_updated:
+        assert fake_redis_pipeline.xadd.call_args.kwargs["fields"] == {
+            "task_id": "test",
+            "status": "COMPLETED",
+            "type": "SLEEP",
+        }
+    else:
+        fake_redis_pipeline.xadd.assert_not_called()
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import time
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app.database.models.task import Task
+from app.enum.task import TaskType
+from app.worker.process_pool import TaskProcessPool
+from app.worker.task_handler.process_pool_handler import ProcessPoolHandler
+
+
+class FakeCpuBoundHandler(ProcessPoolHandler):
+    @staticmethod
+    def run(task_id, parameters):
+        return task_id, parameters
+
+
+@pytest.mark.asyncio
+async def test_run_in_child_process_and_recycle_after_max_tasks():
+    pool = TaskProcessPool(size=1, max_tasks_per_child=1)
+    await pool.start()
+    try:
+        first_pid = await pool.run(os.getpid)
+        assert first_pid != os.getpid()
+
+        # the pool is recycled in background when the next task is submitted
+        await pool.run(os.getpid)
+        assert pool._recycler is not None
+        await pool._recycler
+        assert await pool.run(os.getpid) not in (first_pid, os.getpid())
+    finally:
+        await pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_shared_pool_should_be_stopped_by_last_user():
+    pool = TaskProcessPool(size=1)
+    first_handler, second_handler = FakeCpuBoundHandler(pool=pool), FakeCpuBoundHandler(pool=pool)
+    await first_handler.start()
+    await second_handler.start()
+    try:
+        await first_handler.stop()
+        assert await second_handler.handle(Task(id="test", type=TaskType.SLEEP)) == ("test", {})
+    finally:
+        await second_handler.stop()
+    assert pool._executor is None
+
+
+def test_invalid_max_tasks_per_child_should_fail():
+    with pytest.raises(ValueError):
+        TaskProcessPool(size=1, max_tasks_per_child=0)
+
+
+@pytest.mark.asyncio
+async def test_process_pool_handler_should_send_only_id_and_parameters():
+    fake_pool = AsyncMock()
+    fake_pool.run.return_value = "result"
+    handler = FakeCpuBoundHandler(pool=fake_pool)
+
+    await handler.start()
+    result = await handler.handle(Task(id="test", type=TaskType.SLEEP, parameters={"a": 1}))
+    await handler.stop()
+
+    assert result == "result"
+    fake_pool.run.assert_awaited_once_with(FakeCpuBoundHandler.run, "test", {"a": 1})
+    fake_pool.start.assert_awaited_once()
+    fake_pool.stop.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_cancel_running_call_should_replace_pool_and_terminate_its_children():
+    pool = TaskProcessPool(size=1, max_tasks_per_child=100)
+    await pool.start()
+    try:
+        old_processes = list(pool._executor._processes.values())
+        runaway_call = asyncio.create_task(pool.run(time.sleep, 30))
+        await asyncio.sleep(0.5)
+        runaway_call.cancel()
+        await asyncio.gather(runaway_call, return_exceptions=True)
+        await pool._recycler
+
+        for process in old_processes:
+            process.join(timeout=5)
+            assert not process.is_alive()
+        assert await asyncio.wait_for(pool.run(os.getpid), timeout=5) not in [p.pid for p in old_processes]
+    finally:
+        await pool.stop()
@@ -0,0 +1,38 @@
+import pytest
+
+from app.worker.retry_policy import RetryPolicy
+
+
+def test_get_delay_should_back_off_exponentially_up_to_max_delay():
+    retry_policy = RetryPolicy(max_retries=5, base_delay=1, max_delay=5, jitter=0)
+
+    assert [retry_policy.get_delay(attempt) for attempt in range(5)] == [1, 2, 4, 5, 5]
+
+
+def test_get_delay_should_return_none_after_max_retries():
+    retry_policy = RetryPolicy(max_retries=2)
+
+    assert retry_policy.get_delay(1) is not None
+    assert retry_policy.get_delay(2) is None
+
+
+def test_get_delay_should_be_spread_by_jitter():
+    retry_policy = RetryPolicy(max_retries=1, base_delay=10, jitter=0.5)
+
+    delays = [retry_policy.get_delay(0) for _ in range(100)]
+
+    assert all(5 <= delay <= 10 for delay in delays)  # type: ignore
+    assert len(set(delays)) > 1
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"max_retries": -1},
+        {"base_delay": 10, "max_delay": 1},
+        {"jitter": 1},
+    ],
+)
+def test_invalid_retry_policy_should_fail(kwargs):
+    with pytest.raises(ValueError):
+        RetryPolicy(**kwargs)
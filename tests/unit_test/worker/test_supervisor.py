@@ -0,0 +1,109 @@
+import functools
+import multiprocessing
+import signal
+import threading
+import time
+from unittest.mock import patch
+
+from app.worker.supervisor import MIN_RESTART_INTERVAL_SECONDS, WorkerSupervisor
+
+
+def _exit_immediately(index, processed_counter):
+    processed_counter.value += 1
+
+
+def _ignore_sigterm_and_sleep(index, processed_counter, ready):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    ready.set()
+    time.sleep(10)
+
+
+def _sleep(index, processed_counter):
+    # not time.sleep, it is patched in the supervisor and inherited by the forked children
+    threading.Event().wait(10)
+
+
+def test_supervise_should_restart_crashed_process_with_backoff():
+    supervisor = WorkerSupervisor(target=_exit_immediately, process_count=1)
+    worker = supervisor._workers[0]
+
+    supervisor._supervise(worker)
+    first_pid = worker.process.pid
+    worker.process.join(timeout=5)
+
+    supervisor._supervise(worker)
+    assert worker.process is None
+    assert worker.restart_count == 1
+    assert worker.crash_streak == 1
+    assert worker.next_start_time - time.time() > MIN_RESTART_INTERVAL_SECONDS / 2
+
+    # not restarted before the backoff is over
+    supervisor._supervise(worker)
+    assert worker.process is None
+
+    worker.next_start_time = 0
+    supervisor._supervise(worker)
+    assert worker.process.pid != first_pid
+    worker.process.join(timeout=5)
+
+    # the process crashed shortly after the restart again, the backoff is doubled
+    supervisor._supervise(worker)
+    assert worker.crash_streak == 2
+    assert worker.next_start_time - time.time() > MIN_RESTART_INTERVAL_SECONDS * 1.5
+    assert worker.processed_counter.value == 2
+
+
+def test_drain_should_terminate_processes():
+    supervisor = WorkerSupervisor(target=_sleep, process_count=2, drain_timeout=5)
+    for worker in supervisor._workers:
+        supervisor._supervise(worker)
+
+    supervisor._drain()
+
+    for worker in supervisor._workers:
+        assert not worker.process.is_alive()
+        assert worker.process.exitcode == -signal.SIGTERM
+
+
+def test_drain_should_kill_processes_after_drain_timeout():
+    ready = multiprocessing.Event()
+    supervisor = WorkerSupervisor(
+        target=functools.partial(_ignore_sigterm_and_sleep, ready=ready),
+        process_count=1,
+        drain_timeout=0.2,
+    )
+    worker = supervisor._workers[0]
+    supervisor._supervise(worker)
+    assert ready.wait(timeout=5)
+
+    start_time = time.time()
+    supervisor._drain()
+
+    assert time.time() - start_time < 5
+    assert worker.process.exitcode == -signal.SIGKILL
+
+
+def test_stop_signal_should_drain_processes():
+    supervisor = WorkerSupervisor(target=_sleep, process_count=1, drain_timeout=5)
+
+    def fake_sleep(seconds):
+        supervisor._on_stop_signal(signal.SIGTERM, None)
+
+    with patch("app.worker.supervisor.time.sleep", side_effect=fake_sleep), patch("app.worker.supervisor.signal.signal"):
+        supervisor.run()
+
+    worker = supervisor._workers[0]
+    assert worker.process.exitcode == -signal.SIGTERM
+
+
+def test_report_throughput_should_record_processed_count():
+    supervisor = WorkerSupervisor(target=_sleep, process_count=1)
+    worker = supervisor._workers[0]
+    worker.processed_counter.value = 30
+    worker.reported_time = time.time() - 10
+
+    with patch("app.worker.supervisor.logger") as fake_logger:
+        supervisor._report_throughput()
+
+    assert worker.reported_count == 30
+    assert "3.00 tasks/s" in fake_logger.info.call_args.args[0]
@@ -0,0 +1,61 @@
+import asyncio
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+import pytest
+from sqlalchemy.dialects.postgresql import asyncpg
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.enum.task import TaskStatus
+from app.worker.task_status_writer import TaskStatusWriter
+from tests.unit_test.utils import make_fake_db_async_context_manager
+
+
+@pytest.mark.asyncio
+async def test_write_should_flush_transitions_in_one_statement():
+    fake_db_async_context_manager = make_fake_db_async_context_manager(execute_side_effect=None, commit_side_effect=None)
+    fake_db_session = fake_db_async_context_manager.__aenter__.return_value
+    # the task 3 is not PROCESSING anymore
+    fake_db_session.execute.return_value = MagicMock()
+    fake_db_session.execute.return_value.scalars.return_value.all.return_value = ["1", "2"]
+    with patch(
+        "app.worker.task_status_writer.get_db_session_context_manager",
+        return_value=fake_db_async_context_manager,
+    ):
+        status_writer = TaskStatusWriter(flush_interval=10, flush_size=3)
+        status_writer.start()
+        is_updated_list = await asyncio.wait_for(
+            asyncio.gather(
+                status_writer.write(id="1", status=TaskStatus.COMPLETED, ended_at=datetime(2022, 1, 1)),
+                status_writer.write(id="2", status=TaskStatus.COMPLETED, ended_at=datetime(2022, 1, 1)),
+                status_writer.write(
+                    id="3", status=TaskStatus.FAILED, ended_at=datetime(2022, 1, 1), error_message="error", error_code=1
+                ),
+            ),
+            timeout=1,
+        )
+        await status_writer.stop()
+
+    assert is_updated_list == [True, True, False]
+    fake_db_session.execute.assert_called_once()
+    fake_db_session.commit.assert_called_once()
+    statement = str(fake_db_session.execute.call_args.args[0].compile(dialect=asyncpg.dialect()))
+    assert statement.startswith("UPDATE task SET")
+    assert "FROM (VALUES" in statement
+    assert "RETURNING task.id" in statement
+
+
+@pytest.mark.asyncio
+async def test_write_should_raise_when_flush_failed():
+    with patch(
+        "app.worker.task_status_writer.get_db_session_context_manager",
+        return_value=make_fake_db_async_context_manager(execute_side_effect=[SQLAlchemyError()]),
+    ):
+        status_writer = TaskStatusWriter(flush_interval=0.01)
+        status_writer.start()
+        with pytest.raises(SQLAlchemyError):
+            await asyncio.wait_for(
+                status_writer.write(id="1", status=TaskStatus.COMPLETED, ended_at=datetime(2022, 1, 1)),
+                timeout=1,
+            )
+        await status_writer.stop()
@@ -0,0 +1,25 @@
+import pytest
+
+from app.worker.weighted_round_robin import WeightedRoundRobin
+
+
+def test_allocate_in_proportion_to_weights():
+    shares = WeightedRoundRobin({"high": 6, "normal": 3, "low": 1})
+    assert shares.allocate(100) == {"high": 60, "normal": 30, "low": 10}
+
+
+def test_allocate_one_by_one_should_not_starve_low_weight():
+    shares = WeightedRoundRobin({"high": 6, "normal": 3, "low": 1})
+    allocations = [shares.allocate(1) for _ in range(10)]
+    assert sum(allocation["low"] for allocation in allocations) == 1
+    assert sum(allocation["high"] for allocation in allocations) == 6
+
+
+def test_allocate_among_subset():
+    shares = WeightedRoundRobin({"high": 6, "normal": 3, "low": 1})
+    assert shares.allocate(4, names=["normal", "low"]) == {"normal": 3, "low": 1}
+
+
+def test_invalid_weight_should_fail():
+    with pytest.raises(ValueError):
+        WeightedRoundRobin({"high": 0})